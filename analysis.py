@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+
+from analysis_cache import AnalysisCache, cache_key
+from gemini_client import GEMINI_API_ENDPOINT, gemini_client
+from metrics import GEMINI_ERRORS, GEMINI_IN_FLIGHT
+from timing import span
+
+# Gemini Vision APIで使用するモデル
+GEMINI_MODEL_NAME = 'models/gemini-1.5-flash'
+
+# 解析に使うバックエンド。gemini (既定) または fake (APIを呼び出さない負荷試験用。fake_gemini.py を参照)
+ANALYSIS_BACKEND = os.getenv("ANALYSIS_BACKEND", "gemini")
+
+# 写真の解析方法。per_view (既定) は写真ごとにMarkdownで、combined は全ての写真を1回の呼び出しでJSONとして解析する
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "per_view")
+
+# combined で部位ごとに返してもらう所見の観点
+FINDING_CATEGORIES = ["歯列", "咬合", "歯肉", "その他"]
+
+# 同時に解析する写真の上限数と、1枚あたりのタイムアウト（秒、再試行を含む）
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "5"))
+ANALYSIS_TIMEOUT = float(os.getenv("ANALYSIS_TIMEOUT", "60"))
+
+# 解析結果のキャッシュ (ANALYSIS_CACHE_PATH を指定するとディスク層も有効になる)
+analysis_cache = AnalysisCache(
+    max_entries=int(os.getenv("ANALYSIS_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("ANALYSIS_CACHE_TTL", "86400")),
+    db_path=os.getenv("ANALYSIS_CACHE_PATH") or None,
+)
+
+# Server-Timing やメトリクスで使う部位の名前 (ヘッダーに日本語を使えないため)
+VIEW_KEYS = {
+    "正面観": "front",
+    "上顎咬合面観": "upper_occlusal",
+    "下顎咬合面観": "lower_occlusal",
+    "右側方観": "right_lateral",
+    "左側方観": "left_lateral",
+}
+
+
+_genai = None
+_genai_lock = threading.Lock()
+
+
+def gemini():
+    """
+    google.generativeai を読み込み、APIキーを設定して返す。
+    読み込みに時間とメモリがかかるため、起動時ではなく起動後 (load_gemini) か最初の解析時に読み込む。
+    """
+    global _genai
+    if _genai is not None:
+        return _genai
+    with _genai_lock:
+        if _genai is not None:
+            return _genai
+        import google.generativeai as genai
+        # Gemini APIキーを設定
+        if GEMINI_API_ENDPOINT:
+            genai.configure(
+                api_key=os.getenv("GEMINI_API_KEY"), transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT}
+            )
+        else:
+            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        _genai = genai
+    return _genai
+
+
+async def load_gemini():
+    """
+    gemini() をスレッドで呼び出す。読み込みには2秒近くかかり、イベントループで行うと
+    その間ワーカーの全てのリクエストが止まるため、解析の前にこれを待つ。
+    """
+    if _genai is None:
+        await asyncio.to_thread(gemini)
+
+
+def generative_model(model_name, generation_config=None):
+    """ANALYSIS_BACKEND の設定に応じて、Gemini または負荷試験用の偽物のモデルを返す"""
+    # 偽物を使う場合も、起動時間やメモリ使用量が本番と同じになるようライブラリは読み込む
+    genai = gemini()
+    if ANALYSIS_BACKEND == "fake":
+        from fake_gemini import FakeGenerativeModel
+        return FakeGenerativeModel(model_name, generation_config)
+    return genai.GenerativeModel(model_name, generation_config=generation_config)
+
+
+def build_prompt(view_name):
+    """各部位の写真に対するGeminiへのプロンプトを作成する"""
+    return f"""この{view_name}の口腔内写真について、歯科医の視点から詳細に分析してください。
+                分析結果はMarkdown形式で、箇条書きなどを用いて分かりやすく記述してください。"""
+
+
+def build_combined_prompt(view_names):
+    """全ての写真をまとめて解析するときのGeminiへのプロンプトを作成する"""
+    return f"""以下の{len(view_names)}枚の口腔内写真 ({"、".join(view_names)}) について、歯科医の視点から部位ごとに詳細に分析してください。
+                各写真の直前に【部位名】を記載しています。
+                部位ごとに、{"・".join(FINDING_CATEGORIES)}の観点から所見を1文ずつ記述してください。"""
+
+
+def combined_schema(view_names):
+    """combined の応答のJSONスキーマ {"views": [{"view": 部位名, "findings": [{"category", "finding"}, ...]}, ...]}"""
+    def enum(values):
+        return {"type": "string", "format": "enum", "enum": list(values)}
+
+    finding = {
+        "type": "object",
+        "properties": {"category": enum(FINDING_CATEGORIES), "finding": {"type": "string"}},
+        "required": ["category", "finding"],
+    }
+    view = {
+        "type": "object",
+        "properties": {"view": enum(view_names), "findings": {"type": "array", "items": finding}},
+        "required": ["view", "findings"],
+    }
+    return {"type": "object", "properties": {"views": {"type": "array", "items": view}}, "required": ["views"]}
+
+
+def parse_combined(text, view_names):
+    """combined の応答を {部位名: [{"category", "finding"}, ...]} に変換する。形式が違う場合は ValueError"""
+    try:
+        views = json.loads(text)["views"]
+        findings = {v["view"]: [{"category": f["category"], "finding": f["finding"]} for f in v["findings"]] for v in views}
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Geminiの応答をJSONとして解釈できませんでした: {e}") from e
+    return {view: findings[view] for view in view_names if view in findings}
+
+
+def findings_markdown(findings):
+    """所見のリストを、写真ごとに解析したときと同じ形のMarkdownの箇条書きにする"""
+    return "\n".join(f"- **{f['category']}**: {f['finding']}" for f in findings)
+
+
+async def analyze_combined(saved_photos, on_result=None, on_chunk=None):
+    """
+    全ての写真を1回の呼び出しで解析し、写真ごとの所見のリスト (応答に含まれなかった写真は例外) を入力と同じ順序で返す。
+    """
+    view_names = [photo["view"] for photo in saved_photos]
+    prompt = build_combined_prompt(view_names)
+    images = b"".join(
+        bytes.fromhex(photo["digest"]) if photo.get("digest") else hashlib.sha256(photo["data"]).digest()
+        for photo in saved_photos
+    )
+    key = cache_key(images, "combined:" + ",".join(view_names), GEMINI_MODEL_NAME, prompt)
+
+    error = None
+    try:
+        text = cached = await analysis_cache.get(key)
+        if cached is None:
+            await load_gemini()
+            model = generative_model(
+                GEMINI_MODEL_NAME,
+                {"response_mime_type": "application/json", "response_schema": combined_schema(view_names)},
+            )
+            contents = [prompt]
+            for photo in saved_photos:
+                contents += [f"【{photo['view']}】", {"mime_type": photo["mime_type"], "data": photo["data"]}]
+            with span("analysis.combined"), GEMINI_IN_FLIGHT.track_inprogress():
+                text = await gemini_client.generate(model, contents, ANALYSIS_TIMEOUT)
+        findings = parse_combined(text, view_names)
+        # 解釈できた応答だけをキャッシュする
+        if cached is None:
+            await analysis_cache.set(key, text)
+    except Exception as e:
+        findings = {}
+        error = e
+
+    results = []
+    for view_name in view_names:
+        if view_name not in findings:
+            results.append(error or ValueError(f"Geminiの応答に{view_name}の所見が含まれていませんでした"))
+            if on_result:
+                on_result(view_name, False)
+            continue
+        results.append(findings[view_name])
+        # 部位ごとのテキストは応答全体が届いてから1度に渡す (JSONの途中は表示できないため)
+        if on_chunk:
+            on_chunk(view_name, findings_markdown(findings[view_name]))
+        if on_result:
+            on_result(view_name, True)
+    return results
+
+
+async def analyze_view(view_name, image_bytes, mime_type, semaphore, on_chunk=None, image_digest=None):
+    """
+    1枚の写真をGemini Vision APIで解析し、解析結果のテキストを返す。
+    on_chunk を渡すとストリーミングで生成し、届いた部分ごとに on_chunk(部位名, テキスト) を呼び出す。
+    image_digest には保存時に計算した写真のハッシュ値を渡す (キャッシュキーの計算で写真を読み直さない)。
+    """
+    prompt = build_prompt(view_name)
+    key = cache_key(image_bytes, view_name, GEMINI_MODEL_NAME, prompt, image_digest)
+    cached = await analysis_cache.get(key)
+    if cached is not None:
+        if on_chunk:
+            on_chunk(view_name, cached)
+        return cached
+
+    async with semaphore:
+        await load_gemini()
+        model = generative_model(GEMINI_MODEL_NAME)
+        # 規格化済みの画像はエンコード済みのバイト列のまま渡す (再デコード・再エンコードしない)
+        contents = [prompt, {"mime_type": mime_type, "data": image_bytes}]
+        with GEMINI_IN_FLIGHT.track_inprogress():
+            # 呼び出し回数の制限・再試行・ヘッジは gemini_client.py で行う
+            text = await gemini_client.generate(
+                model, contents, ANALYSIS_TIMEOUT, on_chunk and (lambda chunk: on_chunk(view_name, chunk))
+            )
+    await analysis_cache.set(key, text)
+    return text
+
+
+async def analyze_photos(saved_photos, on_result=None, on_chunk=None):
+    """
+    保存済みの写真 [{"view", "path", "data", "mime_type", "digest"}, ...] を並行して解析する。
+    gemini_analyses と photo_paths を入力と同じ順序で返す。
+    on_result を渡すと、各写真の解析が終わるたびに on_result(部位名, 成功したか) が呼び出される。
+    on_chunk を渡すと、解析結果がストリーミングで届くたびに on_chunk(部位名, テキスト) が呼び出される。
+    ANALYSIS_MODE が combined のときは1回の呼び出しで解析し、gemini_analyses に構造化した所見 (findings) も入れる。
+    """
+    if ANALYSIS_MODE == "combined" and saved_photos:
+        with span("analysis"):
+            results = await analyze_combined(saved_photos, on_result, on_chunk)
+        return collect_results(saved_photos, results)
+
+    semaphore = asyncio.Semaphore(max(1, ANALYSIS_CONCURRENCY))
+
+    async def analyze(photo):
+        try:
+            with span(f"analysis.{VIEW_KEYS.get(photo['view'], 'other')}"):
+                analysis = await analyze_view(
+                    photo["view"], photo["data"], photo["mime_type"], semaphore, on_chunk, photo.get("digest")
+                )
+        except Exception:
+            if on_result:
+                on_result(photo["view"], False)
+            raise
+        if on_result:
+            on_result(photo["view"], True)
+        return analysis
+
+    with span("analysis"):
+        results = await asyncio.gather(*(analyze(photo) for photo in saved_photos), return_exceptions=True)
+    return collect_results(saved_photos, results)
+
+
+def collect_results(saved_photos, results):
+    """解析結果 (テキスト・所見のリスト・例外) を gemini_analyses と photo_paths にまとめる"""
+    gemini_analyses = []
+    photo_paths = []
+    for photo, result in zip(saved_photos, results):
+        view_name = photo["view"]
+        if isinstance(result, asyncio.TimeoutError):
+            result = TimeoutError(f"{ANALYSIS_TIMEOUT}秒以内に応答がありませんでした")
+        if isinstance(result, BaseException):
+            print(f"Gemini Vision API呼び出し中にエラーが発生しました ({view_name}): {result}")
+            GEMINI_ERRORS.labels(VIEW_KEYS.get(view_name, "other"), type(result).__name__).inc()
+            gemini_analyses.append({"view": view_name, "analysis": f"AI画像解析中にエラーが発生しました: {result}"})
+            continue
+
+        if isinstance(result, list):
+            gemini_analyses.append({"view": view_name, "analysis": findings_markdown(result), "findings": result})
+        else:
+            gemini_analyses.append({"view": view_name, "analysis": result})
+        photo_paths.append({"view": view_name, "path": str(photo["path"])})
+        print(f"Gemini AI Analysis for {view_name}: {gemini_analyses[-1]['analysis']}")
+
+    return gemini_analyses, photo_paths
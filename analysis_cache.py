@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(image_bytes, view_name, model_name, prompt, image_digest=None):
+    """
+    画像のバイト列・部位名・モデル名・プロンプトからキャッシュキーを作成する。
+    画像のハッシュ値 (sha256 の16進数) を image_digest に渡すと計算し直さない。
+    """
+    h = hashlib.sha256()
+    h.update(bytes.fromhex(image_digest) if image_digest else hashlib.sha256(image_bytes).digest())
+    for part in (view_name, model_name, prompt):
+        h.update(b"\0")
+        h.update(part.encode("utf-8"))
+    return h.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Geminiの解析結果のキャッシュ。
+    メモリ上のLRU（件数上限とTTL付き）と、任意でSQLiteによるディスク層を持つ。
+    ディスク層は再起動後も残り、同じファイルを指定した全てのgunicornワーカーで共有される。
+    ディスク層の読み書きは、イベントループを止めないようスレッドで行う (接続はプロセスで1つを使い回す)。
+    """
+
+    def __init__(self, max_entries=256, ttl=86400, db_path=None, purge_interval=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = str(db_path) if db_path else None
+        # 期限切れの行をディスク層から削除する間隔（秒）
+        self.purge_interval = purge_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._purged_at = 0.0
+        self.stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS analyses ("
+                    "key TEXT PRIMARY KEY, analysis TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS analyses_expires_at ON analyses (expires_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _connection(self):
+        """ディスク層の接続を返す (_db_lock を取ってから使う)。gunicornのワーカーごとに作成する"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+        return self._conn
+
+    async def get(self, key):
+        """キャッシュされた解析結果を返す。無ければ None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, analysis = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    self.stats["memory_hits"] += 1
+                    return analysis
+                del self._entries[key]
+                self.stats["evictions"] += 1
+
+        if self.db_path:
+            row = await asyncio.to_thread(self._disk_get, key, now)
+            if row is not None:
+                analysis, expires_at = row
+                with self._lock:
+                    self._store(key, analysis, expires_at)
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                return analysis
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    async def set(self, key, analysis):
+        """解析結果をキャッシュに保存する"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, analysis, expires_at)
+        if self.db_path:
+            await asyncio.to_thread(self._disk_set, key, analysis, expires_at)
+
+    def _disk_get(self, key, now):
+        with self._db_lock:
+            return self._connection().execute(
+                "SELECT analysis, expires_at FROM analyses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+
+    def _disk_set(self, key, analysis, expires_at):
+        now = time.time()
+        with self._db_lock, self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, analysis, expires_at) VALUES (?, ?, ?)",
+                (key, analysis, expires_at),
+            )
+            # 期限切れの行は書き込みのたびではなく、purge_interval 秒ごとにまとめて削除する
+            if now - self._purged_at >= self.purge_interval:
+                conn.execute("DELETE FROM analyses WHERE expires_at <= ?", (now,))
+                self._purged_at = now
+
+    def _store(self, key, analysis, expires_at):
+        self._entries[key] = (expires_at, analysis)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get_stats(self):
+        """ヒット・ミス・追い出しの件数を返す"""
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries))
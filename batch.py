@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import re
+import sys
+import zipfile
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# .env ファイルから環境変数を読み込む
+load_dotenv()
+
+from diagnosis import ReceivedPhoto, check_photo, check_photo_bytes, parse_form_row, report_filename, run_diagnosis
+from metrics import observe_timings
+from render_pool import RenderQueueFull, render_pool
+from scoring import cohort_columns, cohort_patient, score_cohort
+from timing import start_timings
+
+# 一括診断で同時に処理する患者数
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# 写真ファイル名に使える部位の表記と、部位名の対応
+VIEW_ALIASES = {
+    "正面観": "正面観", "front": "正面観", "oral_photo_front": "正面観",
+    "上顎咬合面観": "上顎咬合面観", "upper_occlusal": "上顎咬合面観", "oral_photo_upper_occlusal": "上顎咬合面観",
+    "下顎咬合面観": "下顎咬合面観", "lower_occlusal": "下顎咬合面観", "oral_photo_lower_occlusal": "下顎咬合面観",
+    "右側方観": "右側方観", "right_lateral": "右側方観", "oral_photo_right_lateral": "右側方観",
+    "左側方観": "左側方観", "left_lateral": "左側方観", "oral_photo_left_lateral": "左側方観",
+}
+VIEW_ORDER = ["正面観", "上顎咬合面観", "下顎咬合面観", "右側方観", "左側方観"]
+
+# ZIP内のファイル名に使わない文字 (パスの区切り・Windowsで使えない文字・制御文字)
+UNSAFE_NAME_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+def read_rows(data, filename):
+    """CSV または JSONL の患者データを行ごとの辞書のリストとして読み込む"""
+    text = data.decode("utf-8-sig")
+    if filename.lower().endswith((".jsonl", ".ndjson")):
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def patient_key(row):
+    """写真ファイルと患者データを対応付けるキー (patient_id 列があればそれを、なければ患者氏名を使う)"""
+    return str(row.get("patient_id") or row.get("patient_name") or "")
+
+
+def parse_photo_name(name):
+    """
+    写真のパスから (患者キー, 部位名) を取り出す。
+    「<患者キー>/<部位>.jpg」と「<患者キー>_<部位>.jpg」の両方の形式に対応する。
+    """
+    path = Path(name)
+    if path.name.startswith(".") or not path.suffix:
+        return None
+    stem = path.stem
+    if stem in VIEW_ALIASES and len(path.parts) > 1:
+        return path.parts[-2], VIEW_ALIASES[stem]
+    for alias, view_name in VIEW_ALIASES.items():
+        if stem.endswith("_" + alias):
+            return stem[:-len(alias) - 1], view_name
+    return None
+
+
+class PhotoArchive:
+    """ZIPアーカイブまたはディレクトリにある写真を、患者キーごとに必要な分だけ読み出す"""
+
+    def __init__(self, source):
+        self._source = source
+        self._zip = None
+        self._dir = None
+        self._index = {}
+        if isinstance(source, (str, Path)) and Path(source).is_dir():
+            self._dir = Path(source)
+            names = [str(p.relative_to(self._dir)) for p in self._dir.rglob("*") if p.is_file()]
+        else:
+            self._zip = zipfile.ZipFile(source)
+            names = [info.filename for info in self._zip.infolist() if not info.is_dir()]
+        for name in names:
+            parsed = parse_photo_name(name)
+            if parsed:
+                key, view_name = parsed
+                self._index.setdefault(key, {})[view_name] = name
+
+    def photos_for(self, key):
+        """
+        患者キーに対応する写真を [ReceivedPhoto(部位名, ファイル名, バイト列), ...] として返す。
+        /diagnose と同じく、大きすぎる写真は PhotoTooLarge を、画像でないファイルは UnsupportedPhoto を送出する。
+        """
+        photos = []
+        for view_name in VIEW_ORDER:
+            name = self._index.get(key, {}).get(view_name)
+            if name is None:
+                continue
+            # 展開後のサイズが上限を超える写真は読み出さない
+            check_photo_bytes(view_name, self._zip.getinfo(name).file_size if self._zip else (self._dir / name).stat().st_size)
+            data = self._zip.read(name) if self._zip else (self._dir / name).read_bytes()
+            check_photo(view_name, data)
+            photos.append(ReceivedPhoto(view_name, Path(name).name, data))
+        return photos
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            if hasattr(self._source, "close"):
+                self._source.close()
+
+
+class _ZipStream(io.RawIOBase):
+    """書き込まれたZIPのバイト列を溜めておき、少しずつ取り出せるようにする (シーク不可のストリーム)"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def _render(diagnosis_result):
+    # レンダリングが混み合っている間は、エラーにせず空くまで待つ
+    while True:
+        try:
+            return await render_pool.render(diagnosis_result)
+        except RenderQueueFull:
+            await asyncio.sleep(render_pool.retry_after)
+
+
+def archive_name(index, filename):
+    """ZIP内のファイル名。患者氏名に / や .. が含まれていてもフォルダが作られないよう、1つのファイル名にする"""
+    return f"{index:04d}_" + UNSAFE_NAME_CHARS.sub("_", filename)
+
+
+async def diagnose_row(index, key, form, scores, photo_archive, semaphore):
+    """1人分の診断とPDFレンダリングを行い、(ZIP内のファイル名, PDF, マニフェストの項目) を返す"""
+    entry = {"row": index, "patient": key, "status": "error", "file": None, "error": None}
+    async with semaphore:
+        # 行ごとに所要時間を記録する (各行は別のタスクで実行されるため、記録は混ざらない)
+        timings = start_timings()
+        try:
+            # ZIPの展開やファイルの読み込みでイベントループを止めないよう、スレッドで読み出す
+            received_photos = await asyncio.to_thread(photo_archive.photos_for, key) if photo_archive else []
+            diagnosis_result = await run_diagnosis(form, received_photos, scores=scores)
+            pdf_bytes = await _render(diagnosis_result)
+        except Exception as e:
+            print(f"Error during batch diagnosis (row {index}): {e}")
+            entry["error"] = str(e)
+            return None, None, entry
+        finally:
+            observe_timings(timings)
+
+    entry["status"] = "ok"
+    entry["file"] = archive_name(index, report_filename(diagnosis_result))
+    entry["photos"] = len(received_photos)
+    entry["diagnosis_id"] = diagnosis_result.get("diagnosis_id")
+    entry["analysis_errors"] = [
+        a["view"] for a in diagnosis_result["gemini_analyses"] if a["analysis"].startswith("AI画像解析中にエラーが発生しました")
+    ]
+    return entry["file"], pdf_bytes, entry
+
+
+async def stream_batch_zip(rows, photo_archive=None, concurrency=None):
+    """
+    全ての行のスコアを一括で計算してから、写真の解析とPDFレンダリングを並行して行い、
+    完成したPDFから順にZIPに書き込んでバイト列を少しずつ返す。
+    最後に行ごとの結果とエラーをまとめた manifest.json を追加する。
+    """
+    manifest = []
+    valid_rows = []
+    for index, row in enumerate(rows, start=1):
+        try:
+            valid_rows.append((index, patient_key(row), parse_form_row(row)))
+        except ValueError as e:
+            manifest.append({"row": index, "patient": patient_key(row), "status": "error", "file": None, "error": str(e)})
+
+    columns = cohort_columns([form for _, _, form in valid_rows])
+    cohort_scores = score_cohort(columns)
+
+    semaphore = asyncio.Semaphore(max(1, concurrency or BATCH_CONCURRENCY))
+    tasks = [
+        asyncio.create_task(diagnose_row(index, key, form, cohort_patient(columns, cohort_scores, i), photo_archive, semaphore))
+        for i, (index, key, form) in enumerate(valid_rows)
+    ]
+    stream = _ZipStream()
+    try:
+        with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_STORED) as archive:
+            for next_done in asyncio.as_completed(tasks):
+                name, pdf_bytes, entry = await next_done
+                manifest.append(entry)
+                if pdf_bytes is not None:
+                    archive.writestr(name, pdf_bytes)
+                    yield stream.pop()
+
+            manifest.sort(key=lambda e: e["row"])
+            summary = {
+                "total": len(manifest),
+                "succeeded": sum(1 for e in manifest if e["status"] == "ok"),
+                "failed": sum(1 for e in manifest if e["status"] != "ok"),
+                "rows": manifest,
+            }
+            archive.writestr("manifest.json", json.dumps(summary, ensure_ascii=False, indent=2))
+        yield stream.pop()
+    finally:
+        # クライアントが切断した場合などは、残りの処理を取り消す
+        for task in tasks:
+            task.cancel()
+        if photo_archive is not None:
+            photo_archive.close()
+
+
+async def run_batch(rows_path, output_path, photos_path=None, concurrency=None):
+    """コマンドラインから一括診断を実行し、ZIPファイルに書き出す"""
+    rows = read_rows(Path(rows_path).read_bytes(), str(rows_path))
+    photo_archive = PhotoArchive(photos_path) if photos_path else None
+    try:
+        with open(output_path, "wb") as output:
+            async for chunk in stream_batch_zip(rows, photo_archive, concurrency):
+                output.write(chunk)
+    finally:
+        render_pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="患者データ (CSV/JSONL) から診断レポートを一括で作成し、ZIPにまとめる")
+    parser.add_argument("rows", help="患者データのCSVまたはJSONLファイル (列は /diagnose のフォーム項目と同じ)")
+    parser.add_argument("-p", "--photos", help="写真のZIPアーカイブまたはディレクトリ (<患者キー>_<部位>.jpg)")
+    parser.add_argument("-o", "--output", default="diagnosis_reports.zip", help="出力するZIPファイル")
+    parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY, help="同時に処理する患者数")
+    args = parser.parse_args()
+    asyncio.run(run_batch(args.rows, args.output, args.photos, args.concurrency))
+    print(f"診断レポートを {args.output} に書き出しました。", file=sys.stderr)
@@ -0,0 +1,82 @@
+"""
+写真ごとの解析 (ANALYSIS_MODE=per_view) と、全ての写真を1回で解析する combined を比較する。
+診断1回 (5部位) あたりのレイテンシ、入力・出力のトークン数、PDF作成時のMarkdown変換の時間を表示する。
+既定の fake ではトークン数は概算で、レイテンシは呼び出し回数の違いしか表さない。
+--backend gemini で実際のAPIを呼び出すと実測できる (GEMINI_API_KEY が必要で、利用料がかかる)。
+
+    python benchmarks/bench_analysis_mode.py [-n 5] [--backend fake|gemini]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from synthetic import PHOTO_SIZES, VIEW_FIELDS, synthetic_photo
+
+MODES = ["per_view", "combined"]
+
+
+def photo_sets(count):
+    """規格化済みの5部位分の写真を count 組作成する (キャッシュに当たらないよう組ごとに変える)"""
+    from analysis import VIEW_KEYS
+    from image_ingest import normalize_image
+
+    sets = []
+    for seed in range(count):
+        photos = []
+        for i, (view, field) in enumerate(zip(VIEW_KEYS, VIEW_FIELDS)):
+            data = normalize_image(synthetic_photo(*PHOTO_SIZES["small"], seed=seed * len(VIEW_FIELDS) + i))[0]
+            photos.append({"view": view, "path": f"{field}.jpg", "data": data, "mime_type": "image/jpeg"})
+        sets.append(photos)
+    return sets
+
+
+def tokens():
+    from prometheus_client import REGISTRY
+    return [REGISTRY.get_sample_value("gemini_tokens_total", {"kind": kind}) or 0 for kind in ("prompt", "output")]
+
+
+def run_mode(mode, sets):
+    """mode で全ての組を順に解析し、(レイテンシのリスト, 1組あたりの入力トークン, 出力トークン, Markdown変換のミリ秒) を返す"""
+    import analysis
+    from bench_report import SAMPLE_RESULT
+    from report import render_report_pdf_timed
+
+    analysis.ANALYSIS_MODE = mode
+    latencies = []
+    markdown_ms = []
+    before = tokens()
+    for photos in sets:
+        start = time.perf_counter()
+        gemini_analyses, _ = asyncio.run(analysis.analyze_photos(photos))
+        latencies.append(time.perf_counter() - start)
+        _, spans = render_report_pdf_timed(dict(SAMPLE_RESULT, gemini_analyses=gemini_analyses))
+        markdown_ms.append(sum(seconds for name, seconds in spans if name == "markdown") * 1000)
+    prompt_tokens, output_tokens = (after - b for after, b in zip(tokens(), before))
+    return latencies, prompt_tokens / len(sets), output_tokens / len(sets), statistics.median(markdown_ms)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--diagnoses", type=int, default=5, help="モードごとの診断回数")
+    parser.add_argument("--backend", choices=["fake", "gemini"], default="fake")
+    args = parser.parse_args()
+
+    # analysis は読み込み時に設定を読むため、読み込む前に設定する
+    os.environ.update(ANALYSIS_BACKEND=args.backend, ANALYSIS_CACHE_SIZE="0", ANALYSIS_CACHE_PATH="")
+
+    sets = photo_sets(args.diagnoses)
+    # ライブラリの読み込みを最初のモードの計測に含めない
+    from analysis import gemini
+    gemini()
+    for mode in MODES:
+        latencies, prompt_tokens, output_tokens, markdown_ms = run_mode(mode, sets)
+        print(
+            f"{mode:<9} レイテンシ p50 {statistics.median(latencies):6.2f}s 最大 {max(latencies):6.2f}s  "
+            f"トークン 入力 {prompt_tokens:7.0f} 出力 {output_tokens:6.0f} (診断1回あたり)  Markdown変換 {markdown_ms:6.2f} ms"
+        )
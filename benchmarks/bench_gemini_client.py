@@ -0,0 +1,92 @@
+"""
+gemini_client.py の再試行・呼び出し回数の制限・ヘッジの効果を、fake_gemini_server.py に対して計測する。
+シナリオごとにサーバーの振る舞い (429 の割合、クォータ、遅い応答の割合) とクライアントの設定を変えて写真を解析し、
+成功率、レイテンシ (p50/p95/最大)、サーバーが返した応答の種類ごとの件数を表示する。
+
+    python benchmarks/bench_gemini_client.py [-n 40] [-c 10]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+PORT = 8092
+# analysis と gemini_client は読み込み時に設定を読むため、先に設定しておく
+os.environ.update(
+    GEMINI_API_ENDPOINT=f"http://127.0.0.1:{PORT}",
+    GEMINI_API_KEY=os.getenv("GEMINI_API_KEY", "fake"),
+    ANALYSIS_BACKEND="gemini",
+    ANALYSIS_CACHE_SIZE="0",
+    ANALYSIS_CACHE_PATH="",
+    ANALYSIS_TIMEOUT="30",
+)
+
+import analysis  # noqa: E402
+import fake_gemini_server  # noqa: E402
+from gemini_client import CircuitBreaker, GeminiClient, TokenBucket  # noqa: E402
+
+QUOTA = {"quota": 20, "quota_window": 5, "retry_after": 2}
+
+# (名前, サーバーの設定, GeminiClient の引数)
+SCENARIOS = [
+    ("429 20% / 再試行なし", {"rate_limit_rate": 0.2}, {"max_retries": 0}),
+    ("429 20% / 再試行あり", {"rate_limit_rate": 0.2}, {}),
+    # クォータは5秒あたり20回 (240rpm)
+    ("クォータ 240rpm / 制限なし", QUOTA, {"max_retries": 0}),
+    ("クォータ 240rpm / 制限なし・再試行あり", QUOTA, {}),
+    ("クォータ 240rpm / 220rpm に制限", QUOTA, {"bucket": TokenBucket(220 / 60, 5)}),
+    ("遅い応答 10% / ヘッジなし", {"slow_rate": 0.1, "slow_latency": 8}, {}),
+    ("遅い応答 10% / 1.5秒でヘッジ", {"slow_rate": 0.1, "slow_latency": 8}, {"hedge_delay": 1.5}),
+]
+
+
+async def run_scenario(requests, concurrency, client_args):
+    analysis.gemini_client = GeminiClient(breaker=CircuitBreaker(0, 0), **client_args)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(i):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await analysis.analyze_view("正面観", i.to_bytes(4, "big"), "image/jpeg", asyncio.Semaphore(1))
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--requests", type=int, default=40, help="シナリオごとの解析回数")
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.5, help="通常の応答時間（秒）")
+    args = parser.parse_args()
+
+    server = fake_gemini_server.serve(PORT)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state = server.RequestHandlerClass.state
+
+    for name, server_config, client_args in SCENARIOS:
+        state.config = dict(fake_gemini_server.DEFAULT_CONFIG, latency=args.latency, jitter=0.1, **server_config)
+        state.stats.clear()
+        state._recent.clear()
+        latencies, failures = asyncio.run(run_scenario(args.requests, args.concurrency, client_args))
+        latencies.sort()
+        p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+        print(
+            f"{name:<34} 成功 {args.requests - failures:3d}/{args.requests}  "
+            f"p50 {statistics.median(latencies):5.2f}s  p95 {p95:5.2f}s  最大 {latencies[-1]:5.2f}s  "
+            f"サーバー {dict(state.stats)}"
+        )
+    server.shutdown()
@@ -0,0 +1,153 @@
+"""
+スコア計算・画像の規格化・PDFの各ページの描画を個別に計測するマイクロベンチマーク。
+--save で結果を保存しておき、変更後に --compare で比較すると、遅くなった処理を検出できる。
+
+    python benchmarks/bench_micro.py [-n 回数] [--save baseline.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import io
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+from starlette.datastructures import Headers
+from starlette.formparsers import MultiPartParser
+
+from bench_report import SAMPLE_RESULT
+from image_ingest import normalize_image
+from multipart_ingest import PhotoFormParser
+from report import create_counseling_report_page, create_summary_page, render_report_pdf
+from scoring import cohort_columns, score_cohort, score_patient
+from synthetic import PHOTO_SIZES, SAMPLE_FORM, VIEW_FIELDS, synthetic_form, synthetic_photo, synthetic_photo_set
+
+# 一括計算のベンチマークで使う患者数
+COHORT_SIZE = 1000
+
+
+def bench(func, iterations):
+    """func を iterations 回実行し、1回あたりの経過時間 (ミリ秒) の中央値を返す"""
+    func()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def multipart_body(photos):
+    """フォームと写真の multipart/form-data の本文と、そのヘッダーを返す"""
+    request = httpx.Request(
+        "POST", "http://localhost/diagnose",
+        data={name: str(value) for name, value in SAMPLE_FORM.items()},
+        files=[(field, (f"{field}.jpg", data, "image/jpeg")) for field, data in photos.items()],
+    )
+    return request.read(), Headers(headers=dict(request.headers))
+
+
+def parse_multipart(parser_class, body, headers):
+    """本文を64KBずつ (uvicorn が渡す大きさ) 解析し、写真を全て読み出す"""
+    async def stream():
+        for i in range(0, len(body), 65536):
+            yield body[i:i + 65536]
+
+    async def parse():
+        if parser_class is PhotoFormParser:
+            form = await PhotoFormParser(headers).parse(stream())
+        else:
+            form = await MultiPartParser(headers, stream()).parse()
+        for _, value in form.multi_items():
+            if not isinstance(value, str):
+                getattr(value, "data", None) or await value.read()
+                await value.close()
+
+    asyncio.run(parse())
+
+
+def draw_page(builder, *args):
+    c = canvas.Canvas(io.BytesIO(), pagesize=letter)
+    builder(c, *args)
+
+
+def benchmarks(photo_dir):
+    """ベンチマーク名と、計測する処理の組を返す"""
+    cohort = [synthetic_form(seed) for seed in range(COHORT_SIZE)]
+    phone_photo = synthetic_photo(*PHOTO_SIZES["phone"])
+    dslr_photo = synthetic_photo(*PHOTO_SIZES["dslr"], orientation=6)
+
+    # カウンセリングレポートには規格化済みの写真を載せる
+    photo_path = Path(photo_dir, "front.jpg")
+    photo_path.write_bytes(normalize_image(phone_photo)[0])
+    result = dict(SAMPLE_RESULT, photo_paths=[{"view": "正面観", "path": str(photo_path)}])
+
+    # 5部位の写真を載せたレポート全体 (写真のギャラリーを含む)
+    photo_set = synthetic_photo_set("phone")
+    all_photo_paths = []
+    for analysis, field in zip(SAMPLE_RESULT["gemini_analyses"], VIEW_FIELDS):
+        path = Path(photo_dir, f"{field}.jpg")
+        path.write_bytes(normalize_image(photo_set[field])[0])
+        all_photo_paths.append({"view": analysis["view"], "path": str(path)})
+    full_result = dict(SAMPLE_RESULT, photo_paths=all_photo_paths)
+
+    # 縮小せずに送られた5部位の写真を含むフォーム
+    body, headers = multipart_body(photo_set)
+
+    return {
+        "scoring.score_patient": lambda: score_patient(SAMPLE_FORM),
+        f"scoring.score_cohort_{COHORT_SIZE}": lambda: score_cohort(cohort_columns(cohort)),
+        "ingest.normalize_phone_12mp": lambda: normalize_image(phone_photo),
+        "ingest.normalize_dslr_24mp": lambda: normalize_image(dslr_photo),
+        "ingest.multipart_starlette_5_photos": lambda: parse_multipart(MultiPartParser, body, headers),
+        "ingest.multipart_stream_5_photos": lambda: parse_multipart(PhotoFormParser, body, headers),
+        "report.summary_page": lambda: draw_page(create_summary_page, result),
+        "report.counseling_page": lambda: draw_page(
+            create_counseling_report_page, result, result["photo_paths"], result["gemini_analyses"]
+        ),
+        "report.pdf_5_photos": lambda: render_report_pdf(full_result),
+    }
+
+
+def compare(results, baseline, threshold):
+    """基準値より threshold 倍以上遅くなったベンチマークの名前を返す"""
+    regressions = []
+    for name, ms in results.items():
+        if name not in baseline:
+            continue
+        ratio = ms / baseline[name]
+        flag = " <- 遅くなっています" if ratio >= threshold else ""
+        print(f"  {name:<32} {baseline[name]:9.3f} ms -> {ms:9.3f} ms ({ratio:.2f}倍){flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("--save", help="結果をJSONで保存するファイル")
+    parser.add_argument("--compare", help="比較する基準値のJSONファイル (--save で保存したもの)")
+    parser.add_argument("--threshold", type=float, default=1.25, help="遅くなったとみなす倍率")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as photo_dir:
+        for name, func in benchmarks(photo_dir).items():
+            results[name] = bench(func, args.iterations)
+            print(f"{name:<34} {results[name]:9.3f} ms (中央値, {args.iterations}回)")
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+    if args.compare:
+        print(f"{args.compare} との比較:")
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.threshold)
+        if regressions:
+            sys.exit(1)
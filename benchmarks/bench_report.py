@@ -0,0 +1,60 @@
+"""
+PDFレポート1件あたりのCPU時間を計測するマイクロベンチマーク。
+スタイルと固定の段落を毎回作り直す場合 (キャッシュなし) と、
+プロセス内で使い回す場合 (キャッシュあり) を比較する。
+
+    python benchmarks/bench_report.py [-n 回数]
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from report import clear_report_template_cache, render_report_pdf
+
+SAMPLE_RESULT = {
+    "patient_info": {"name": "山田太郎", "age": 7},
+    "analysis_summary": {
+        "risk_level": "高リスク",
+        "appliance_suggestion": "T4K",
+        "mfs_score": 3,
+        "das_score": 7,
+        "mfs_yes_items": ["口呼吸", "舌癖", "いびき"],
+        "das_items": ["上顎の叢生", "下顎の空隙歯列", "正中線のずれ (1.5mm)", "交叉咬合"],
+        "comments": ["MFSスコア: 3/9", "DASスコア: 7/9"],
+    },
+    "other_findings": "特になし",
+    "gemini_analyses": [
+        {"view": view, "analysis": "- **歯列**: 軽度の叢生が見られます。\n- **歯肉**: 炎症所見はありません。"}
+        for view in ["正面観", "上顎咬合面観", "下顎咬合面観", "右側方観", "左側方観"]
+    ],
+    "photo_paths": [],
+}
+
+
+def measure(iterations, cached):
+    """レポートを iterations 回レンダリングし、1件あたりのCPU時間 (ミリ秒) のリストを返す"""
+    timings = []
+    for _ in range(iterations):
+        if not cached:
+            clear_report_template_cache()
+        start = time.process_time()
+        render_report_pdf(SAMPLE_RESULT)
+        timings.append((time.process_time() - start) * 1000)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    # 初回のフォント読み込みなどを計測から除く
+    render_report_pdf(SAMPLE_RESULT)
+
+    for label, cached in (("キャッシュなし", False), ("キャッシュあり", True)):
+        timings = measure(args.iterations, cached)
+        print(f"{label}: 平均 {statistics.mean(timings):.2f} ms / 中央値 {statistics.median(timings):.2f} ms (CPU時間, {args.iterations}回)")
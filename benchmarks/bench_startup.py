@@ -0,0 +1,116 @@
+"""
+起動時間とワーカーごとのメモリ使用量を計測する。
+--imports では main.py の読み込みにかかる時間をモジュールごとに表示する (python -X importtime を集計)。
+それ以外では Procfile と同じ構成のサーバーを preload なし・あり (GUNICORN_PRELOAD=1) で起動し、
+リクエストを受け付けるまでの時間と、数件処理した後のプロセスごとの RSS / PSS を比較する。
+PSS は共有しているページをプロセス数で割った値で、コピーオンライトによる共有の効果が表れる。
+
+    python benchmarks/bench_startup.py [--imports] [-n 8]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from load_test import BASE_DIR, drive, start_server, wait_until_ready
+from synthetic import synthetic_photo_set
+
+
+def import_times(top=15):
+    """main を読み込む子プロセスを -X importtime 付きで実行し、(合計秒, [(モジュール名, 秒), ...]) を返す"""
+    start = time.perf_counter()
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BASE_DIR, capture_output=True, text=True, check=True,
+    ).stderr
+    elapsed = time.perf_counter() - start
+
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # main から直接読み込まれたモジュール (字下げが1段のもの)
+        if name.startswith("   ") and not name.startswith("    "):
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    modules.sort(key=lambda m: m[1], reverse=True)
+    return elapsed, modules[:top]
+
+
+def memory(pid):
+    """プロセスの (RSS, PSS) をバイトで返す"""
+    values = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+        key, _, rest = line.partition(":")
+        if key in ("Rss", "Pss"):
+            values[key] = int(rest.split()[0]) * 1024
+    return values.get("Rss", 0), values.get("Pss", 0)
+
+
+def child_pids(pid):
+    children = []
+    for task in Path(f"/proc/{pid}/task").iterdir():
+        children += [int(p) for p in (task / "children").read_text().split()]
+    return children
+
+
+def process_memory(master_pid):
+    """
+    {役割: [(RSS, PSS), ...]} を返す。
+    renderer はワーカーの子プロセス (PDFレンダリング用のプロセスと multiprocessing の resource_tracker)
+    """
+    roles = {"master": [memory(master_pid)], "worker": [], "renderer": []}
+    for worker in child_pids(master_pid):
+        roles["worker"].append(memory(worker))
+        for renderer in child_pids(worker):
+            roles["renderer"].append(memory(renderer))
+    return roles
+
+
+def measure_server(preload, requests, photos, port):
+    """サーバーを起動し、(起動までの秒数, process_memory の結果) を返す"""
+    start = time.perf_counter()
+    server = start_server(port, 0.1, 0.0, 0.0, extra_env={"GUNICORN_PRELOAD": "1" if preload else "0"})
+    url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(url, server)
+        ready = time.perf_counter() - start
+        # 初回のリクエストまで読み込みを遅らせているものも含めて比較するため、数件処理させる
+        asyncio.run(drive(url, requests, 4, photos, warmup=0))
+        return ready, process_memory(server.pid)
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--imports", action="store_true", help="main.py の読み込み時間の内訳だけを表示する")
+    parser.add_argument("-n", "--requests", type=int, default=8, help="メモリを計測する前に処理させるリクエスト数")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    elapsed, modules = import_times()
+    print(f"main の読み込み: {elapsed:.2f} 秒 (インタプリタの起動を含む)")
+    for name, seconds in modules:
+        print(f"  {name:<24} {seconds * 1000:8.1f} ms")
+    if args.imports:
+        sys.exit(0)
+
+    photos = synthetic_photo_set("small")
+    for preload in (False, True):
+        ready, roles = measure_server(preload, args.requests, photos, args.port)
+        print(f"\npreload {'あり' if preload else 'なし'}: 起動から {ready:.2f} 秒でリクエストを受け付け")
+        total_pss = 0
+        for role, values in roles.items():
+            if not values:
+                continue
+            rss = sum(v[0] for v in values) / len(values)
+            pss = sum(v[1] for v in values)
+            total_pss += pss
+            print(f"  {role:<9} {len(values)}個  RSS 平均 {rss / 1024 ** 2:6.0f} MiB  PSS 合計 {pss / 1024 ** 2:6.0f} MiB")
+        print(f"  PSS 全体 {total_pss / 1024 ** 2:.0f} MiB")
@@ -0,0 +1,304 @@
+"""
+/diagnose の負荷試験。Procfile と同じ gunicorn/uvicorn の構成でサーバーを起動し (Geminiは fake_gemini を使う)、
+指定した並列数でリクエストを送って、レイテンシ (p50/p95/p99)、スループット、ピークRSS、PDFサイズを表示する。
+
+    python benchmarks/load_test.py [-n 100] [-c 8] [--latency 2.0] [--jitter 0.5] [--error-rate 0]
+    python benchmarks/load_test.py --url http://127.0.0.1:8000   # 起動済みのサーバーに対して実行 (RSSは計測しない)
+    python benchmarks/load_test.py --storm 20   # 同じ内容のリクエストを20件同時に送り、解析が1回にまとめられるか確かめる
+
+通常の計測は同じ写真を繰り返し送るため、同じ入力の診断をまとめる処理 (SINGLE_FLIGHT) を無効にして起動する。
+"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from synthetic import PHOTO_SIZES, SAMPLE_FORM, synthetic_photo_set
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def procfile_command():
+    """Procfile の web プロセスのコマンドを引数のリストとして返す"""
+    for line in (BASE_DIR / "Procfile").read_text().splitlines():
+        if line.startswith("web:"):
+            return shlex.split(line[len("web:"):])
+    raise RuntimeError("Procfile に web プロセスがありません")
+
+
+def start_server(port, latency, jitter, error_rate, extra_env=None):
+    """Procfile のコマンドに待ち受けアドレスだけを加えてサーバーを起動する"""
+    env = dict(
+        os.environ,
+        ANALYSIS_BACKEND="fake",
+        FAKE_GEMINI_LATENCY=str(latency),
+        FAKE_GEMINI_JITTER=str(jitter),
+        FAKE_GEMINI_ERROR_RATE=str(error_rate),
+        # 同じ写真を繰り返し送るため、解析結果のキャッシュは無効にする
+        ANALYSIS_CACHE_SIZE="0",
+        ANALYSIS_CACHE_PATH="",
+        SINGLE_FLIGHT="off",
+    )
+    env.update(extra_env or {})
+    command = procfile_command() + ["-b", f"127.0.0.1:{port}"]
+    return subprocess.Popen(command, cwd=BASE_DIR, env=env, start_new_session=True)
+
+
+def wait_until_ready(url, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"サーバーが起動に失敗しました (終了コード {server.returncode})")
+        try:
+            if httpx.get(url + "/", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("サーバーの起動がタイムアウトしました")
+
+
+def process_tree_rss(root_pid):
+    """root_pid とその子孫プロセス (gunicornのワーカーとPDFレンダリング用のプロセス) のRSSの合計 (バイト)"""
+    children = {}
+    rss = {}
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            stat = stat_path.read_text()
+            status = (stat_path.parent / "status").read_text()
+        except OSError:
+            continue
+        pid = int(stat_path.parent.name)
+        # comm に空白や括弧が含まれる場合があるため、最後の ")" より後ろを分割する
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(pid)
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                rss[pid] = int(line.split()[1]) * 1024
+    total = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total
+
+
+class RSSSampler(threading.Thread):
+    """一定間隔でプロセスツリーのRSSを計測し、最大値を記録する"""
+
+    def __init__(self, root_pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.root_pid))
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def parse_server_timing(header):
+    """Server-Timing ヘッダーを {段階名: ミリ秒} に変換する"""
+    spans = {}
+    for item in filter(None, (part.strip() for part in header.split(","))):
+        name, _, params = item.partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                spans[name] = float(value)
+    return spans
+
+
+async def drive(url, requests, concurrency, photos, warmup):
+    """/diagnose に requests 件のリクエストを concurrency 並列で送り、1件ごとの結果を返す"""
+    files = [(field, (f"{field}.jpg", data, "image/jpeg")) for field, data in photos.items()]
+    data = {name: str(value) for name, value in SAMPLE_FORM.items()}
+    results = []
+
+    async with httpx.AsyncClient(base_url=url, timeout=300) as client:
+        async def send():
+            start = time.perf_counter()
+            try:
+                response = await client.post("/diagnose", data=data, files=files)
+            except httpx.HTTPError as e:
+                return {"status": None, "error": str(e), "seconds": time.perf_counter() - start}
+            return {
+                "status": response.status_code,
+                "seconds": time.perf_counter() - start,
+                "pdf_bytes": len(response.content) if response.status_code == 200 else 0,
+                "server_timing": parse_server_timing(response.headers.get("server-timing", "")),
+            }
+
+        # 各ワーカーのレンダリング用プロセスや接続の準備を計測から除く
+        await asyncio.gather(*(send() for _ in range(warmup)))
+
+        queue = asyncio.Queue()
+        for _ in range(requests):
+            queue.put_nowait(None)
+
+        async def worker():
+            while not queue.empty():
+                queue.get_nowait()
+                results.append(await send())
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def metric_values(url):
+    """/metrics から {(名前, ラベル): 値} を取得する (gunicorn.conf.py で起動していれば全ワーカーの合計)"""
+    values = {}
+    for family in text_string_to_metric_families(httpx.get(url + "/metrics", timeout=10).text):
+        for sample in family.samples:
+            values[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+    return values
+
+
+async def storm(url, requests, photos):
+    """
+    同じフォームと写真のリクエストを requests 件同時に送る (二度押しや再送の集中を再現する)。
+    写真の解析が何回実行されたかを /metrics の段階ごとの件数から数えて返す。
+    """
+    files = [(field, (f"{field}.jpg", data, "image/jpeg")) for field, data in photos.items()]
+    # 以前の実行の結果を共有しないよう、実行ごとに患者氏名を変える
+    data = {name: str(value) for name, value in SAMPLE_FORM.items()}
+    data["patient_name"] += f" {time.time_ns()}"
+
+    before = metric_values(url)
+    async with httpx.AsyncClient(base_url=url, timeout=300) as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *(client.post("/diagnose", data=data, files=files) for _ in range(requests)), return_exceptions=True
+        )
+        elapsed = time.perf_counter() - start
+    after = metric_values(url)
+
+    def delta(name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return after.get(key, 0) - before.get(key, 0)
+
+    statuses = [r.status_code if isinstance(r, httpx.Response) else None for r in responses]
+    return {
+        "requests": requests,
+        "statuses": {str(status): statuses.count(status) for status in set(statuses)},
+        "diagnosis_ids": len({r.headers.get("x-diagnosis-id") for r in responses if isinstance(r, httpx.Response) and r.status_code == 200}),
+        "elapsed_seconds": elapsed,
+        "analysis_fanouts": delta("diagnosis_stage_seconds_count", stage="analysis"),
+        "single_flight": {role: delta("diagnosis_single_flight_total", role=role) for role in ("leader", "follower", "fallback")},
+    }
+
+
+def print_storm(summary):
+    print(f"リクエスト: {summary['requests']}件 {summary['statuses']} ({summary['elapsed_seconds']:.1f} 秒)")
+    print(f"写真の解析の実行回数: {summary['analysis_fanouts']:.0f} / 診断ID: {summary['diagnosis_ids']}種類")
+    print(f"まとめ: {summary['single_flight']}")
+
+
+def summarize(results, elapsed, peak_rss):
+    ok = [r for r in results if r["status"] == 200]
+    latencies = sorted(r["seconds"] for r in ok)
+    summary = {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "statuses": {str(status): sum(1 for r in results if r["status"] == status) for status in {r["status"] for r in results}},
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(ok) / elapsed if elapsed else 0.0,
+        "peak_rss_bytes": peak_rss,
+    }
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        summary.update(p50=percentiles[49], p95=percentiles[94], p99=percentiles[98], max=latencies[-1])
+    if ok:
+        pdf_sizes = [r["pdf_bytes"] for r in ok]
+        summary.update(pdf_bytes_mean=statistics.mean(pdf_sizes), pdf_bytes_max=max(pdf_sizes))
+        stages = {}
+        for r in ok:
+            for name, ms in r["server_timing"].items():
+                stages.setdefault(name, []).append(ms)
+        summary["stages_ms_mean"] = {name: statistics.mean(values) for name, values in stages.items()}
+    return summary
+
+
+def print_summary(summary):
+    print(f"リクエスト: {summary['requests']}件 (成功 {summary['succeeded']} / 失敗 {summary['failed']}) {summary['statuses']}")
+    print(f"スループット: {summary['requests_per_second']:.2f} req/s ({summary['elapsed_seconds']:.1f} 秒)")
+    if "p50" in summary:
+        print(f"レイテンシ: p50 {summary['p50']:.2f} s / p95 {summary['p95']:.2f} s / p99 {summary['p99']:.2f} s / 最大 {summary['max']:.2f} s")
+    if summary["peak_rss_bytes"]:
+        print(f"ピークRSS (全プロセスの合計): {summary['peak_rss_bytes'] / 1024 ** 2:.0f} MiB")
+    if "pdf_bytes_mean" in summary:
+        print(f"PDFサイズ: 平均 {summary['pdf_bytes_mean'] / 1024:.0f} KiB / 最大 {summary['pdf_bytes_max'] / 1024:.0f} KiB")
+        print("段階ごとの平均 (Server-Timing):")
+        for name, ms in summary["stages_ms_mean"].items():
+            print(f"  {name:<28} {ms:9.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--requests", type=int, default=100, help="計測するリクエスト数")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="同時に送るリクエスト数")
+    parser.add_argument("--warmup", type=int, default=4, help="計測前に送るリクエスト数")
+    parser.add_argument("--size", default="phone", choices=list(PHOTO_SIZES), help="合成写真の解像度")
+    parser.add_argument("--latency", type=float, default=2.0, help="偽のGeminiの平均応答時間（秒）")
+    parser.add_argument("--jitter", type=float, default=0.5, help="偽のGeminiの応答時間のばらつき（±秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="偽のGeminiが失敗する割合")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="起動済みのサーバーのURL (指定するとサーバーを起動しない)")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    parser.add_argument("--storm", type=int, help="同じ内容のリクエストをこの件数だけ同時に送り、まとめられるか確かめる")
+    args = parser.parse_args()
+
+    photos = synthetic_photo_set(args.size)
+    server = None
+    url = args.url
+    if url is None:
+        url = f"http://127.0.0.1:{args.port}"
+        server = start_server(
+            args.port, args.latency, args.jitter, args.error_rate, {"SINGLE_FLIGHT": "sqlite"} if args.storm else None
+        )
+    sampler = None
+    try:
+        wait_until_ready(url, server)
+        if server is not None and Path("/proc").is_dir():
+            sampler = RSSSampler(server.pid)
+            sampler.start()
+        if args.storm:
+            summary = asyncio.run(storm(url, args.storm, photos))
+        else:
+            results, elapsed = asyncio.run(drive(url, args.requests, args.concurrency, photos, args.warmup))
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait(timeout=30)
+
+    if args.storm:
+        print_storm(summary)
+    else:
+        summary = summarize(results, elapsed, sampler.peak if sampler else 0)
+        print_summary(summary)
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, ensure_ascii=False, indent=2))
+        print(f"結果を {args.json} に保存しました。", file=sys.stderr)
@@ -0,0 +1,116 @@
+"""
+ベンチマーク用の合成データ (診断フォームの入力と、口腔内写真の代わりになる画像) を作成する。
+写真はスマートフォンやデジタル一眼レフで撮影したものと同じ解像度・JPEG画質・EXIFの向きを持たせる。
+
+    python benchmarks/synthetic.py -o photos/ [--size 4032x3024]
+"""
+import argparse
+import io
+import random
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# よく使われるカメラの解像度 (横, 縦)
+PHOTO_SIZES = {
+    "phone": (4032, 3024),   # 12MP スマートフォン
+    "dslr": (6000, 4000),    # 24MP デジタル一眼レフ
+    "small": (1600, 1200),   # 規格化後と同程度
+}
+
+# 口腔内写真のフォーム項目名
+VIEW_FIELDS = [
+    "oral_photo_front",
+    "oral_photo_upper_occlusal",
+    "oral_photo_lower_occlusal",
+    "oral_photo_right_lateral",
+    "oral_photo_left_lateral",
+]
+
+# /diagnose に送信するフォームの入力例
+SAMPLE_FORM = {
+    "patient_name": "山田太郎", "patient_age": 7, "birth_date": "2018-04-01", "gender": "male",
+    "guardian_name": "山田花子", "phone_number": "090-0000-0000", "email": "sample@example.com",
+    "chief_complaint": "歯並びが気になる", "medical_history": "特になし",
+    "mouth_breathing": "yes", "thumb_sucking": "no", "nail_biting": "yes", "tongue_thrust": "yes",
+    "snoring": "no", "tonsil_swelling": "no", "allergic_rhinitis": "yes", "eating_sounds": "no",
+    "swallowing_pattern": "no",
+    "upper_jaw_condition": "crowding", "lower_jaw_condition": "spacing", "midline_deviation": 1.5,
+    "crossbite": "yes", "tongue_position": "low", "lip_closure": "impossible", "facial_appearance": "normal",
+    "tmd_symptoms": "no", "other_findings": "特になし",
+}
+
+# 選択肢のある項目と、その選択肢 (synthetic_form で使う)
+FORM_CHOICES = {
+    **{field: ["yes", "no"] for field in [
+        "mouth_breathing", "thumb_sucking", "nail_biting", "tongue_thrust", "snoring",
+        "tonsil_swelling", "allergic_rhinitis", "eating_sounds", "swallowing_pattern", "crossbite", "tmd_symptoms",
+    ]},
+    "upper_jaw_condition": ["normal", "crowding", "spacing"],
+    "lower_jaw_condition": ["normal", "crowding", "spacing"],
+    "tongue_position": ["normal", "low"],
+    "lip_closure": ["possible", "impossible"],
+    "facial_appearance": ["normal", "adenoid"],
+}
+
+
+def synthetic_form(seed):
+    """SAMPLE_FORM の選択項目・年齢・正中線のずれを乱数で変えたフォームを返す (スコアが患者ごとに異なる)"""
+    rng = random.Random(seed)
+    form = dict(SAMPLE_FORM, patient_name=f"患者{seed:05d}", patient_age=rng.randint(3, 15))
+    form["midline_deviation"] = round(rng.uniform(0, 3), 1)
+    for field, choices in FORM_CHOICES.items():
+        form[field] = rng.choice(choices)
+    return form
+
+
+def synthetic_photo(width, height, seed=0, quality=92, orientation=1):
+    """
+    歯と歯肉に近い色のグラデーションにノイズを加えたJPEGを返す。
+    一様な画像より実際の写真に近い圧縮率とデコード時間になる。
+    """
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :]
+    # 中央が明るい (歯)、周囲が赤い (歯肉・口唇) 画像
+    center = np.exp(-(((x - 0.5) / 0.3) ** 2 + ((y - 0.5) / 0.25) ** 2))
+    pixels = np.empty((height, width, 3), dtype=np.float32)
+    pixels[..., 0] = 170 + 70 * center
+    pixels[..., 1] = 80 + 150 * center
+    pixels[..., 2] = 80 + 140 * center
+    pixels += rng.normal(0, 6, size=(height, width, 1)).astype(np.float32)
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def synthetic_photo_set(size="phone", seed=0):
+    """5部位分の写真を {フォーム項目名: JPEGのバイト列} として返す (縦向きの写真も含める)"""
+    width, height = PHOTO_SIZES[size]
+    photos = {}
+    for i, field in enumerate(VIEW_FIELDS):
+        # 咬合面観は縦向きで撮影され、EXIFで回転されていることが多い
+        orientation = 6 if "occlusal" in field else 1
+        photos[field] = synthetic_photo(width, height, seed=seed + i, orientation=orientation)
+    return photos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-o", "--output", default="synthetic_photos", help="出力先のディレクトリ")
+    parser.add_argument("--size", default="phone", help=f"{', '.join(PHOTO_SIZES)} または 幅x高さ")
+    args = parser.parse_args()
+
+    if args.size not in PHOTO_SIZES:
+        PHOTO_SIZES[args.size] = tuple(int(v) for v in args.size.lower().split("x"))
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    for field, data in synthetic_photo_set(args.size).items():
+        path = output / f"{field}.jpg"
+        path.write_bytes(data)
+        print(f"{path}: {len(data)} bytes")
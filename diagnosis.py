@@ -0,0 +1,378 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import mimetypes
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from fastapi import UploadFile, File, Form
+from PIL import Image
+
+from analysis import analyze_photos
+from diagnosis_store import diagnosis_store
+from scoring import score_patient
+from single_flight import request_key, single_flight
+from image_ingest import (
+    IMAGE_EXTENSIONS, IMAGE_FORMAT, IMAGE_MAX_PIXELS, IMAGE_MAX_UPLOAD_BYTES, IMAGE_MIME_TYPES, image_size, normalize_image,
+    IMAGE_SNIFF_BYTES, sniff_image_format,
+)
+from metrics import IMAGE_BYTES
+from storage import store_photo
+from timing import mark, span
+
+
+def diagnosis_form(
+    # 患者基本情報
+    patient_name: str = Form(...),
+    patient_age: int = Form(...),
+    birth_date: str = Form(...),
+    gender: str = Form(...),
+    guardian_name: str = Form(...),
+    phone_number: str = Form(...),
+    email: str = Form(...),
+    chief_complaint: str = Form(...),
+    medical_history: str = Form(...),
+
+    # 問診項目
+    mouth_breathing: str = Form(...),
+    thumb_sucking: str = Form(...),
+    nail_biting: str = Form(...),
+    tongue_thrust: str = Form(...),
+    snoring: str = Form(...),
+    tonsil_swelling: str = Form(...),
+    allergic_rhinitis: str = Form(...),
+    eating_sounds: str = Form(...),
+    swallowing_pattern: str = Form(...),
+
+    # 口腔内検査項目
+    upper_jaw_condition: str = Form(...),
+    lower_jaw_condition: str = Form(...),
+    midline_deviation: float = Form(...),
+    crossbite: str = Form(...),
+    tongue_position: str = Form(...),
+    lip_closure: str = Form(...),
+    facial_appearance: str = Form(...),
+    tmd_symptoms: str = Form(...),
+    other_findings: str = Form(...),
+):
+    """診断フォームの入力項目を辞書として受け取る (エンドポイント共通の依存関数)"""
+    # 引数名がそのままフォームのフィールド名になる
+    return dict(locals())
+
+
+# フォームの項目名と型 (CSV/JSONLの行をフォームと同じ形式に変換する際に使う)
+FORM_FIELDS = {name: param.annotation for name, param in inspect.signature(diagnosis_form).parameters.items()}
+
+
+def parse_form_row(row):
+    """1行分の患者データを /diagnose のフォームと同じ形式に変換する。不足や型の誤りは ValueError"""
+    missing = [name for name in FORM_FIELDS if row.get(name) is None]
+    if missing:
+        raise ValueError(f"必須項目がありません: {', '.join(missing)}")
+    form = {}
+    for name, field_type in FORM_FIELDS.items():
+        try:
+            form[name] = field_type(row[name])
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} の値が不正です: {row[name]!r}")
+    return form
+
+
+class PhotoTooLarge(Exception):
+    """アップロードされた写真のファイルサイズまたは画素数が上限を超えているときに送出される"""
+
+
+class UnsupportedPhoto(Exception):
+    """アップロードされたファイルが写真として受け付ける画像形式でないときに送出される"""
+
+
+# 写真のフォームのフィールド名と部位名
+PHOTO_VIEWS = {
+    "oral_photo_front": "正面観",
+    "oral_photo_upper_occlusal": "上顎咬合面観",
+    "oral_photo_lower_occlusal": "下顎咬合面観",
+    "oral_photo_right_lateral": "右側方観",
+    "oral_photo_left_lateral": "左側方観",
+}
+
+
+class ReceivedPhoto(NamedTuple):
+    """受け取った写真。digest は受信中に計算した内容のハッシュ値 (sha256 の16進数、無ければ None)"""
+    view: str
+    filename: str
+    data: bytes
+    digest: Optional[str] = None
+
+
+def check_photo_bytes(view_name, size):
+    """写真のファイルサイズが上限を超えていれば PhotoTooLarge を送出する"""
+    if size is not None and size > IMAGE_MAX_UPLOAD_BYTES:
+        raise PhotoTooLarge(
+            f"{view_name}の写真が大きすぎます ({size // 1024 ** 2}MB)。"
+            f"{IMAGE_MAX_UPLOAD_BYTES // 1024 ** 2}MB以下にしてください。"
+        )
+
+
+def check_photo(view_name, data, sniffed=False):
+    """
+    写真のファイルサイズ・形式・画素数を確かめ、上限を超えれば PhotoTooLarge を、画像でなければ UnsupportedPhoto を送出する。
+    受信中に形式を判定済みの写真は sniffed=True にする。
+    """
+    check_photo_bytes(view_name, len(data))
+    if not sniffed and data and sniff_image_format(data[:IMAGE_SNIFF_BYTES]) is None:
+        raise UnsupportedPhoto(f"{view_name}のファイルは画像ではありません。JPEG・PNG・HEICなどの写真を選択してください。")
+    try:
+        size = image_size(data)
+    except Image.DecompressionBombError:
+        # 画素数が極端に大きく、Pillow がサイズを返さない画像
+        raise PhotoTooLarge(
+            f"{view_name}の写真の画素数が大きすぎます。"
+            f"{IMAGE_MAX_PIXELS // 1_000_000}メガピクセル以下にしてください。"
+        )
+    if size and size[0] * size[1] > IMAGE_MAX_PIXELS:
+        raise PhotoTooLarge(
+            f"{view_name}の写真の画素数が大きすぎます ({size[0]}x{size[1]})。"
+            f"{IMAGE_MAX_PIXELS // 1_000_000}メガピクセル以下にしてください。"
+        )
+
+
+async def uploaded_photos(
+    # 口腔内写真アップロード
+    oral_photo_front: Optional[UploadFile] = File(None),
+    oral_photo_upper_occlusal: Optional[UploadFile] = File(None),
+    oral_photo_lower_occlusal: Optional[UploadFile] = File(None),
+    oral_photo_right_lateral: Optional[UploadFile] = File(None),
+    oral_photo_left_lateral: Optional[UploadFile] = File(None),
+):
+    """
+    アップロードされた写真を [ReceivedPhoto(部位名, ファイル名, バイト列, ハッシュ値), ...] として受け取る。
+    ファイルサイズや画素数が上限を超える写真があれば PhotoTooLarge を送出する (ブラウザで縮小されていない場合など)。
+    画像でないファイルは UnsupportedPhoto を送出する。
+    """
+    # 引数名がそのままフォームのフィールド名になる
+    photos = {PHOTO_VIEWS[name]: oral_photo for name, oral_photo in locals().items()}
+    received_photos = []
+    for view_name, oral_photo in photos.items():
+        if not (oral_photo and oral_photo.filename):
+            continue
+        check_photo_bytes(view_name, oral_photo.size)
+        # ストリーミングで受信した写真 (multipart_ingest.py) は、形式を判定済みのバイト列とハッシュ値をメモリ上に持っている
+        data = getattr(oral_photo, "data", None)
+        sniffed = data is not None
+        if data is None:
+            data = await oral_photo.read()
+        check_photo(view_name, data, sniffed)
+        received_photos.append(ReceivedPhoto(view_name, oral_photo.filename, data, getattr(oral_photo, "digest", None)))
+    # リクエストの受信からフォームの解析・写真の読み込みまで
+    mark("upload")
+    return received_photos
+
+
+def oral_photo_mime_type(filename):
+    """ファイル名から画像のMIMEタイプを推測する"""
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def build_diagnosis_result(form, scores=None):
+    """
+    フォームの入力内容からスコア・リスク判定・アプライアンスを計算し、診断結果を作成する。
+    一括計算済みのスコア (scoring.cohort_patient の戻り値) を scores に渡すと再計算しない。
+    """
+    scores = scores or score_patient(form)
+    mfs_score = scores["mfs_score"]
+    das_score = scores["das_score"]
+
+    # 仮の診断結果を作成
+    diagnosis_result = {
+        "patient_info": {
+            "name": form["patient_name"],
+            "age": form["patient_age"],
+        },
+        "analysis_summary": {
+            "risk_level": scores["risk_level"],
+            "appliance_suggestion": scores["appliance_suggestion"],
+            "mfs_score": mfs_score,
+            "das_score": das_score,
+            "mfs_yes_items": scores["mfs_yes_items"],
+            "das_items": scores["das_items"],
+            "comments": [f"MFSスコア: {mfs_score}/9", f"DASスコア: {das_score}/9"],
+        }
+    }
+    diagnosis_result['other_findings'] = form["other_findings"]
+    return diagnosis_result
+
+
+async def ingest_photos(received_photos):
+    """
+    受け取った写真の向きやサイズを補正（規格化）し、内容のハッシュ値をファイル名にして保存する。
+    保存した写真 [{"view", "path", "data", "mime_type", "digest"}, ...] と、規格化前後のバイト数を返す。
+    """
+    normalized_photos = await asyncio.gather(
+        *(asyncio.to_thread(normalize_image, photo.data) for photo in received_photos),
+        return_exceptions=True,
+    )
+
+    saved_photos = []
+    image_ingest = []
+    for (view_name, filename, data, digest), normalized in zip(received_photos, normalized_photos):
+        IMAGE_BYTES.labels("original").inc(len(data))
+        if isinstance(normalized, Exception):
+            # 規格化できない画像はそのまま保存して解析に回す
+            print(f"画像の規格化中にエラーが発生しました ({view_name}): {normalized}")
+            photo_data, mime_type, suffix = data, oral_photo_mime_type(filename), Path(filename).suffix
+        else:
+            photo_data, stats = normalized
+            mime_type, suffix = IMAGE_MIME_TYPES[IMAGE_FORMAT], IMAGE_EXTENSIONS[IMAGE_FORMAT]
+            image_ingest.append({"view": view_name, **stats})
+            print(f"画像を規格化しました ({view_name}): {stats['original_bytes']} -> {stats['normalized_bytes']} bytes")
+
+        IMAGE_BYTES.labels("normalized").inc(len(photo_data))
+
+        # 写真を保存 (規格化で変わらなかった写真は、受信中に計算したハッシュ値を使う)
+        photo_path = await asyncio.to_thread(store_photo, photo_data, suffix, digest if photo_data is data else None)
+        saved_photos.append({
+            "view": view_name, "path": photo_path, "data": photo_data, "mime_type": mime_type, "digest": photo_path.stem,
+        })
+
+    return saved_photos, image_ingest
+
+
+async def run_diagnosis(form, received_photos, progress=None, scores=None, on_chunk=None):
+    """
+    スコア計算・写真の規格化・AI画像解析を行い、PDFレンダリング前の診断結果を返す。
+    progress を渡すと、各段階の開始・終了時に progress(段階名, 状態) が呼び出される。
+    on_chunk を渡すと、AI画像解析の結果をストリーミングで受け取り、届くたびに on_chunk(部位名, テキスト) が呼び出される。
+    同じフォームと写真の診断が他のリクエスト (他のワーカーを含む) で実行中なら、解析せずにその完了を待って同じ結果を返す。
+    """
+    progress = progress or (lambda stage, status: None)
+    if single_flight is None:
+        return await execute_diagnosis(form, received_photos, progress, scores, on_chunk)
+
+    async def compute():
+        diagnosis_result = await execute_diagnosis(form, received_photos, progress, scores, on_chunk)
+        if not diagnosis_result.get("diagnosis_id"):
+            return None, diagnosis_result
+        # 保存した診断は後から修正 (PATCH) されうるため、入力のハッシュ値も記録して読み込むときに照合する
+        return f"{diagnosis_result['diagnosis_id']}:{diagnosis_result['input_digest']}", diagnosis_result
+
+    progress("upload", "running")
+    diagnosis_result, coalesced = await single_flight.run(request_key(form, received_photos), compute, load_flight_result)
+    if coalesced:
+        # 実行したリクエストと同じ順で進捗と解析結果を知らせる
+        progress("upload", "done")
+        # photo_paths には解析に成功した写真だけが記録されている
+        analyzed_views = {photo["view"] for photo in diagnosis_result["photo_paths"]}
+        for analysis in diagnosis_result["gemini_analyses"]:
+            if analysis["view"] not in analyzed_views:
+                progress(f"analysis:{analysis['view']}", "error")
+                continue
+            if on_chunk:
+                on_chunk(analysis["view"], analysis["analysis"])
+            progress(f"analysis:{analysis['view']}", "done")
+    return diagnosis_result
+
+
+async def execute_diagnosis(form, received_photos, progress, scores=None, on_chunk=None):
+    """run_diagnosis の処理の本体 (同じ入力のリクエストをまとめずに実行する)"""
+    with span("scoring"):
+        diagnosis_result = build_diagnosis_result(form, scores)
+
+    # 2. アップロードされた写真の処理 (複数枚対応)
+    progress("upload", "running")
+    with span("ingest"):
+        saved_photos, image_ingest = await ingest_photos(received_photos)
+    progress("upload", "done")
+
+    # Gemini Vision APIによる画像解析 (全ての写真を並行して解析)
+    for photo in saved_photos:
+        progress(f"analysis:{photo['view']}", "running")
+    gemini_analyses, photo_paths = await analyze_photos(
+        saved_photos,
+        on_result=lambda view_name, ok: progress(f"analysis:{view_name}", "done" if ok else "error"),
+        on_chunk=on_chunk,
+    )
+
+    diagnosis_result["gemini_analyses"] = gemini_analyses
+    diagnosis_result["photo_paths"] = photo_paths
+    diagnosis_result["photo_digests"] = [{"view": photo["view"], "digest": photo["digest"]} for photo in saved_photos]
+    diagnosis_result["image_ingest"] = image_ingest
+    diagnosis_result["input_digest"] = input_digest(form, diagnosis_result["photo_digests"])
+
+    # 後からAIを呼び出さずにPDFを作り直せるよう保存する (保存に失敗してもレポートは返す)
+    try:
+        with span("persist"):
+            diagnosis_result["diagnosis_id"] = await asyncio.to_thread(diagnosis_store.save, form, diagnosis_result)
+    except Exception as e:
+        print(f"診断結果の保存中にエラーが発生しました: {e}")
+    return diagnosis_result
+
+
+def load_flight_result(result_id):
+    """
+    まとめた診断の結果 ("<診断のID>:<入力のハッシュ値>") を読み込む。
+    実行した後に入力が修正されていれば、このリクエストの入力の結果ではないため None を返す (計算し直す)。
+    """
+    diagnosis_id, _, digest = result_id.partition(":")
+    record = diagnosis_store.get(diagnosis_id)
+    if record is None:
+        return None
+    diagnosis_result = rebuild_diagnosis_result(record)
+    return diagnosis_result if diagnosis_result["input_digest"] == digest else None
+
+
+def rebuild_diagnosis_result(record):
+    """保存した診断 (diagnosis_store の get の戻り値) から、AI画像解析をやり直さずに診断結果を作り直す"""
+    diagnosis_result = build_diagnosis_result(record["form"], record["scores"])
+    diagnosis_result["gemini_analyses"] = record["gemini_analyses"]
+    diagnosis_result["photo_paths"] = record["photo_paths"]
+    # photo_digests を記録する前に保存した診断は、解析に成功した写真の参照 (ファイル名がハッシュ値) から作る
+    diagnosis_result["photo_digests"] = record.get("photo_digests") or [
+        {"view": photo["view"], "digest": Path(photo["path"]).stem} for photo in record["photo_paths"]
+    ]
+    diagnosis_result["image_ingest"] = record["image_ingest"]
+    diagnosis_result["diagnosis_id"] = record["id"]
+    diagnosis_result["input_digest"] = input_digest(record["form"], diagnosis_result["photo_digests"])
+    # 保存先から失われた写真の部位 (作り直したPDFには載らないため、レスポンスで知らせる)
+    diagnosis_result["missing_photos"] = [
+        photo["view"] for photo in record["photo_paths"] if not Path(photo["path"]).exists()
+    ]
+    return diagnosis_result
+
+
+def input_digest(form, photo_digests):
+    """
+    フォームの入力と写真の内容から診断の入力のハッシュ値を作る (レスポンスのETagに使う)。
+    写真は解析に失敗したものも含め、受け取った全ての写真の内容のハッシュ値 [{"view", "digest"}, ...] を使う。
+    """
+    photos = [(photo["view"], photo["digest"]) for photo in photo_digests]
+    payload = json.dumps({"form": form, "photos": photos}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def update_diagnosis(diagnosis_id, changes):
+    """
+    保存した診断のフォームの入力のうち changes に含まれる項目だけを変更し、スコアを計算し直す。
+    AI画像解析の結果と写真はそのまま使う。変更後の保存内容に、実際に変わった項目名のリスト changed を加えて返す。
+    診断が無ければ None を返し、未知の項目や型の誤りは ValueError を送出する。
+    """
+    unknown = [name for name in changes if name not in FORM_FIELDS]
+    if unknown:
+        raise ValueError(f"変更できない項目です: {', '.join(unknown)}")
+    record = diagnosis_store.get(diagnosis_id)
+    if record is None:
+        return None
+    form = parse_form_row({**record["form"], **changes})
+    changed = [name for name in changes if form[name] != record["form"][name]]
+    if not changed:
+        return {**record, "changed": changed}
+    scores = build_diagnosis_result(form)["analysis_summary"]
+    if not diagnosis_store.update(diagnosis_id, form, scores):
+        return None
+    return {**record, "form": form, "scores": scores, "changed": changed}
+
+
+def report_filename(diagnosis_result):
+    """PDFレポートのファイル名"""
+    patient_info = diagnosis_result["patient_info"]
+    return f"diagnosis_report_{patient_info['name']}_{patient_info['age']}.pdf"
@@ -0,0 +1,219 @@
+"""
+診断結果の保存先。フォームの入力・スコア・AI画像解析の結果・写真の参照を保存しておき、
+AIを呼び出し直さずにPDFを作り直したり、入力の誤りを修正したりできるようにする。
+"""
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from storage import UPLOAD_DIR
+
+# 診断結果の保存先 (memory または sqlite)。再起動後も残し、全てのgunicornワーカーで共有するには sqlite を使う
+DIAGNOSIS_STORE = os.getenv("DIAGNOSIS_STORE", "sqlite")
+DIAGNOSIS_DB_PATH = os.getenv("DIAGNOSIS_DB_PATH", str(UPLOAD_DIR / "diagnoses.sqlite3"))
+# 診断を保存しておく秒数 (最後に修正されてから)。保存中の診断が参照している写真は UPLOAD_RETENTION_SECONDS を過ぎても削除しない
+DIAGNOSIS_RETENTION_SECONDS = float(os.getenv("DIAGNOSIS_RETENTION_SECONDS", str(90 * 24 * 3600)))
+
+# 検索に使える項目 (SQLiteではそれぞれに索引を作成する)
+SEARCH_FIELDS = ("patient_name", "birth_date", "visit_date")
+
+
+def new_record(form, diagnosis_result):
+    """保存する診断の辞書 {"id", "form", "scores", "gemini_analyses", "photo_paths", "photo_digests", "image_ingest", "visit_date", ...}"""
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "form": form,
+        "scores": diagnosis_result["analysis_summary"],
+        "gemini_analyses": diagnosis_result["gemini_analyses"],
+        "photo_paths": diagnosis_result["photo_paths"],
+        # 解析に失敗した写真も含む、受け取った全ての写真の内容のハッシュ値 [{"view", "digest"}, ...]
+        "photo_digests": diagnosis_result.get("photo_digests", []),
+        "image_ingest": diagnosis_result.get("image_ingest", []),
+        "visit_date": datetime.date.today().isoformat(),
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def summary(record):
+    """一覧に表示する項目"""
+    return {
+        "id": record["id"],
+        "patient_name": record["form"]["patient_name"],
+        "birth_date": record["form"]["birth_date"],
+        "visit_date": record["visit_date"],
+        "created_at": record["created_at"],
+        "updated_at": record["updated_at"],
+    }
+
+
+def photo_names(photo_paths):
+    """写真の参照 [{"view", "path"}, ...] から、保存先のファイル名を返す"""
+    return {Path(photo["path"]).name for photo in photo_paths}
+
+
+class MemoryDiagnosisStore:
+    """診断結果をプロセス内のメモリに保存する (ワーカー間では共有されない)"""
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def save(self, form, diagnosis_result):
+        record = new_record(form, diagnosis_result)
+        with self._lock:
+            self._records[record["id"]] = record
+        return record["id"]
+
+    def get(self, diagnosis_id):
+        with self._lock:
+            record = self._records.get(diagnosis_id)
+            return json.loads(json.dumps(record)) if record else None
+
+    def update(self, diagnosis_id, form, scores):
+        with self._lock:
+            record = self._records.get(diagnosis_id)
+            if record is None:
+                return False
+            record.update(form=form, scores=scores, updated_at=time.time())
+            return True
+
+    def find(self, limit=50, **criteria):
+        with self._lock:
+            records = [summary(r) for r in self._records.values()]
+        records = [r for r in records if all(r[k] == v for k, v in criteria.items() if v)]
+        return sorted(records, key=lambda r: r["created_at"], reverse=True)[:limit]
+
+    def delete_older_than(self, cutoff):
+        with self._lock:
+            for diagnosis_id in [i for i, r in self._records.items() if r["updated_at"] < cutoff]:
+                del self._records[diagnosis_id]
+
+    def referenced_photos(self):
+        with self._lock:
+            return set().union(*(photo_names(r["photo_paths"]) for r in self._records.values()))
+
+
+class SQLiteDiagnosisStore:
+    """診断結果をSQLiteに保存する。同じファイルを使う全てのワーカーから参照できる"""
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS diagnoses ("
+                "id TEXT PRIMARY KEY, patient_name TEXT NOT NULL, birth_date TEXT NOT NULL, visit_date TEXT NOT NULL, "
+                "form TEXT NOT NULL, scores TEXT NOT NULL, gemini_analyses TEXT NOT NULL, photo_paths TEXT NOT NULL, "
+                "image_ingest TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            for field in SEARCH_FIELDS:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS diagnoses_{field} ON diagnoses ({field})")
+            conn.execute("CREATE INDEX IF NOT EXISTS diagnoses_updated_at ON diagnoses (updated_at)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(diagnoses)")}
+            if "photo_digests" not in columns:
+                # 列を追加する前に保存した診断は空のリストになる (読み込むときに photo_paths から補う)
+                conn.execute("ALTER TABLE diagnoses ADD COLUMN photo_digests TEXT NOT NULL DEFAULT '[]'")
+            # 診断が参照している写真のファイル名 (写真の削除時に、全ての診断の photo_paths を読まずに済むようにする)
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'diagnosis_photos'").fetchone()
+            conn.execute("CREATE TABLE IF NOT EXISTS diagnosis_photos (diagnosis_id TEXT NOT NULL, name TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS diagnosis_photos_id ON diagnosis_photos (diagnosis_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS diagnosis_photos_name ON diagnosis_photos (name)")
+            if not exists:
+                # 表を追加する前に保存した診断の参照を登録する
+                for diagnosis_id, photo_paths in conn.execute("SELECT id, photo_paths FROM diagnoses").fetchall():
+                    self._insert_photos(conn, diagnosis_id, json.loads(photo_paths))
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _insert_photos(self, conn, diagnosis_id, photo_paths):
+        conn.executemany(
+            "INSERT INTO diagnosis_photos (diagnosis_id, name) VALUES (?, ?)",
+            [(diagnosis_id, name) for name in photo_names(photo_paths)],
+        )
+
+    def save(self, form, diagnosis_result):
+        r = new_record(form, diagnosis_result)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO diagnoses (id, patient_name, birth_date, visit_date, form, scores, gemini_analyses, "
+                "photo_paths, photo_digests, image_ingest, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    r["id"], form["patient_name"], form["birth_date"], r["visit_date"],
+                    *(json.dumps(r[k], ensure_ascii=False) for k in (
+                        "form", "scores", "gemini_analyses", "photo_paths", "photo_digests", "image_ingest",
+                    )),
+                    r["created_at"], r["updated_at"],
+                ),
+            )
+            self._insert_photos(conn, r["id"], r["photo_paths"])
+        return r["id"]
+
+    def get(self, diagnosis_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, visit_date, form, scores, gemini_analyses, photo_paths, image_ingest, created_at, updated_at, "
+                "photo_digests "
+                "FROM diagnoses WHERE id = ?", (diagnosis_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0], "visit_date": row[1], "form": json.loads(row[2]), "scores": json.loads(row[3]),
+            "gemini_analyses": json.loads(row[4]), "photo_paths": json.loads(row[5]), "image_ingest": json.loads(row[6]),
+            "created_at": row[7], "updated_at": row[8], "photo_digests": json.loads(row[9]),
+        }
+
+    def update(self, diagnosis_id, form, scores):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE diagnoses SET patient_name = ?, birth_date = ?, form = ?, scores = ?, updated_at = ? WHERE id = ?",
+                (
+                    form["patient_name"], form["birth_date"], json.dumps(form, ensure_ascii=False),
+                    json.dumps(scores, ensure_ascii=False), time.time(), diagnosis_id,
+                ),
+            )
+        return cursor.rowcount > 0
+
+    def find(self, limit=50, **criteria):
+        conditions = [(f"{k} = ?", v) for k, v in criteria.items() if k in SEARCH_FIELDS and v]
+        where = " AND ".join(c for c, _ in conditions) or "1"
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id, patient_name, birth_date, visit_date, created_at, updated_at FROM diagnoses "
+                f"WHERE {where} ORDER BY created_at DESC LIMIT ?",
+                [v for _, v in conditions] + [limit],
+            ).fetchall()
+        keys = ("id", "patient_name", "birth_date", "visit_date", "created_at", "updated_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def delete_older_than(self, cutoff):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM diagnosis_photos WHERE diagnosis_id IN (SELECT id FROM diagnoses WHERE updated_at < ?)",
+                (cutoff,),
+            )
+            conn.execute("DELETE FROM diagnoses WHERE updated_at < ?", (cutoff,))
+
+    def referenced_photos(self):
+        """保存した診断が参照している写真のファイル名 (保存期間を過ぎても削除しない)"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT DISTINCT name FROM diagnosis_photos").fetchall()
+        return {row[0] for row in rows}
+
+
+def create_diagnosis_store():
+    """DIAGNOSIS_STORE の設定に応じて診断結果の保存先を作成する"""
+    if DIAGNOSIS_STORE == "memory":
+        return MemoryDiagnosisStore()
+    return SQLiteDiagnosisStore(DIAGNOSIS_DB_PATH)
+
+
+diagnosis_store = create_diagnosis_store()
@@ -0,0 +1,127 @@
+"""
+負荷試験・ベンチマーク用の genai.GenerativeModel の偽物。
+APIを呼び出さずに、設定した応答時間のばらつきとエラー率でそれらしい解析結果を返す。
+ANALYSIS_BACKEND=fake で起動すると analysis.py がこちらを使う。
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import time
+
+from google.api_core import exceptions
+
+# 1回の呼び出しの平均応答時間（秒）、そのばらつきの幅（±秒）、失敗させる割合 (0〜1)
+FAKE_GEMINI_LATENCY = float(os.getenv("FAKE_GEMINI_LATENCY", "2.0"))
+FAKE_GEMINI_JITTER = float(os.getenv("FAKE_GEMINI_JITTER", "0.5"))
+FAKE_GEMINI_ERROR_RATE = float(os.getenv("FAKE_GEMINI_ERROR_RATE", "0"))
+
+SAMPLE_ANALYSIS = """- **歯列**: 上顎前歯部に軽度の叢生が見られます。
+- **咬合**: 前歯部の被蓋はやや浅く、開咬の傾向があります。
+- **歯肉**: 明らかな発赤や腫脹は見られません。
+- **その他**: 舌の位置が低い可能性があり、口呼吸の影響が疑われます。"""
+
+
+# 画像1枚あたりのトークン数 (Geminiは小さな画像を258トークンと数える。大きな画像は分割して数えるが、ここでは固定とする)
+IMAGE_TOKENS = 258
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+def fake_usage(contents, text):
+    """トークン数の概算 (日本語は1文字を1トークン、画像は IMAGE_TOKENS とする)"""
+    prompt_tokens = sum(len(part) if isinstance(part, str) else IMAGE_TOKENS for part in contents)
+    return FakeUsage(prompt_tokens, len(text))
+
+
+def fake_analysis_text(contents, json_output=False):
+    """
+    contents に対するそれらしい解析結果を返す。
+    json_output のときは analysis.py の combined モードと同じ形のJSONを、
+    contents の「【部位名】」の見出しごとに返す。
+    """
+    prompt = contents[0] if contents else ""
+    if not json_output:
+        return f"{SAMPLE_ANALYSIS}\n- **プロンプト**: {len(prompt)}文字"
+    findings = [
+        {"category": category, "finding": finding}
+        for category, finding in re.findall(r"- \*\*(.+?)\*\*: (.+)", SAMPLE_ANALYSIS)
+    ]
+    views = [part[1:-1] for part in contents if isinstance(part, str) and part.startswith("【") and part.endswith("】")]
+    return json.dumps({"views": [{"view": view, "findings": findings} for view in views]}, ensure_ascii=False)
+
+
+class FakeResponse:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeStreamResponse:
+    """stream=True のときの応答。部分ごとのテキストを一定間隔で返す"""
+
+    def __init__(self, chunks, interval, usage_metadata=None):
+        self._chunks = chunks
+        self._interval = interval
+        self._usage = usage_metadata
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self._interval)
+            yield FakeResponse(chunk, self._usage)
+
+
+class FakeGenerativeModel:
+    """generate_content / generate_content_async だけを持つ GenerativeModel の代わり"""
+
+    def __init__(self, model_name, generation_config=None, latency=None, jitter=None, error_rate=None):
+        self.model_name = model_name
+        self.generation_config = generation_config or {}
+        self.latency = FAKE_GEMINI_LATENCY if latency is None else latency
+        self.jitter = FAKE_GEMINI_JITTER if jitter is None else jitter
+        self.error_rate = FAKE_GEMINI_ERROR_RATE if error_rate is None else error_rate
+
+    def _delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def _respond(self, contents):
+        if random.random() < self.error_rate:
+            # 混雑時のGeminiと同じ例外を送出する
+            raise exceptions.ServiceUnavailable("fake_gemini: 意図的に発生させたエラーです")
+        text = fake_analysis_text(contents, self.generation_config.get("response_mime_type") == "application/json")
+        return FakeResponse(text, fake_usage(contents, text))
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        delay = self._delay()
+        if not stream:
+            time.sleep(delay)
+            return self._respond(contents)
+        time.sleep(delay * 0.3)
+        response = self._respond(contents)
+        lines = response.text.splitlines(keepends=True)
+        return self._iterate(lines, delay * 0.7 / len(lines), response.usage_metadata)
+
+    def _iterate(self, lines, interval, usage):
+        for line in lines:
+            time.sleep(interval)
+            yield FakeResponse(line, usage)
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        delay = self._delay()
+        if not stream:
+            await asyncio.sleep(delay)
+            return self._respond(contents)
+        # 応答時間の3割で最初の部分が届き、残りは行ごとに少しずつ届く
+        await asyncio.sleep(delay * 0.3)
+        response = self._respond(contents)
+        lines = response.text.splitlines(keepends=True)
+        return FakeStreamResponse(lines, delay * 0.7 / len(lines), response.usage_metadata)
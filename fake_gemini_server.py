@@ -0,0 +1,165 @@
+"""
+Gemini API (REST) の偽物のサーバー。gemini_client.py の再試行・呼び出し回数の制限・ヘッジを試験するために、
+429 (Retry-After 付き) や 503、遅い応答を指定した割合で返す。
+GEMINI_API_ENDPOINT=http://127.0.0.1:8090 を指定して起動すると、アプリはこのサーバーに接続する。
+
+    python fake_gemini_server.py [--port 8090] [--rate-limit-rate 0.2] [--retry-after 1] [--quota 60]
+                                 [--slow-rate 0.05] [--slow-latency 10] [--error-rate 0]
+
+POST /_config に設定をJSONで送ると起動中に変更でき、GET /_stats で応答の種類ごとの件数を確認できる。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fake_gemini import FAKE_GEMINI_JITTER, FAKE_GEMINI_LATENCY, fake_analysis_text, fake_usage
+
+DEFAULT_CONFIG = {
+    "latency": FAKE_GEMINI_LATENCY,  # 平均応答時間（秒）
+    "jitter": FAKE_GEMINI_JITTER,  # 応答時間のばらつき（±秒）
+    "rate_limit_rate": 0.0,  # 429 を返す割合
+    "retry_after": 1.0,  # 429 の Retry-After（秒）。負の値なら付けない
+    "quota": 0,  # 直近 quota_window 秒の呼び出しがこれを超えると 429 を返す。0なら無制限
+    "quota_window": 60.0,
+    "error_rate": 0.0,  # 503 を返す割合
+    "slow_rate": 0.0,  # slow_latency 秒かけて応答する割合
+    "slow_latency": 10.0,
+}
+
+
+class FakeGeminiState:
+    def __init__(self, config):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.stats = Counter()
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def decide(self):
+        """このリクエストへの応答を ("ok" | "slow" | "rate_limited" | "quota" | "error", 待つ秒数) で返す"""
+        config = self.config
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > config["quota_window"]:
+                self._recent.popleft()
+            if config["quota"] and len(self._recent) >= config["quota"]:
+                outcome = "quota"
+            elif random.random() < config["rate_limit_rate"]:
+                outcome = "rate_limited"
+            elif random.random() < config["error_rate"]:
+                outcome = "error"
+            elif random.random() < config["slow_rate"]:
+                outcome = "slow"
+            else:
+                outcome = "ok"
+            if outcome != "quota":
+                self._recent.append(now)
+            self.stats[outcome] += 1
+        if outcome == "slow":
+            return outcome, config["slow_latency"]
+        if outcome == "ok":
+            return outcome, max(0.0, config["latency"] + random.uniform(-config["jitter"], config["jitter"]))
+        return outcome, 0.0
+
+
+def candidate(text, usage):
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": 1}],
+        "usageMetadata": {
+            "promptTokenCount": usage.prompt_token_count,
+            "candidatesTokenCount": usage.candidates_token_count,
+            "totalTokenCount": usage.total_token_count,
+        },
+    }
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            self.send_json(200, {"stats": dict(self.state.stats), "config": self.state.config})
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/_config":
+            self.state.config.update(json.loads(body or b"{}"))
+            self.state.stats.clear()
+            self.send_json(200, self.state.config)
+            return
+        if ":generateContent" not in self.path and ":streamGenerateContent" not in self.path:
+            self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+            return
+
+        outcome, delay = self.state.decide()
+        if outcome in ("rate_limited", "quota"):
+            retry_after = self.state.config["retry_after"]
+            headers = {"Retry-After": f"{retry_after:g}"} if retry_after >= 0 else {}
+            self.send_json(429, {"error": {"code": 429, "message": f"fake_gemini_server: {outcome}",
+                                           "status": "RESOURCE_EXHAUSTED"}}, headers)
+            return
+        if outcome == "error":
+            self.send_json(503, {"error": {"code": 503, "message": "fake_gemini_server: unavailable",
+                                           "status": "UNAVAILABLE"}})
+            return
+
+        # テキストは文字列、画像などはそのままの辞書として fake_gemini に渡す
+        request = json.loads(body or b"{}")
+        contents = [part.get("text", part) for content in request.get("contents", []) for part in content.get("parts", [])]
+        json_output = request.get("generationConfig", {}).get("responseMimeType") == "application/json"
+        text = fake_analysis_text(contents, json_output)
+        usage = fake_usage(contents, text)
+        if ":generateContent" in self.path:
+            time.sleep(delay)
+            self.send_json(200, candidate(text, usage))
+            return
+
+        # ストリーミングは JSON の配列を少しずつ送る (接続を閉じて終わりを知らせる)
+        lines = text.splitlines(keepends=True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        time.sleep(delay * 0.3)
+        for i, line in enumerate(lines):
+            time.sleep(delay * 0.7 / len(lines))
+            self.wfile.write(("[" if i == 0 else ",\n").encode() + json.dumps(candidate(line, usage)).encode())
+            self.wfile.flush()
+        self.wfile.write(b"]")
+
+
+def serve(port, config=None):
+    """サーバーを作成して返す (serve_forever は呼び出し側で行う)"""
+    handler = type("Handler", (FakeGeminiHandler,), {"state": FakeGeminiState(config or {})})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8090)
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument("--" + key.replace("_", "-"), type=type(value), default=value)
+    args = parser.parse_args()
+
+    server = serve(args.port, {key: getattr(args, key) for key in DEFAULT_CONFIG})
+    print(f"fake_gemini_server: http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
@@ -0,0 +1,422 @@
+"""
+Gemini API の呼び出しをまとめる層。
+- トークンバケットによる呼び出し回数の制限 (GEMINI_RATE_DB_PATH を指定すると全ワーカーで共有)
+- 429・503などに対する指数バックオフでの再試行 (Retry-After があればそれに従う)
+- 失敗が続いたときに呼び出しを止めるサーキットブレーカー
+- 応答が遅いときに同じリクエストをもう1つ送り、先に返った方を使うヘッジ
+"""
+import asyncio
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import GEMINI_CIRCUIT_OPENS, GEMINI_HEDGES, GEMINI_RETRIES, GEMINI_TOKENS
+from timing import span
+
+# 1分あたりの呼び出し回数の上限と、まとめて呼び出せる回数。0なら制限しない
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "0"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+# 呼び出し回数の制限を全ワーカーで共有するためのSQLiteファイル。未指定ならプロセスごとに制限する
+GEMINI_RATE_DB_PATH = os.getenv("GEMINI_RATE_DB_PATH") or None
+
+# 再試行の回数と、バックオフの初期値・上限（秒）
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+
+# 連続して何回失敗したら呼び出しを止めるか、止めてから何秒後に試しに呼び出すか
+GEMINI_CIRCUIT_THRESHOLD = int(os.getenv("GEMINI_CIRCUIT_THRESHOLD", "5"))
+GEMINI_CIRCUIT_RESET = float(os.getenv("GEMINI_CIRCUIT_RESET", "30"))
+
+# Gemini APIの接続先。指定するとRESTで接続する (fake_gemini_server.py などの試験用サーバー向け)
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT") or None
+
+# 何秒応答がなければ同じリクエストをもう1つ送るか。0ならヘッジしない
+GEMINI_HEDGE_DELAY = float(os.getenv("GEMINI_HEDGE_DELAY", "0"))
+
+_retryable_errors = None
+
+
+def retryable_errors():
+    """
+    再試行する例外 (混雑・一時的な障害)。入力の誤りなどは再試行しない。
+    google.api_core は grpc を読み込むため、analysis.gemini() と同じく起動時ではなく最初の呼び出し時に読み込む。
+    """
+    global _retryable_errors
+    if _retryable_errors is None:
+        from google.api_core import exceptions
+        _retryable_errors = (
+            exceptions.TooManyRequests,
+            exceptions.ResourceExhausted,
+            exceptions.ServiceUnavailable,
+            exceptions.InternalServerError,
+            exceptions.GatewayTimeout,
+            exceptions.DeadlineExceeded,
+            asyncio.TimeoutError,
+        )
+    return _retryable_errors
+
+
+class CircuitOpen(Exception):
+    """サーキットブレーカーが開いていて、Geminiを呼び出さなかった"""
+
+
+class RateLimited(Exception):
+    """呼び出し回数の制限の順番が期限までに回ってこないため、Geminiを呼び出さなかった"""
+
+
+class TokenBucket:
+    """
+    1秒あたり rate 個のトークンが貯まり、最大 capacity 個まで保持するトークンバケット。
+    呼び出し1回につき1個使う。足りないときは前借りして、貯まるまでの秒数だけ待つ (先着順になる)。
+    期限までに貯まらない場合は前借りせずに断り、待っている間に取り消された場合は前借りしたトークンを返す。
+    db_path を指定すると、同じファイルを指定した全てのプロセスで1つのバケットを共有する。
+    """
+
+    def __init__(self, rate, capacity, db_path=None, name="gemini"):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.db_path = str(db_path) if db_path else None
+        self.name = name
+        self._tokens = float(self.capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS token_buckets ("
+                    "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+                )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def _update(self, change):
+        """
+        現在のトークン数 (貯まった分を加えたもの) を change に渡し、change が返す (新しいトークン数, 戻り値) の
+        トークン数を保存して戻り値を返す
+        """
+        now = time.time()
+        if not self.db_path:
+            with self._lock:
+                tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._tokens, result = change(tokens)
+                self._updated = now
+            return result
+
+        conn = self._connect()
+        try:
+            # 読み取りから書き込みまでを他のプロセスと排他にする
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated FROM token_buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens, updated = row if row else (float(self.capacity), now)
+            tokens, result = change(min(self.capacity, tokens + (now - updated) * self.rate))
+            conn.execute(
+                "INSERT OR REPLACE INTO token_buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                (self.name, tokens, now),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return result
+
+    def reserve(self, max_wait=None):
+        """
+        トークンを1個使い、使えるようになるまでの秒数を返す。
+        待つ秒数が max_wait を超える場合はトークンを使わずに None を返す。
+        """
+        def take(tokens):
+            wait = max(0.0, (1 - tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return tokens, None
+            return tokens - 1, wait
+        return self._update(take)
+
+    def release(self):
+        """reserve で使ったトークンを1個返す"""
+        self._update(lambda tokens: (min(self.capacity, tokens + 1), None))
+
+    async def acquire(self, max_wait=None):
+        """
+        トークンを1個使い、使えるようになるまで待つ。max_wait 秒以内に使えない場合は RateLimited を送出する。
+        共有する場合の SQLite の書き込みロック待ちでイベントループを止めないよう、スレッドで予約する。
+        """
+        if self.db_path:
+            reservation = asyncio.ensure_future(asyncio.to_thread(self.reserve, max_wait))
+            try:
+                wait = await asyncio.shield(reservation)
+            except asyncio.CancelledError:
+                # 予約の途中で取り消された場合は、予約が終わってからトークンを返す
+                def give_back(f):
+                    if not f.cancelled() and f.exception() is None and f.result() is not None:
+                        self._release_later()
+                reservation.add_done_callback(give_back)
+                raise
+        else:
+            wait = self.reserve(max_wait)
+        if wait is None:
+            raise RateLimited("呼び出し回数の制限 (GEMINI_RPM) のため、期限までにGemini APIを呼び出せませんでした")
+        if wait > 0:
+            with span("rate_limit"):
+                try:
+                    await asyncio.sleep(wait)
+                except asyncio.CancelledError:
+                    # タイムアウトやヘッジで取り消された場合は、使わなかったトークンを返す
+                    self._release_later()
+                    raise
+
+    def _release_later(self):
+        """トークンを返す。SQLite に保存する場合はスレッドで返し、終わるのを待たない"""
+        if self.db_path:
+            asyncio.get_running_loop().run_in_executor(None, self.release)
+        else:
+            self.release()
+
+
+class CircuitBreaker:
+    """
+    threshold 回続けて失敗すると開き、reset_timeout 秒の間は呼び出しを止める。
+    その後は1回だけ試しに呼び出し、成功すれば閉じ、失敗すればまた開く。
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # 試しの呼び出しを始めた時刻 (取り消されて結果が記録されなかった場合に備え、reset_timeout 秒で期限切れにする)
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def before_call(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            state = self.state
+            trial_running = self._trial_at is not None and time.monotonic() - self._trial_at < self.reset_timeout
+            if state == "open" or (state == "half_open" and trial_running):
+                raise CircuitOpen("Gemini APIの呼び出しに続けて失敗したため、しばらく呼び出しを止めています")
+            if state == "half_open":
+                self._trial_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold > 0:
+                if self.state != "open":
+                    GEMINI_CIRCUIT_OPENS.inc()
+                self.opened_at = time.monotonic()
+                self._trial_at = None
+
+
+def retry_after(exc):
+    """例外に含まれる待ち時間の指定（秒）を返す。無ければ None"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    # gRPC・RESTの429には google.rpc.RetryInfo として待ち時間が入っている
+    for detail in getattr(exc, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            match = re.match(r"([\d.]+)s", str(detail["retryDelay"]))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt, exc):
+    """attempt 回目 (0始まり) の失敗の後に待つ秒数。Retry-After があればそれを優先する"""
+    delay = retry_after(exc)
+    if delay is None:
+        # 他のワーカーと同時に再試行しないよう、上限までの範囲でばらつかせる (full jitter)
+        delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+    return delay
+
+
+class GeminiClient:
+    """呼び出し回数の制限・再試行・サーキットブレーカー・ヘッジを組み合わせてGeminiを呼び出す"""
+
+    def __init__(self, bucket=None, breaker=None, max_retries=GEMINI_MAX_RETRIES, hedge_delay=GEMINI_HEDGE_DELAY):
+        self.bucket = bucket
+        self.breaker = breaker or CircuitBreaker(GEMINI_CIRCUIT_THRESHOLD, GEMINI_CIRCUIT_RESET)
+        self.max_retries = max_retries
+        self.hedge_delay = hedge_delay
+
+    async def generate(self, model, contents, timeout, on_chunk=None):
+        """
+        model で contents を生成し、テキストを返す。timeout は再試行を含めた全体の秒数。
+        on_chunk を渡すとストリーミングで生成し、届いた部分ごとに on_chunk(テキスト) を呼び出す。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                text = await self._hedged(model, contents, deadline, on_chunk)
+            except RateLimited:
+                # Geminiを呼び出していないため、サーキットブレーカーの成功にも失敗にも数えない
+                raise
+            except retryable_errors() as exc:
+                self.breaker.record_failure()
+                delay = backoff_delay(attempt, exc)
+                # 再試行しても期限内に終わらない場合はあきらめる
+                if attempt >= self.max_retries or loop.time() + delay >= deadline:
+                    raise
+                GEMINI_RETRIES.labels(type(exc).__name__).inc()
+                print(f"Gemini API呼び出しに失敗したため、{delay:.1f}秒後に再試行します: {type(exc).__name__}")
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                # 入力の誤りなどはGeminiが応答しているため、サーキットブレーカーの失敗には数えない
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return text
+
+    async def _hedged(self, model, contents, deadline, on_chunk):
+        """1回のリクエストを送り、hedge_delay 秒以内に応答 (ストリーミングでは最初の部分) がなければもう1つ送る"""
+        timeout = deadline - asyncio.get_running_loop().time()
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        if self.hedge_delay <= 0:
+            return await asyncio.wait_for(self._call(model, contents, on_chunk, deadline), timeout)
+        return await asyncio.wait_for(self._race(model, contents, on_chunk, deadline), timeout)
+
+    async def _race(self, model, contents, on_chunk, deadline):
+        # ストリーミングでは、最初の部分が先に届いたリクエストの部分だけを on_chunk に渡す
+        winner = None
+        first_chunk = asyncio.Event()
+
+        def chunk_handler(name):
+            def handle(chunk):
+                nonlocal winner
+                if winner is None:
+                    winner = name
+                    first_chunk.set()
+                if winner == name:
+                    on_chunk(chunk)
+            return handle
+
+        tasks = {}
+
+        def start(name):
+            handler = chunk_handler(name) if on_chunk else None
+            tasks[asyncio.ensure_future(self._call(model, contents, handler, deadline))] = name
+
+        start("primary")
+        waiter = asyncio.ensure_future(first_chunk.wait())
+        try:
+            done, _ = await asyncio.wait([*tasks, waiter], timeout=self.hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                start("hedge")
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    # 部分を先に受け取った方の結果だけを使う
+                    elif winner in (None, tasks[task]):
+                        if len(tasks) > 1:
+                            GEMINI_HEDGES.labels(tasks[task]).inc()
+                        return task.result()
+            raise error
+        finally:
+            waiter.cancel()
+            for task in tasks:
+                task.cancel()
+
+    async def _call(self, model, contents, on_chunk, deadline):
+        """リクエストを1回送る (呼び出し回数の制限を受け、deadline までに順番が回ってこなければ送らない)"""
+        if self.bucket:
+            await self.bucket.acquire(deadline - asyncio.get_running_loop().time())
+        # ライブラリ自身の再試行は無効にし、この層で再試行する
+        options = {"request_options": {"retry": None}}
+        if GEMINI_API_ENDPOINT:
+            # 取り消された後にスレッドから届いた部分は捨てる
+            active = True
+
+            def forward(chunk):
+                if active:
+                    on_chunk(chunk)
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(
+                    _rest_executor, _generate_sync, model, contents, on_chunk and forward, loop, options
+                )
+            finally:
+                active = False
+        if on_chunk is None:
+            response = await model.generate_content_async(contents, **options)
+            record_usage(response)
+            return response.text
+        response = await model.generate_content_async(contents, stream=True, **options)
+        parts = []
+        chunk = None
+        async for chunk in response:
+            parts.append(chunk.text)
+            on_chunk(chunk.text)
+        record_usage(chunk)
+        return "".join(parts)
+
+
+def record_usage(response):
+    """応答に含まれるトークン数をメトリクスに加える (ストリーミングでは最後の部分に合計が入っている)"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        GEMINI_TOKENS.labels("prompt").inc(usage.prompt_token_count)
+        GEMINI_TOKENS.labels("output").inc(usage.candidates_token_count)
+
+
+# RESTの呼び出しに使うスレッド。取り消したリクエスト (ヘッジで負けた方など) も応答まではスレッドを使い続けるため、
+# 既定のスレッドプール (CPU数+4) とは別に多めに用意する
+_rest_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="gemini-rest")
+
+
+def _generate_sync(model, contents, on_chunk, loop, options):
+    """RESTで接続するときは非同期の呼び出しが使えないため、スレッドで同期的に呼び出す"""
+    if on_chunk is None:
+        response = model.generate_content(contents, **options)
+        record_usage(response)
+        return response.text
+    parts = []
+    chunk = None
+    for chunk in model.generate_content(contents, stream=True, **options):
+        parts.append(chunk.text)
+        loop.call_soon_threadsafe(on_chunk, chunk.text)
+    record_usage(chunk)
+    return "".join(parts)
+
+
+gemini_client = GeminiClient(
+    bucket=TokenBucket(GEMINI_RPM / 60, GEMINI_BURST, GEMINI_RATE_DB_PATH) if GEMINI_RPM > 0 else None,
+)
@@ -0,0 +1,33 @@
+import gc
+import os
+import shutil
+import tempfile
+
+# 各ワーカーのメトリクスをファイルに書き出し、/metrics で全ワーカーの値を集計する
+# (ワーカーが prometheus_client を読み込む前に設定しておく必要がある)
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "dental_ai_report_metrics")
+)
+# 前回の起動時のメトリクスが混ざらないよう、空にしてから起動する
+# (preload ではマスターがアプリを読み込む時点でディレクトリが必要なため、on_starting ではなくここで行う)
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir, exist_ok=True)
+
+# GUNICORN_PRELOAD=1 のとき、マスターでアプリを読み込んでからワーカーを fork する
+# (読み込んだモジュールやフォントをワーカー間でコピーオンライトで共有し、起動とメモリを節約する)
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+
+def child_exit(server, worker):
+    # 終了したワーカーの処理中件数 (livesum のゲージ) を集計から外す
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    # fork の前に、初回のリクエストまで読み込みを遅らせているものも読み込んでおく
+    if server.cfg.preload_app:
+        import main
+        main.preload()
+        # 読み込み済みのオブジェクトをGCの対象から外し、GCの走査でページがコピーされないようにする
+        gc.freeze()
@@ -0,0 +1,108 @@
+import io
+import os
+
+from PIL import Image, ImageOps
+
+# 規格化後の画像の長辺の最大ピクセル数・保存形式・画質
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# 受け付ける写真1枚あたりのファイルサイズ (バイト) と画素数の上限。超える写真は 413 で拒否する
+IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(20 * 1024 ** 2)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+# 1リクエスト (フォームと全ての写真) の受信サイズの上限 (バイト)。既定は写真5枚分と1MB
+IMAGE_MAX_REQUEST_BYTES = int(os.getenv("IMAGE_MAX_REQUEST_BYTES", str(5 * IMAGE_MAX_UPLOAD_BYTES + 1024 ** 2)))
+# 1プロセスで受信中の全てのリクエストがメモリ上に保持する写真の合計の上限 (バイト)。超えると 503 を返す
+IMAGE_MAX_BUFFERED_BYTES = int(os.getenv("IMAGE_MAX_BUFFERED_BYTES", str(4 * IMAGE_MAX_REQUEST_BYTES)))
+
+IMAGE_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp"}
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# 先頭のバイト列 (マジックナンバー) と画像形式。HEIF/AVIF は4バイト目からの ftyp ボックスで判定する
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+]
+HEIF_BRANDS = {b"heic": "HEIF", b"heix": "HEIF", b"hevc": "HEIF", b"heif": "HEIF", b"mif1": "HEIF", b"msf1": "HEIF",
+               b"avif": "AVIF"}
+# 画像形式の判定に必要な先頭のバイト数
+IMAGE_SNIFF_BYTES = 12
+
+
+def sniff_image_format(head):
+    """先頭のバイト列から画像形式 ("JPEG" など) を判定する。写真として受け付けない形式なら None"""
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head[4:8] == b"ftyp":
+        return HEIF_BRANDS.get(head[8:12])
+    return None
+
+
+def image_size(data):
+    """
+    画像のヘッダーだけを読んで (幅, 高さ) を返す。画像として読めない場合は None。
+    Pillow の上限 (Image.MAX_IMAGE_PIXELS の2倍) を超える画素数の画像は Image.DecompressionBombError をそのまま送出する。
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Image.DecompressionBombError:
+        raise
+    except Exception:
+        return None
+
+
+def normalize_image(data, max_edge=None, image_format=None, quality=None):
+    """
+    アップロードされた画像の向きやサイズを補正（規格化）する。
+    EXIFの向きを適用し、長辺を max_edge 以下に縮小、RGBに変換してJPEG/WebPで再エンコードする。
+    画像のデコードは1回だけ行い、JPEGは draft() でデコード時に縮小する。
+    """
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    image_format = (image_format or IMAGE_FORMAT).upper()
+    quality = quality or IMAGE_QUALITY
+
+    img = Image.open(io.BytesIO(data))
+    original_size = img.size
+    # ブラウザで縮小・再エンコード済みの写真など、既に規格どおりのものはそのまま使う (再エンコードによる劣化を避ける)
+    if (
+        img.format == image_format and img.mode == "RGB" and max(original_size) <= max_edge
+        and "exif" not in img.info
+    ):
+        stats = {
+            "original_bytes": len(data),
+            "normalized_bytes": len(data),
+            "original_size": list(original_size),
+            "normalized_size": list(original_size),
+        }
+        return data, stats
+    # JPEGはDCTスケーリングで、縮小後のサイズを下回らない範囲で縮小しながらデコードする
+    scale = max_edge / max(original_size)
+    if scale < 1:
+        img.draft("RGB", (int(original_size[0] * scale), int(original_size[1] * scale)))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    # thumbnail は reducing_gap により reduce() で大まかに縮小してからリサンプリングする
+    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, quality=quality, optimize=True)
+    normalized = buffer.getvalue()
+
+    stats = {
+        "original_bytes": len(data),
+        "normalized_bytes": len(normalized),
+        "original_size": list(original_size),
+        "normalized_size": list(img.size),
+    }
+    return normalized, stats
+
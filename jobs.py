@@ -0,0 +1,328 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from diagnosis import report_filename, run_diagnosis
+from metrics import observe_timings
+from render_pool import RenderQueueFull, render_pool
+from storage import UPLOAD_DIR
+from timing import start_timings
+
+# ジョブの状態の保存先 (memory または sqlite)。複数のgunicornワーカーで共有するには sqlite を使う
+JOB_STORE = os.getenv("JOB_STORE", "sqlite")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", str(UPLOAD_DIR / "jobs.sqlite3"))
+# ワーカープロセスごとに同時に処理するジョブ数と、順番待ちできるジョブ数
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_DEPTH = int(os.getenv("JOB_QUEUE_DEPTH", "32"))
+
+
+class JobQueueFull(Exception):
+    """ジョブの順番待ちが上限に達したときに送出される"""
+
+
+# ジョブの保存先に書き込むスレッド。SQLiteの書き込み (ロック待ち・コミット・PDFの保存) でイベントループを止めず、
+# 進捗の更新が届いた順に保存されるよう、プロセスごとに1つのスレッドで順に書き込む
+_store_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+
+
+async def store_write(method, *args, **kwargs):
+    """ジョブの保存先への書き込みを書き込み用のスレッドで行い、終わるまで待つ"""
+    return await asyncio.wrap_future(_store_writer.submit(method, *args, **kwargs))
+
+
+def store_write_later(method, *args, **kwargs):
+    """ジョブの保存先への書き込みを書き込み用のスレッドに渡す (終わるのを待たない)"""
+    def write():
+        try:
+            method(*args, **kwargs)
+        except Exception as e:
+            print(f"ジョブの状態を保存できませんでした: {e}")
+    _store_writer.submit(write)
+
+
+def job_stages(received_photos):
+    """ジョブの段階 (アップロード・各写真の解析・PDF生成) の初期状態を作成する"""
+    stages = [{"name": "upload", "label": "写真のアップロード", "status": "pending"}]
+    for photo in received_photos:
+        stages.append({"name": f"analysis:{photo.view}", "label": f"{photo.view}の解析", "status": "pending"})
+    stages.append({"name": "pdf", "label": "PDFレポートの生成", "status": "pending"})
+    return stages
+
+
+class MemoryJobStore:
+    """ジョブの状態をプロセス内のメモリに保存する (単一ワーカー向け)"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id, stages):
+        with self._lock:
+            self._jobs[job_id] = {
+                "id": job_id, "status": "queued", "stages": stages, "error": None,
+                "created_at": time.time(), "updated_at": time.time(),
+            }
+
+    def update(self, job_id, status, error=None):
+        with self._lock:
+            self._jobs[job_id].update(status=status, error=error, updated_at=time.time())
+
+    def set_stage(self, job_id, stage, status):
+        with self._lock:
+            job = self._jobs[job_id]
+            for s in job["stages"]:
+                if s["name"] == stage:
+                    s["status"] = status
+            job["updated_at"] = time.time()
+
+    def set_result(self, job_id, filename, pdf_bytes):
+        with self._lock:
+            self._results[job_id] = (filename, pdf_bytes)
+            self._jobs[job_id].update(status="done", updated_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job else None
+
+    def get_result(self, job_id):
+        with self._lock:
+            return self._results.get(job_id)
+
+    def delete_older_than(self, cutoff):
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items() if job["updated_at"] < cutoff]:
+                del self._jobs[job_id]
+                self._results.pop(job_id, None)
+
+
+class SQLiteJobStore:
+    """ジョブの状態とPDFをSQLiteに保存する。同じファイルを使う全てのワーカーから参照できる"""
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, stages TEXT NOT NULL, error TEXT, "
+                "filename TEXT, pdf BLOB, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def create(self, job_id, stages):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, stages, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(stages, ensure_ascii=False), now, now),
+            )
+
+    def update(self, job_id, status, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def set_stage(self, job_id, stage, status):
+        with self._connect() as conn:
+            row = conn.execute("SELECT stages FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            stages = json.loads(row[0])
+            for s in stages:
+                if s["name"] == stage:
+                    s["status"] = status
+            conn.execute(
+                "UPDATE jobs SET stages = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(stages, ensure_ascii=False), time.time(), job_id),
+            )
+
+    def set_result(self, job_id, filename, pdf_bytes):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', filename = ?, pdf = ?, updated_at = ? WHERE id = ?",
+                (filename, pdf_bytes, time.time(), job_id),
+            )
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, stages, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0], "status": row[1], "stages": json.loads(row[2]), "error": row[3],
+            "created_at": row[4], "updated_at": row[5],
+        }
+
+    def get_result(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT filename, pdf FROM jobs WHERE id = ? AND status = 'done'", (job_id,)
+            ).fetchone()
+        return (row[0], bytes(row[1])) if row else None
+
+    def delete_older_than(self, cutoff):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,))
+
+
+def create_job_store():
+    """JOB_STORE の設定に応じてジョブの保存先を作成する"""
+    if JOB_STORE == "memory":
+        return MemoryJobStore()
+    return SQLiteJobStore(JOB_DB_PATH)
+
+
+async def run_job(store, job_id, form, received_photos, on_stage=None, on_chunk=None):
+    """
+    ジョブを1件実行し、各段階の進捗と完成したPDFをジョブの保存先に記録する。
+    on_stage を渡すと、各段階の開始・終了時に on_stage(段階名, 状態) も呼び出される。
+    """
+    def progress(stage, status):
+        store_write_later(store.set_stage, job_id, stage, status)
+        if on_stage:
+            on_stage(stage, status)
+
+    await store_write(store.update, job_id, "running")
+    diagnosis_result = await run_diagnosis(form, received_photos, progress=progress, on_chunk=on_chunk)
+
+    progress("pdf", "running")
+    while True:
+        try:
+            pdf_bytes = await render_pool.render(diagnosis_result)
+            break
+        except RenderQueueFull:
+            # レンダリングが混み合っている間は、エラーにせず空くまで待つ
+            await asyncio.sleep(render_pool.retry_after)
+        except Exception:
+            progress("pdf", "error")
+            raise
+    progress("pdf", "done")
+    await store_write(store.set_result, job_id, report_filename(diagnosis_result), pdf_bytes)
+    return diagnosis_result
+
+
+def sse_event(event, data):
+    """Server-Sent Events の1件分の文字列"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_job(store, form, received_photos, on_done=None):
+    """
+    ジョブを登録してこのワーカーで実行し、進捗を Server-Sent Events として少しずつ返す。
+    各部位の解析結果は Gemini から届いた部分ごとに送り、最後にPDFのURLを送る。
+    PDFはジョブの保存先に記録するため、GET /jobs/{job_id}/report.pdf で取得できる。
+    on_done を渡すと、ジョブが終わったとき (接続が切れて取り消した場合も含む) に呼び出す。
+    """
+    job_id = uuid.uuid4().hex
+    stages = job_stages(received_photos)
+    await store_write(store.create, job_id, stages)
+    events = asyncio.Queue()
+
+    async def run():
+        # レスポンスの送信を始めた後に実行されるため、所要時間はリクエストとは別に記録する
+        timings = start_timings()
+        try:
+            return await run_job(
+                store, job_id, form, received_photos,
+                on_stage=lambda stage, status: events.put_nowait(("stage", {"name": stage, "status": status})),
+                on_chunk=lambda view_name, text: events.put_nowait(("chunk", {"view": view_name, "text": text})),
+            )
+        finally:
+            observe_timings(timings)
+            if on_done:
+                on_done()
+
+    task = asyncio.create_task(run())
+    task.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        yield sse_event("job", {"job_id": job_id, "status_url": f"/jobs/{job_id}", "stages": stages})
+        while (event := await events.get()) is not None:
+            yield sse_event(*event)
+
+        try:
+            diagnosis_result = task.result()
+        except Exception as e:
+            print(f"Error during job {job_id}: {e}")
+            await store_write(store.update, job_id, "error", error=str(e))
+            yield sse_event("error", {"message": f"診断レポートの生成に失敗しました: {e}"})
+            return
+        diagnosis_id = diagnosis_result.get("diagnosis_id")
+        yield sse_event("report", {
+            "report_url": f"/jobs/{job_id}/report.pdf",
+            "analyses": diagnosis_result["gemini_analyses"],
+            "diagnosis_id": diagnosis_id,
+            "diagnosis_url": f"/reports/{diagnosis_id}" if diagnosis_id else None,
+        })
+    finally:
+        # クライアントが切断した場合は、処理を取り消す
+        if not task.done():
+            task.cancel()
+            store_write_later(store.update, job_id, "error", error="クライアントが切断したため中止しました")
+
+
+class JobQueue:
+    """
+    診断レポートのジョブをプロセス内のワーカーで順に処理する。
+    各段階の進捗はジョブの保存先に記録され、GET /jobs/{id} から参照できる。
+    """
+
+    def __init__(self, store, workers=JOB_WORKERS, queue_depth=JOB_QUEUE_DEPTH):
+        self.store = store
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_depth)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(max(1, self.workers))]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, form, received_photos, on_done=None):
+        """ジョブを登録してジョブIDを返す。on_done を渡すと、ジョブが終わったときに呼び出す"""
+        if self._queue is None:
+            self.start()
+        if self._queue.full():
+            raise JobQueueFull(f"{self._queue.qsize()}件のジョブが順番待ちです")
+        job_id = uuid.uuid4().hex
+        await store_write(self.store.create, job_id, job_stages(received_photos))
+        # 保存を待つ間に順番待ちが埋まった場合
+        if self._queue.full():
+            store_write_later(self.store.update, job_id, "error", error="順番待ちが上限に達しました")
+            raise JobQueueFull(f"{self._queue.qsize()}件のジョブが順番待ちです")
+        self._queue.put_nowait((job_id, form, received_photos, on_done))
+        return job_id
+
+    async def _worker(self):
+        while True:
+            job_id, form, received_photos, on_done = await self._queue.get()
+            timings = start_timings()
+            try:
+                await run_job(self.store, job_id, form, received_photos)
+            except Exception as e:
+                print(f"Error during job {job_id}: {e}")
+                await store_write(self.store.update, job_id, "error", error=str(e))
+            finally:
+                observe_timings(timings)
+                if on_done:
+                    on_done()
+                self._queue.task_done()
+
+
+job_queue = JobQueue(create_job_store())
@@ -1,422 +1,411 @@
-from fastapi import FastAPI, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi import APIRouter, FastAPI, Request, Depends, UploadFile, File, Body
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-import uvicorn
+from starlette.background import BackgroundTask
+import asyncio
+import html
 import os
-from pathlib import Path
 import shutil
-import json
-from typing import Optional
+import tempfile
+import time
+from pathlib import Path
+from typing import Literal, Optional
+from urllib.parse import quote
 
-# Gemini APIと環境変数、画像処理のためのインポート
-import google.generativeai as genai
+# 環境変数のためのインポート (Gemini APIは起動後にスレッドで analysis.load_gemini() で読み込む)
 from dotenv import load_dotenv
-from PIL import Image
-
-# reportlab のインポート
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import Paragraph, Table, TableStyle
-from reportlab.lib.utils import ImageReader
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
-from reportlab.lib import colors
 import markdown
 
-app = FastAPI()
-
 # .env ファイルから環境変数を読み込む
 load_dotenv()
-# Gemini APIキーを設定
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+from analysis import analysis_cache, gemini, load_gemini
+from batch import PhotoArchive, read_rows, stream_batch_zip
+from diagnosis import (
+    PhotoTooLarge, UnsupportedPhoto, diagnosis_form, rebuild_diagnosis_result, report_filename, run_diagnosis, update_diagnosis, uploaded_photos,
+)
+from diagnosis_store import DIAGNOSIS_RETENTION_SECONDS, diagnosis_store
+from image_ingest import IMAGE_MAX_EDGE, IMAGE_MAX_UPLOAD_BYTES, IMAGE_QUALITY
+from jobs import JobQueueFull, job_queue, stream_job
+from metrics import HTTP_IN_FLIGHT, HTTP_REQUEST_SECONDS, observe_timings, render_metrics
+from multipart_ingest import PhotoUploadRoute, keep_photo_buffer
+from render_pool import RenderQueueFull, render_pool
+from report import register_fonts
+from storage import retention_loop
+from timing import start_timings
+
+app = FastAPI()
+# 写真を受け取るエンドポイント (フォームをストリーミングで受信し、大きすぎる写真や画像でないファイルは受信中に拒否する)
+photo_routes = APIRouter(route_class=PhotoUploadRoute)
 
 # このファイルの場所を基準に絶対パスを構築
 BASE_DIR = Path(__file__).resolve().parent
 
-# 日本語フォントの登録
-FONT_PATH = Path(BASE_DIR, "fonts", "ipaexg.ttf")
-if FONT_PATH.exists():
-    pdfmetrics.registerFont(TTFont('IPAexGothic', str(FONT_PATH)))
-    pdfmetrics.registerFontFamily('IPAexGothic', normal='IPAexGothic', bold='IPAexGothic', italic='IPAexGothic', boldItalic='IPAexGothic')
-else:
-    print(f"Warning: Japanese font not found at {FONT_PATH}. Please place IPAexGothic.ttf in the 'fonts' directory.")
-
 # templatesディレクトリの絶対パスを設定
 templates = Jinja2Templates(directory=str(Path(BASE_DIR, "templates")))
 
-# アップロードされたファイルを保存するディレクトリも絶対パスで設定
-UPLOAD_DIR = Path(BASE_DIR, "uploads")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+def preload():
+    """
+    gunicorn の preload (GUNICORN_PRELOAD=1) でワーカーを起動する前にマスターで呼び出す。
+    Gemini のライブラリ・フォント・テンプレートを読み込んでおき、全ワーカーでコピーオンライトで共有する。
+    """
+    gemini()
+    register_fonts()
+    templates.get_template("index.html")
+    templates.get_template("report.html")
+
+
+def delete_expired_records(cutoff):
+    """保存期間を過ぎたジョブと診断を削除する (診断は DIAGNOSIS_RETENTION_SECONDS で、削除すると写真も削除できるようになる)"""
+    job_queue.store.delete_older_than(cutoff)
+    diagnosis_store.delete_older_than(time.time() - DIAGNOSIS_RETENTION_SECONDS)
+
+
+@app.on_event("startup")
+async def start_workers():
+    # PDFレンダリング用のワーカープロセスと、ジョブを処理するワーカーを起動しておく
+    render_pool.start()
+    job_queue.start()
+    # Geminiのライブラリを最初の解析を待たずにスレッドで読み込んでおく (preload していれば読み込み済み)
+    app.state.gemini_task = asyncio.create_task(load_gemini())
+    # 保存期間を過ぎた写真・ジョブ・診断を定期的に削除する (保存中の診断が参照している写真は残す)
+    app.state.retention_task = asyncio.create_task(retention_loop(
+        on_sweep=delete_expired_records, referenced=diagnosis_store.referenced_photos,
+    ))
+
+
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    # ジョブのワーカーとPDFレンダリング用のワーカープロセスを終了する
+    app.state.retention_task.cancel()
+    await job_queue.stop()
+    render_pool.shutdown()
+
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    """
+    リクエストの段階ごとの所要時間を記録し、Server-Timing ヘッダーとして返す。
+    同じ値を /metrics のヒストグラムにも加える。
+    """
+    timings = start_timings()
+    status = 500
+    HTTP_IN_FLIGHT.inc()
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        # パスではなくルートの定義 (/jobs/{job_id} など) で集計する
+        route = request.scope.get("route")
+        elapsed = time.perf_counter() - timings.started
+        HTTP_REQUEST_SECONDS.labels(request.method, route.path if route else "unmatched", str(status)).observe(elapsed)
+        observe_timings(timings)
+
+    timings.add("total", elapsed)
+    response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+
+@app.exception_handler(PhotoTooLarge)
+async def photo_too_large(request: Request, exc: PhotoTooLarge):
+    return JSONResponse(status_code=413, content={"message": str(exc)})
+
+
+@app.exception_handler(UnsupportedPhoto)
+async def unsupported_photo(request: Request, exc: UnsupportedPhoto):
+    return JSONResponse(status_code=415, content={"message": str(exc)})
+
+
+def pdf_response(pdf_bytes, filename, diagnosis_id=None):
+    """メモリ上のPDFを添付ファイルとして返すレスポンス (日本語のファイル名にも対応)"""
+    quoted = quote(filename)
+    if quoted != filename:
+        content_disposition = f"attachment; filename*=utf-8''{quoted}"
+    else:
+        content_disposition = f'attachment; filename="{filename}"'
+    headers = {"Content-Disposition": content_disposition}
+    if diagnosis_id:
+        # 保存した診断のID (GET /reports/{id} で作り直し、PATCH /reports/{id} で修正できる)
+        headers["X-Diagnosis-Id"] = diagnosis_id
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+
+
+async def render_pdf_response(diagnosis_result):
+    """診断結果をレンダリング用のプロセスプールでPDFにして返す (ディスクには保存しない)"""
+    try:
+        pdf_bytes = await render_pool.render(diagnosis_result)
+        return pdf_response(pdf_bytes, report_filename(diagnosis_result), diagnosis_result.get("diagnosis_id"))
+
+    except RenderQueueFull as e:
+        print(f"PDF rendering queue is full: {e}")
+        return JSONResponse(
+            status_code=503,
+            content={"message": "PDF生成の順番待ちが混み合っています。しばらくしてから再度お試しください。"},
+            headers={"Retry-After": str(render_pool.retry_after)},
+        )
+
+    except Exception as e:
+        print(f"Error during PDF generation: {e}")
+        return JSONResponse(status_code=500, content={"message": f"PDF生成中にエラーが発生しました: {e}"})
+
+
+# 診断結果の出力形式。json と html はPDFを作らずにすぐ返すプレビュー
+ReportFormat = Literal["pdf", "json", "html"]
+
+# 患者の情報を含むため共有キャッシュには保存させず、ブラウザには毎回ETagで確認させる
+REPORT_CACHE_CONTROL = "private, no-cache"
+
+
+def report_etag(diagnosis_result, format):
+    """入力 (フォームと写真) のハッシュ値と出力形式から作るETag"""
+    return f'"{diagnosis_result["input_digest"][:32]}.{format}"'
+
+
+def etag_matches(request, etag):
+    """If-None-Match が etag に一致するか (一致すれば本文を作らずに 304 を返せる)"""
+    header = request.headers.get("if-none-match", "")
+    return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in header.split(","))
+
+
+def analysis_html(analysis):
+    """AI画像解析の結果 (Markdown) をHTMLにする。Geminiの出力にHTMLが含まれていてもそのまま埋め込まない"""
+    return markdown.markdown(html.escape(analysis["analysis"], quote=False))
+
+
+def public_result(diagnosis_result):
+    """JSONで返す診断結果。写真はサーバー上のパス (photo_paths) ではなく、部位と内容のハッシュ値 (photos) で表す"""
+    result = {key: value for key, value in diagnosis_result.items() if key != "photo_paths"}
+    result["photos"] = [
+        {"view": photo["view"], "digest": Path(photo["path"]).stem} for photo in diagnosis_result.get("photo_paths", [])
+    ]
+    return result
+
+
+async def report_response(request, diagnosis_result, format="pdf"):
+    """診断結果を format (pdf・json・html) の形式で返す。ETagを付け、json と html はPDFを作らない"""
+    headers = {"ETag": report_etag(diagnosis_result, format), "Cache-Control": REPORT_CACHE_CONTROL}
+    if diagnosis_result.get("diagnosis_id"):
+        headers["X-Diagnosis-Id"] = diagnosis_result["diagnosis_id"]
+    if diagnosis_result.get("missing_photos"):
+        # 保存した診断の写真が失われている (ヘッダーには日本語を使えないため、部位の数だけ返す)
+        headers["X-Missing-Photos"] = str(len(diagnosis_result["missing_photos"]))
+
+    if format == "json":
+        return JSONResponse(content=public_result(diagnosis_result), headers=headers)
+    if format == "html":
+        return templates.TemplateResponse("report.html", {
+            "request": request,
+            "result": diagnosis_result,
+            "analyses": [
+                {**analysis, "html": None if analysis.get("findings") else analysis_html(analysis)}
+                for analysis in diagnosis_result.get("gemini_analyses", [])
+            ],
+        }, headers=headers)
+
+    response = await render_pdf_response(diagnosis_result)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
 
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
-    # index.htmlをレンダリングして返す
-    return templates.TemplateResponse("index.html", {"request": request})
+    # index.htmlをレンダリングして返す (写真はブラウザでサーバーの規格に合わせて縮小してから送信する)
+    return templates.TemplateResponse("index.html", {
+        "request": request,
+        "image_max_edge": IMAGE_MAX_EDGE,
+        "image_quality": IMAGE_QUALITY / 100,
+        "image_max_upload_bytes": IMAGE_MAX_UPLOAD_BYTES,
+    })
+
 
+@app.get("/cache/stats")
+async def cache_stats():
+    # 解析結果キャッシュのヒット・ミス・追い出し件数を返す (ワーカープロセスごとの値)
+    return {"pid": os.getpid(), "analysis_cache": analysis_cache.get_stats()}
 
-@app.post("/diagnose", response_class=FileResponse)
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus形式のメトリクス (gunicorn.conf.py で起動した場合は全ワーカーの合計)
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@photo_routes.post("/diagnose", response_class=FileResponse)
 async def diagnose(
-    # 患者基本情報
-    patient_name: str = Form(...),
-    patient_age: int = Form(...),
-    birth_date: str = Form(...),
-    gender: str = Form(...),
-    guardian_name: str = Form(...),
-    phone_number: str = Form(...),
-    email: str = Form(...),
-    chief_complaint: str = Form(...),
-    medical_history: str = Form(...),
-
-    # 問診項目
-    mouth_breathing: str = Form(...),
-    thumb_sucking: str = Form(...),
-    nail_biting: str = Form(...),
-    tongue_thrust: str = Form(...),
-    snoring: str = Form(...),
-    tonsil_swelling: str = Form(...),
-    allergic_rhinitis: str = Form(...),
-    eating_sounds: str = Form(...),
-    swallowing_pattern: str = Form(...),
-
-    # 口腔内検査項目
-    upper_jaw_condition: str = Form(...),
-    lower_jaw_condition: str = Form(...),
-    midline_deviation: float = Form(...),
-    crossbite: str = Form(...),
-    tongue_position: str = Form(...),
-    lip_closure: str = Form(...),
-    facial_appearance: str = Form(...),
-    tmd_symptoms: str = Form(...),
-    other_findings: str = Form(...),
-
-    # 口腔内写真アップロード
-    oral_photo_front: Optional[UploadFile] = File(None),
-    oral_photo_upper_occlusal: Optional[UploadFile] = File(None),
-    oral_photo_lower_occlusal: Optional[UploadFile] = File(None),
-    oral_photo_right_lateral: Optional[UploadFile] = File(None),
-    oral_photo_left_lateral: Optional[UploadFile] = File(None)
+    request: Request,
+    form: dict = Depends(diagnosis_form),
+    received_photos: list = Depends(uploaded_photos),
+    format: ReportFormat = "pdf",
 ):
     """
     フォームデータを受け取り、診断ロジックを実行し、
     結果をPDFレポートで返すエンドポイント。
+    ?format=json で診断結果をそのまま、?format=html でプレビュー用のHTMLを、PDFを作らずに返す。
     """
-    # 1. ダミーAI分析ロジック (一旦削除)
-    # 2. 診断ロジックの実装
-    # 2.1. スコア計算ロジック
-    # 筋機能評価スコア (MFS)
-    mfs_score = 0
-    mfs_items = [mouth_breathing, thumb_sucking, nail_biting, tongue_thrust, snoring, tonsil_swelling, allergic_rhinitis, eating_sounds, swallowing_pattern]
-    mfs_yes_items = []
-    for item_name, item_value in zip(["口呼吸", "指しゃぶり", "爪噛み", "舌癖", "いびき", "扁桃腺の腫れ", "アレルギー性鼻炎", "食事中の音", "嚥下パターン"], mfs_items):
-        if item_value == 'yes':
-            mfs_score += 1
-            mfs_yes_items.append(item_name)
-
-    # 歯列評価スコア (DAS)
-    das_score = 0
-    das_items = []
-    if upper_jaw_condition == 'crowding':
-        das_score += 3
-        das_items.append("上顎の叢生")
-    elif upper_jaw_condition == 'spacing':
-        das_score += 1
-        das_items.append("上顎の空隙歯列")
-
-    if lower_jaw_condition == 'crowding':
-        das_score += 3
-        das_items.append("下顎の叢生")
-    elif lower_jaw_condition == 'spacing':
-        das_score += 1
-        das_items.append("下顎の空隙歯列")
-
-    if midline_deviation >= 1.0:
-        das_score += 1
-        das_items.append(f"正中線のずれ ({midline_deviation}mm)")
-
-    if crossbite == 'yes':
-        das_score += 2
-        das_items.append("交叉咬合")
-
-    # 2.2. リスク判定ロジック
-    risk_level = "低リスク"
-    if mouth_breathing == 'yes' and tongue_thrust == 'yes' and (upper_jaw_condition == 'crowding' or lower_jaw_condition == 'crowding'):
-        risk_level = "高リスク"
-    elif mouth_breathing == 'yes' or tongue_thrust == 'yes':
-        risk_level = "中リスク"
-
-    # 2.3. アプライアンス選択ロジック
-    appliance_suggestion = "要相談"
-    if 6 <= patient_age <= 10 and upper_jaw_condition == 'crowding':
-        appliance_suggestion = "T4K"
-    elif 3 <= patient_age <= 5:
-        appliance_suggestion = "Myobrace for Juniors"
-    
-    # 仮の診断結果を作成
-    diagnosis_result = {
-        "patient_info": {
-            "name": patient_name,
-            "age": patient_age,
-        },
-        "analysis_summary": {
-            "risk_level": risk_level,
-            "appliance_suggestion": appliance_suggestion,
-            "mfs_score": mfs_score,
-            "das_score": das_score,
-            "mfs_yes_items": mfs_yes_items,
-            "das_items": das_items,
-            "comments": [f"MFSスコア: {mfs_score}/9", f"DASスコア: {das_score}/9"],
-        }
-    }
-    diagnosis_result['other_findings'] = other_findings
-    
-    # 2. アップロードされた写真の処理 (複数枚対応)
-    photo_paths = []
-    gemini_analyses = []
-    
-    # アップロードされた可能性のある全ての写真を確認
-    uploaded_photos = {
-        "正面観": oral_photo_front,
-        "上顎咬合面観": oral_photo_upper_occlusal,
-        "下顎咬合面観": oral_photo_lower_occlusal,
-        "右側方観": oral_photo_right_lateral,
-        "左側方観": oral_photo_left_lateral,
-    }
+    diagnosis_result = await run_diagnosis(form, received_photos)
 
-    for view_name, oral_photo in uploaded_photos.items():
-        if oral_photo and oral_photo.filename:
-            # 写真を保存
-            photo_path = UPLOAD_DIR / oral_photo.filename
-            with photo_path.open("wb") as buffer:
-                shutil.copyfileobj(oral_photo.file, buffer)
+    # 4. PDFレポートの生成 (レンダリング用のプロセスプールで実行し、ディスクに保存せずそのまま返す)
+    return await report_response(request, diagnosis_result, format)
 
-            # Gemini Vision APIによる画像解析
-            try:
-                img = Image.open(photo_path)
-                model = genai.GenerativeModel('models/gemini-1.5-flash')
-                prompt = f"""この{view_name}の口腔内写真について、歯科医の視点から詳細に分析してください。
-                分析結果はMarkdown形式で、箇条書きなどを用いて分かりやすく記述してください。"""
-                response = model.generate_content([prompt, img])
-                
-                gemini_analysis = response.text
-                gemini_analyses.append({"view": view_name, "analysis": gemini_analysis})
-                photo_paths.append({"view": view_name, "path": str(photo_path)})
 
-                print(f"Gemini AI Analysis for {view_name}: {gemini_analysis}")
+@photo_routes.post("/jobs", status_code=202)
+async def create_job(
+    request: Request,
+    form: dict = Depends(diagnosis_form),
+    received_photos: list = Depends(uploaded_photos),
+):
+    """
+    /diagnose と同じフォームを受け取り、レポート作成をジョブとして登録してすぐに返すエンドポイント。
+    進捗は GET /jobs/{job_id}、完成したPDFは GET /jobs/{job_id}/report.pdf で取得する。
+    """
+    # 順番待ちの間も写真をメモリに保持するため、ジョブが終わるまで受信の上限から差し引いておく
+    release = keep_photo_buffer(request)
+    try:
+        job_id = await job_queue.submit(form, received_photos, on_done=release)
+    except JobQueueFull as e:
+        release()
+        print(f"Job queue is full: {e}")
+        return JSONResponse(
+            status_code=503,
+            content={"message": "診断レポートの順番待ちが混み合っています。しばらくしてから再度お試しください。"},
+            headers={"Retry-After": str(render_pool.retry_after)},
+        )
+    return {
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}",
+        "report_url": f"/jobs/{job_id}/report.pdf",
+    }
 
-            except Exception as e:
-                print(f"Gemini Vision API呼び出し中にエラーが発生しました ({view_name}): {e}")
-                gemini_analyses.append({"view": view_name, "analysis": f"AI画像解析中にエラーが発生しました: {e}"})
 
-    diagnosis_result["gemini_analyses"] = gemini_analyses
-    diagnosis_result["photo_paths"] = photo_paths
+@photo_routes.post("/diagnose/stream")
+async def diagnose_stream(
+    request: Request,
+    form: dict = Depends(diagnosis_form),
+    received_photos: list = Depends(uploaded_photos),
+):
+    """
+    /diagnose と同じフォームを受け取り、進捗と各部位のAI解析結果を Server-Sent Events で順次返すエンドポイント。
+    イベントは job (ジョブID と段階の一覧)、stage (段階の状態)、chunk (解析結果の一部)、
+    report (PDFのURLと解析結果の全文)、error の順に送られる。
+    """
+    release = keep_photo_buffer(request)
+    return StreamingResponse(
+        stream_job(job_queue.store, form, received_photos, on_done=release),
+        media_type="text/event-stream",
+        # プロキシでまとめて送られないよう、キャッシュとバッファリングを無効にする
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # ジョブを始める前に接続が切れた場合も、レスポンスの後で写真の分を戻す
+        background=BackgroundTask(release),
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """ジョブの状態と、各段階 (アップロード・各写真の解析・PDF生成) の進捗を返す"""
+    job = await asyncio.to_thread(job_queue.store.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": "指定されたジョブが見つかりません。"})
+    job["report_url"] = f"/jobs/{job_id}/report.pdf" if job["status"] == "done" else None
+    return job
+
+
+@app.get("/jobs/{job_id}/report.pdf")
+async def get_job_report(job_id: str):
+    """完成したジョブのPDFレポートを返す"""
+    job = await asyncio.to_thread(job_queue.store.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": "指定されたジョブが見つかりません。"})
+    result = await asyncio.to_thread(job_queue.store.get_result, job_id)
+    if result is None:
+        return JSONResponse(status_code=409, content={"message": "診断レポートはまだ作成中です。", "status": job["status"]})
+    filename, pdf_bytes = result
+    return pdf_response(pdf_bytes, filename)
+
+
+@app.get("/reports")
+async def list_reports(
+    patient_name: Optional[str] = None,
+    birth_date: Optional[str] = None,
+    visit_date: Optional[str] = None,
+    limit: int = 50,
+):
+    """保存した診断を患者氏名・生年月日・受診日 (YYYY-MM-DD) で検索し、新しい順に返す"""
+    reports = await asyncio.to_thread(
+        diagnosis_store.find, limit, patient_name=patient_name, birth_date=birth_date, visit_date=visit_date
+    )
+    for report in reports:
+        report["report_url"] = f"/reports/{report['id']}"
+    return {"reports": reports}
 
 
-    # 4. PDFレポートの生成
+@app.get("/reports/{diagnosis_id}")
+async def get_report(request: Request, diagnosis_id: str, format: ReportFormat = "pdf"):
+    """
+    保存した診断からPDFレポートを作り直して返す (AI画像解析は呼び出さない)。
+    ?format=json・?format=html はPDFを作らずに返す。入力が変わっていなければ If-None-Match に 304 を返す。
+    """
+    record = await asyncio.to_thread(diagnosis_store.get, diagnosis_id)
+    if record is None:
+        return JSONResponse(status_code=404, content={"message": "指定された診断が見つかりません。"})
+    diagnosis_result = rebuild_diagnosis_result(record)
+    etag = report_etag(diagnosis_result, format)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REPORT_CACHE_CONTROL})
+    return await report_response(request, diagnosis_result, format)
+
+
+@app.patch("/reports/{diagnosis_id}")
+async def patch_report(diagnosis_id: str, changes: dict = Body(...)):
+    """
+    保存した診断のフォームの入力を修正する (例: {"guardian_name": "山田 花子"})。
+    送られた項目だけを変更してスコアを計算し直し、AI画像解析の結果はそのまま使う。
+    """
     try:
-        pdf_filename = f"diagnosis_report_{patient_name}_{patient_age}.pdf"
-        pdf_path = UPLOAD_DIR / pdf_filename
-        
-        c = canvas.Canvas(str(pdf_path), pagesize=letter)
-        
-        # ==================================================================
-        # 術者向けAI診断サマリー (1ページ目)
-        # ==================================================================
-        create_summary_page(c, diagnosis_result)
-
-        # ==================================================================
-        # 保護者向けカウンセリングレポート (2ページ目以降)
-        # ==================================================================
-        c.showPage() # 改ページ
-        create_counseling_report_page(c, diagnosis_result, photo_paths, gemini_analyses)
-
-        c.save()
-
-        return FileResponse(path=pdf_path, media_type="application/pdf", filename=pdf_filename)
+        record = await asyncio.to_thread(update_diagnosis, diagnosis_id, changes)
+    except ValueError as e:
+        return JSONResponse(status_code=422, content={"message": str(e)})
+    if record is None:
+        return JSONResponse(status_code=404, content={"message": "指定された診断が見つかりません。"})
+    return {
+        "id": diagnosis_id,
+        "changed": record["changed"],
+        "form": record["form"],
+        "analysis_summary": record["scores"],
+        "report_url": f"/reports/{diagnosis_id}",
+    }
+
 
+@app.post("/batch")
+async def batch_diagnose(
+    rows: UploadFile = File(...),
+    photos: Optional[UploadFile] = File(None),
+):
+    """
+    患者データ (CSV/JSONL、列は /diagnose のフォーム項目と同じ) と、任意で写真のZIPアーカイブを受け取り、
+    診断レポートを一括で作成するエンドポイント。完成したPDFから順にZIPとしてストリーミングで返す。
+    写真は「<患者キー>_<部位>.jpg」または「<患者キー>/<部位>.jpg」の名前でZIPに含める。
+    """
+    try:
+        patient_rows = read_rows(await rows.read(), rows.filename or "")
+        photo_archive = None
+        if photos and photos.filename:
+            # アップロードされたファイルはレスポンスの送信前に閉じられるため、一時ファイルに移しておく
+            archive_file = tempfile.TemporaryFile()
+            await asyncio.to_thread(shutil.copyfileobj, photos.file, archive_file)
+            photo_archive = PhotoArchive(archive_file)
     except Exception as e:
-        print(f"Error during PDF generation: {e}")
-        return JSONResponse(status_code=500, content={"message": f"PDF生成中にエラーが発生しました: {e}"})
+        return JSONResponse(status_code=400, content={"message": f"一括診断のデータを読み込めませんでした: {e}"})
 
-def create_summary_page(c, diagnosis_result):
-    """術者向けAI診断サマリーページを作成する"""
-    width, height = letter
-    styles = getSampleStyleSheet()
-    
-    # スタイルの設定
-    styleH1 = ParagraphStyle(name='H1', fontName='IPAexGothic', fontSize=16, leading=22, alignment=TA_CENTER)
-    styleH2 = ParagraphStyle(name='H2', fontName='IPAexGothic', fontSize=12, leading=18)
-    styleT = ParagraphStyle(name='Table', fontName='IPAexGothic', fontSize=10, leading=14)
-    styleBody = ParagraphStyle(name='Body', fontName='IPAexGothic', fontSize=10, leading=14)
-
-    # タイトル
-    p = Paragraph("術者向けAI診断サマリー", styleH1)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, height - 1 * inch)
-
-    # 患者情報テーブル
-    patient_info = diagnosis_result['patient_info']
-    summary_data = diagnosis_result['analysis_summary']
-    
-    data = [
-        [Paragraph('<b>患者氏名</b>', styleT), Paragraph(patient_info['name'], styleT), Paragraph('<b>年齢</b>', styleT), Paragraph(str(patient_info['age']), styleT)],
-        [Paragraph('<b>リスク判定</b>', styleT), Paragraph(f'<b>{summary_data["risk_level"]}</b>', styleT), Paragraph('<b>推奨アプライアンス</b>', styleT), Paragraph(summary_data["appliance_suggestion"], styleT)],
-        [Paragraph('<b>筋機能評価スコア (MFS)</b>', styleT), Paragraph(f'<b>{summary_data["mfs_score"]} / 9</b>', styleT), Paragraph('<b>歯列評価スコア (DAS)</b>', styleT), Paragraph(f'<b>{summary_data["das_score"]} / 9</b>', styleT)],
-    ]
-    
-    table = Table(data, colWidths=[1.5*inch, 2*inch, 1.7*inch, 2.3*inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
-        ('BACKGROUND', (2, 0), (2, -1), colors.lightgrey),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 5),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 5),
-    ]))
-    
-    table.wrapOn(c, width - 2 * inch, height)
-    table.drawOn(c, 1 * inch, height - 2.5 * inch)
-
-    # AIによる口腔内写真の客観的所見
-    y_pos = height - 3.5 * inch
-    p = Paragraph("<b>【AIによる口腔内写真の客観的所見】</b>", styleH2)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos)
-    y_pos -= 0.4 * inch
-    
-    gemini_analyses = diagnosis_result.get("gemini_analyses", [])
-    if gemini_analyses:
-        for analysis in gemini_analyses:
-            # MarkdownをHTMLに変換してParagraphで描画
-            html_text = markdown.markdown(f"<b>{analysis['view']}:</b> {analysis['analysis']}")
-            p = Paragraph(html_text, styleBody)
-            p_height = p.wrap(width - 2.2 * inch, height)[1]
-            if y_pos - p_height < 1 * inch:
-                c.showPage()
-                y_pos = height - 1 * inch
-            p.drawOn(c, 1.1 * inch, y_pos - p_height)
-            y_pos -= p_height + 10
-    else:
-        p = Paragraph("口腔内写真の解析結果はありません。", styleBody)
-        p.wrapOn(c, width - 2.2 * inch, height)
-        p.drawOn(c, 1.1 * inch, y_pos - 0.2 * inch)
-        y_pos -= 0.4 * inch
-
-    # 特記事項
-    y_pos -= 0.4 * inch
-    p = Paragraph("<b>【特記事項】</b>", styleH2)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos)
-    y_pos -= 0.4 * inch
-
-    # (MFSとDASの詳細項目などをここに記載)
-    p = Paragraph(f"<b>MFS項目 ({summary_data['mfs_score']}点):</b> {', '.join(summary_data['mfs_yes_items'])}", styleBody)
-    p.wrapOn(c, width - 2.2 * inch, height)
-    p.drawOn(c, 1.1 * inch, y_pos - p.height)
-    y_pos -= p.height + 10
-
-    p = Paragraph(f"<b>DAS項目 ({summary_data['das_score']}点):</b> {', '.join(summary_data['das_items'])}", styleBody)
-    p.wrapOn(c, width - 2.2 * inch, height)
-    p.drawOn(c, 1.1 * inch, y_pos - p.height)
-    y_pos -= p.height + 10
-    
-    # その他所見
-    if diagnosis_result.get('other_findings'):
-        p = Paragraph(f"<b>その他口腔内所見:</b> {diagnosis_result['other_findings']}", styleBody)
-        p.wrapOn(c, width - 2.2 * inch, height)
-        p.drawOn(c, 1.1 * inch, y_pos - p.height)
-
-def create_counseling_report_page(c, diagnosis_result, photo_paths, gemini_analyses):
-    """保護者向けカウンセリングレポートページを作成する"""
-    width, height = letter
-    styles = getSampleStyleSheet()
-    
-    # スタイルの設定
-    styleH1 = ParagraphStyle(name='H1', fontName='IPAexGothic', fontSize=18, leading=24, alignment=TA_CENTER, spaceAfter=20)
-    styleH2 = ParagraphStyle(name='H2', fontName='IPAexGothic', fontSize=14, leading=18, spaceBefore=15, spaceAfter=10)
-    styleBody = ParagraphStyle(name='Body', fontName='IPAexGothic', fontSize=11, leading=16)
-    
-    patient_name = diagnosis_result['patient_info']['name']
-    summary_data = diagnosis_result['analysis_summary']
-    mfs_score = summary_data['mfs_score']
-
-    # 掴み
-    p = Paragraph(f"<b>{patient_name}くん・ちゃんの健やかな成長のために</b><br/><b>大切なお口のお話</b>", styleH1)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, height - 1.5 * inch)
-
-    y_pos = height - 2.5 * inch
-
-    # 現状の説明
-    p = Paragraph("<b>【いま、お口の中で起きていること】</b>", styleH2)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos)
-    y_pos -= p.height + 10
-
-    p = Paragraph(f"お口の悪い癖が、<b>{mfs_score}個</b>も見つかりました。<br/>このままだと、将来の歯並びだけでなく、健康にも影響が出てしまうかもしれません。", styleBody)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos - p.height)
-    y_pos -= p.height + 20
-    
-    # (口腔内写真とAIの指摘を表示するロジック)
-    # ここでは最初の写真と解析結果を表示する例
-    if photo_paths and gemini_analyses:
-        photo_info = photo_paths[0]
-        analysis_info = gemini_analyses[0]
-        
-        try:
-            # 画像を描画
-            img_path = photo_info['path']
-            img = ImageReader(img_path)
-            img_width, img_height = img.getSize()
-            aspect = img_height / float(img_width)
-            draw_width = 3 * inch
-            draw_height = draw_width * aspect
-            c.drawImage(img, 1.5 * inch, y_pos - draw_height, width=draw_width, height=draw_height)
-            y_pos -= draw_height + 10
-
-            # AIの分析結果を描画
-            p = Paragraph(f"AI（人工知能）の分析でも、<b>この部分</b>（写真参照）が、将来問題になる可能性があると指摘されています。", styleBody)
-            p.wrapOn(c, width - 2 * inch, height)
-            p.drawOn(c, 1 * inch, y_pos - p.height)
-            y_pos -= p.height + 20
-
-        except Exception as e:
-            print(f"Error embedding counseling image: {e}")
-
-
-    # 原因の説明
-    p = Paragraph("<b>【なぜ、そうなってしまったの？】</b>", styleH2)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos - p.height)
-    y_pos -= p.height + 10
-
-    p = Paragraph("実は、これらの問題の根本的な原因は、<b>「口呼吸」</b>や<b>「舌の悪い癖」</b>にあるのです。<br/>（ここに口呼吸や舌癖を説明するイラストを挿入）", styleBody)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos - p.height)
-    y_pos -= p.height + 20
-
-    # 解決策の提示
-    appliance = summary_data['appliance_suggestion']
-    p = Paragraph("<b>【未来のための解決策があります】</b>", styleH2)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos - p.height)
-    y_pos -= p.height + 10
-
-    p = Paragraph(f"そこで、当院では<b>「MRC治療」</b>をお勧めしています。<br/>これは、<b>「{appliance}」</b>という、柔らかいマウスピース型の装置を使って、お口の悪い癖を治し、あごの成長を助け、歯並びを自然に整える、世界中で行われている治療法です。", styleBody)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos - p.height)
-    y_pos -= p.height + 20
-
-    # 未来の提示 & クロージング
-    p = Paragraph("<b>【MRC治療で得られる素晴らしい未来】</b>", styleH2)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos - p.height)
-    y_pos -= p.height + 10
-    
-    p = Paragraph("<b>綺麗な歯並び</b>と、<b>健康的な体</b>を手に入れることができます。<br/>正しい呼吸は、集中力アップや、運動能力の向上にも繋がります。<br/><br/>より詳しいお話にご興味があれば、ぜひ一度ご相談ください。<br/>専門のスタッフが、丁寧にご説明させていただきます。", styleBody)
-    p.wrapOn(c, width - 2 * inch, height)
-    p.drawOn(c, 1 * inch, y_pos - p.height)
\ No newline at end of file
+    return StreamingResponse(
+        stream_batch_zip(patient_rows, photo_archive),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="diagnosis_reports.zip"'},
+    )
+
+
+app.include_router(photo_routes)
@@ -0,0 +1,47 @@
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+
+# gunicorn の複数ワーカーで集計するには、起動前に PROMETHEUS_MULTIPROC_DIR を設定する (gunicorn.conf.py を参照)
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# Gemini の応答待ちは数十秒かかることがあるため、既定より長い区間まで用意する
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTPリクエストの処理時間", ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "処理中のHTTPリクエスト数", multiprocess_mode="livesum")
+STAGE_SECONDS = Histogram(
+    "diagnosis_stage_seconds", "診断の段階ごとの所要時間 (Server-Timing と同じ段階名)", ["stage"], buckets=LATENCY_BUCKETS,
+)
+GEMINI_IN_FLIGHT = Gauge("gemini_requests_in_flight", "応答待ちのGemini API呼び出し数", multiprocess_mode="livesum")
+GEMINI_ERRORS = Counter("gemini_errors_total", "Gemini APIによる解析の失敗数", ["view", "error"])
+GEMINI_RETRIES = Counter("gemini_retries_total", "Gemini API呼び出しの再試行数", ["error"])
+GEMINI_HEDGES = Counter("gemini_hedged_requests_total", "ヘッジしたGemini API呼び出しの数 (先に応答した方)", ["winner"])
+GEMINI_TOKENS = Counter("gemini_tokens_total", "Gemini APIが数えたトークン数 (prompt: 入力, output: 出力)", ["kind"])
+GEMINI_CIRCUIT_OPENS = Counter("gemini_circuit_opens_total", "サーキットブレーカーがGemini APIの呼び出しを止めた回数")
+PDF_RENDERS_IN_FLIGHT = Gauge("pdf_renders_in_flight", "処理中または順番待ちのPDFレンダリング数", multiprocess_mode="livesum")
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "diagnosis_single_flight_total",
+    "同じ入力の診断のまとめ (leader: 解析を実行, follower: 結果を共有, fallback: 結果を読めず再実行)", ["role"],
+)
+IMAGE_BYTES = Counter("image_bytes_total", "受け取った写真のバイト数 (規格化の前後)", ["stage"])
+
+
+def observe_timings(timings):
+    """記録した段階ごとの所要時間をヒストグラムに加える"""
+    for name, seconds in timings.spans:
+        STAGE_SECONDS.labels(name).observe(seconds)
+
+
+def render_metrics():
+    """Prometheus形式のメトリクスと Content-Type を返す (マルチプロセスモードでは全ワーカーの合計)"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
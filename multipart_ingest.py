@@ -0,0 +1,271 @@
+"""
+写真のアップロードをストリーミングで受信する。
+Starletteの標準のフォーム解析は、本文を最後まで受信し、写真を一時ファイル (1MBを超えるとディスク) に書き出してから返す。
+そのため大きすぎる写真や画像でないファイルも全て受信してから拒否することになり、写真を何度も読み書きする。
+ここでは届いた部分ごとにサイズの上限を確認し、写真の内容のハッシュ値を計算し、先頭のバイト列で画像形式を判定する。
+写真はメモリ上に保持したまま規格化・解析に渡す (プロセス全体で保持する量には上限を設ける)。
+"""
+import hashlib
+import io
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.datastructures import FormData, Headers, UploadFile
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart 0.0.13 より前
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from diagnosis import PHOTO_VIEWS, PhotoTooLarge, UnsupportedPhoto
+from image_ingest import (
+    IMAGE_MAX_BUFFERED_BYTES, IMAGE_MAX_REQUEST_BYTES, IMAGE_MAX_UPLOAD_BYTES, IMAGE_SNIFF_BYTES, sniff_image_format,
+)
+
+# 写真以外の項目1つあたりの受信サイズの上限 (バイト)
+FORM_FIELD_MAX_BYTES = 64 * 1024
+
+
+class UploadBusy(Exception):
+    """受信中の写真がプロセス全体の上限 (IMAGE_MAX_BUFFERED_BYTES) に達した"""
+
+
+class BufferBudget:
+    """
+    プロセス全体でメモリ上に保持している写真のバイト数。
+    パーサーの呼び出しは全てイベントループのスレッドで行われるため、ロックは使わない。
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def take(self, size):
+        if self.used + size > self.limit:
+            raise UploadBusy("写真の受信が混み合っています。しばらくしてから再度お試しください。")
+        self.used += size
+
+    def give_back(self, size):
+        self.used -= size
+
+
+buffer_budget = BufferBudget(IMAGE_MAX_BUFFERED_BYTES)
+
+
+class MemoryUploadFile(UploadFile):
+    """受信した写真。data に検査済みのバイト列、digest に受信中に計算したハッシュ値 (sha256 の16進数) を持つ"""
+
+    def __init__(self, buffer, filename, headers, digest, image_format):
+        # getvalue() は書き込み済みのバッファをコピーせずに bytes として返す
+        self.data = buffer.getvalue()
+        buffer.seek(0)
+        super().__init__(buffer, size=len(self.data), filename=filename, headers=headers)
+        self.digest = digest
+        self.image_format = image_format
+
+
+class FormPart:
+    """受信中のフォームの項目"""
+
+    def __init__(self):
+        self.headers = []
+        self.name = ""
+        self.filename = None
+        # 受信した内容。リストに溜めて最後に連結すると一時的に2倍のメモリを使うため、1つのバッファに書き込む
+        self.buffer = io.BytesIO()
+        # 画像形式の判定に使う先頭のバイト列
+        self.head = b""
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.image_format = None
+
+
+def too_large_message(name, limit):
+    view_name = PHOTO_VIEWS.get(name, name)
+    return f"{view_name}の写真が大きすぎます。{limit // 1024 ** 2}MB以下にしてください。"
+
+
+def request_too_large(limit):
+    return PhotoTooLarge(f"送信された写真の合計が大きすぎます。合計 {limit // 1024 ** 2}MB以下にしてください。")
+
+
+class PhotoFormParser:
+    """
+    multipart/form-data の本文を届いた部分ごとに解析する。
+    写真が1枚あたり max_photo_bytes を、本文全体が max_request_bytes を超えた時点で PhotoTooLarge を、
+    写真の先頭のバイト列が画像でなければその時点で UnsupportedPhoto を送出する (残りは受信しない)。
+    """
+
+    def __init__(
+        self, headers, max_request_bytes=IMAGE_MAX_REQUEST_BYTES, max_photo_bytes=IMAGE_MAX_UPLOAD_BYTES, budget=None,
+    ):
+        self.headers = headers
+        self.max_request_bytes = max_request_bytes
+        self.max_photo_bytes = max_photo_bytes
+        # budget を渡すと、保持する写真のバイト数をプロセス全体の上限から差し引く (release() で戻す)
+        self.budget = budget
+        self.buffered = 0
+        # keep() を呼ぶと、リクエストの処理が終わっても戻さず、返された release を呼ぶまで保持する
+        self.kept = False
+        self.items = []
+        self._part = None
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_part_begin(self):
+        self._part = FormPart()
+
+    def on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._part.headers.append((self._header_name.lower(), self._header_value))
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        part = self._part
+        disposition = dict(part.headers).get(b"content-disposition", b"")
+        _, options = parse_options_header(disposition)
+        if b"name" not in options:
+            raise ValueError('Content-Disposition に "name" がありません')
+        part.name = options[b"name"].decode("utf-8", errors="replace")
+        if b"filename" in options:
+            part.filename = options[b"filename"].decode("utf-8", errors="replace")
+
+    def on_part_data(self, data, start, end):
+        part = self._part
+        chunk = memoryview(data)[start:end]
+        part.size += len(chunk)
+        if part.filename is None:
+            if part.size > FORM_FIELD_MAX_BYTES:
+                raise ValueError(f"{part.name} の値が長すぎます")
+            part.buffer.write(chunk)
+            return
+        if part.size > self.max_photo_bytes:
+            raise PhotoTooLarge(too_large_message(part.name, self.max_photo_bytes))
+        if self.budget is not None:
+            self.budget.take(len(chunk))
+            self.buffered += len(chunk)
+        part.buffer.write(chunk)
+        part.sha256.update(chunk)
+        if part.image_format is None:
+            part.head += chunk[:IMAGE_SNIFF_BYTES - len(part.head)]
+            if len(part.head) >= IMAGE_SNIFF_BYTES:
+                self.sniff(part)
+
+    def on_part_end(self):
+        part = self._part
+        if part.filename is None:
+            self.items.append((part.name, part.buffer.getvalue().decode("utf-8", errors="replace")))
+            return
+        if part.size and part.image_format is None:
+            # 判定に必要なバイト数より小さいファイル
+            self.sniff(part)
+        self.items.append((part.name, MemoryUploadFile(
+            part.buffer, part.filename, Headers(raw=part.headers), part.sha256.hexdigest() if part.size else None,
+            part.image_format,
+        )))
+
+    def release(self):
+        """プロセス全体の上限から差し引いた分を戻す (リクエストの処理が終わったとき)"""
+        if self.budget is not None:
+            self.budget.give_back(self.buffered)
+            self.buffered = 0
+
+    def keep(self):
+        """レスポンスを返した後も写真を使う場合に呼び出し、使い終わったときに呼ぶ release を返す"""
+        self.kept = True
+        return self.release
+
+    def sniff(self, part):
+        part.image_format = sniff_image_format(part.head)
+        if part.image_format is None:
+            view_name = PHOTO_VIEWS.get(part.name, part.name)
+            raise UnsupportedPhoto(f"{view_name}のファイルは画像ではありません。JPEG・PNG・HEICなどの写真を選択してください。")
+
+    async def parse(self, stream):
+        """本文のストリームを解析して FormData を返す"""
+        _, params = parse_options_header(self.headers["content-type"])
+        if b"boundary" not in params:
+            raise ValueError("multipart の boundary がありません")
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        received = 0
+        async for chunk in stream:
+            received += len(chunk)
+            if received > self.max_request_bytes:
+                raise request_too_large(self.max_request_bytes)
+            parser.write(chunk)
+        parser.finalize()
+        return FormData(self.items)
+
+
+class PhotoUploadRequest(Request):
+    """multipart/form-data のフォームを PhotoFormParser で解析するリクエスト"""
+
+    _photo_form = None
+    photo_parser = None
+
+    async def form(self, **kwargs):
+        if not self.headers.get("content-type", "").startswith("multipart/form-data"):
+            return await super().form(**kwargs)
+        if self._photo_form is None:
+            self.photo_parser = PhotoFormParser(self.headers, budget=buffer_budget)
+            self._photo_form = await self.photo_parser.parse(self.stream())
+        return self._photo_form
+
+
+class PhotoUploadRoute(APIRoute):
+    """
+    写真を受け取るエンドポイントのルート。エンドポイントの依存関数を解決する前に、フォームをストリーミングで受信する。
+    (FastAPI はフォームの解析中の例外を 400 にするため、先に受信して 413・415 を返せるようにする)
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def photo_upload_handler(request):
+            request = PhotoUploadRequest(request.scope, request.receive)
+            # Content-Length で上限を超えることが分かれば、本文を受信せずに拒否する
+            content_length = request.headers.get("content-length", "")
+            if content_length.isdigit() and int(content_length) > IMAGE_MAX_REQUEST_BYTES:
+                raise request_too_large(IMAGE_MAX_REQUEST_BYTES)
+            try:
+                try:
+                    await request.form()
+                except (PhotoTooLarge, UnsupportedPhoto):
+                    raise
+                except UploadBusy as e:
+                    return JSONResponse(status_code=503, content={"message": str(e)}, headers={"Retry-After": "1"})
+                except Exception as e:
+                    return JSONResponse(status_code=400, content={"message": f"フォームを読み込めませんでした: {e}"})
+                return await handler(request)
+            finally:
+                # ジョブ・ストリーミングで写真を使い続ける場合は、使い終わったときに戻す (keep_photo_buffer)
+                if request.photo_parser is not None and not request.photo_parser.kept:
+                    request.photo_parser.release()
+
+        return photo_upload_handler
+
+
+def keep_photo_buffer(request):
+    """
+    受信した写真をレスポンスの後も使うエンドポイント (ジョブの登録・ストリーミング) で呼び出す。
+    保持している写真のバイト数は、返された関数を呼ぶまでプロセス全体の上限から差し引いたままにする。
+    """
+    parser = getattr(request, "photo_parser", None)
+    if parser is None:
+        return lambda: None
+    return parser.keep()
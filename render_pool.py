@@ -0,0 +1,106 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import PDF_RENDERS_IN_FLIGHT
+from report import render_report_pdf_timed, warm_up
+from timing import current_timings, span
+
+# PDFレンダリング用のワーカープロセス数 (0 の場合はスレッドで実行する)
+PDF_POOL_SIZE = int(os.getenv("PDF_POOL_SIZE", "2"))
+# 実行中のものに加えて順番待ちできるレンダリングの件数
+PDF_QUEUE_DEPTH = int(os.getenv("PDF_QUEUE_DEPTH", "8"))
+# 順番待ちが一杯のときにクライアントへ返す Retry-After (秒)
+PDF_RETRY_AFTER = int(os.getenv("PDF_RETRY_AFTER", "5"))
+
+
+class RenderQueueFull(Exception):
+    """PDFレンダリングの順番待ちが上限に達したときに送出される"""
+
+
+class RenderPool:
+    """
+    PDFレンダリングを専用のプロセスプールで実行する。
+    イベントループを止めずに、複数コアでレポートを並行して生成できる。
+    """
+
+    def __init__(self, pool_size=PDF_POOL_SIZE, queue_depth=PDF_QUEUE_DEPTH, retry_after=PDF_RETRY_AFTER):
+        self.pool_size = pool_size
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._executor = None
+        # レンダリング中の診断 (診断ID, 入力のハッシュ値) -> タスク
+        self._shared = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            # gRPCなどのスレッドを抱えた親プロセスを fork しないよう spawn で起動する
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.pool_size,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def start(self):
+        """ワーカープロセスを事前に起動し、最初のリクエストで起動待ちが発生しないようにする"""
+        if self.pool_size > 0:
+            executor = self._get_executor()
+            for _ in range(self.pool_size):
+                executor.submit(warm_up)
+
+    async def render(self, diagnosis_result):
+        """
+        診断結果をPDFのバイト列にレンダリングする。
+        同じ診断 (まとめられた同じ入力のリクエストなど) を同時にレンダリングする場合は、1回のレンダリングの結果を共有する。
+        """
+        key = (diagnosis_result.get("diagnosis_id"), diagnosis_result.get("input_digest"))
+        if None in key:
+            return await self._render(diagnosis_result)
+        task = self._shared.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._render(diagnosis_result))
+            self._shared[key] = task
+            task.add_done_callback(lambda _: self._shared.pop(key, None))
+        # 待っているリクエストの1つが切断されても、共有しているレンダリングは止めない
+        return await asyncio.shield(task)
+
+    async def _render(self, diagnosis_result):
+        if self.in_flight >= max(1, self.pool_size) + self.queue_depth:
+            raise RenderQueueFull(f"{self.in_flight}件のレンダリングが処理中または順番待ちです")
+
+        self.in_flight += 1
+        PDF_RENDERS_IN_FLIGHT.inc()
+        try:
+            with span("pdf"):
+                if self.pool_size <= 0:
+                    pdf_bytes, spans = await asyncio.to_thread(render_report_pdf_timed, diagnosis_result)
+                else:
+                    loop = asyncio.get_running_loop()
+                    try:
+                        pdf_bytes, spans = await loop.run_in_executor(
+                            self._get_executor(), render_report_pdf_timed, diagnosis_result
+                        )
+                    except BrokenProcessPool:
+                        # ワーカーが異常終了した場合は次回の呼び出しでプールを作り直す
+                        self._executor = None
+                        raise
+        finally:
+            self.in_flight -= 1
+            PDF_RENDERS_IN_FLIGHT.dec()
+
+        # ワーカー内で計測したページごとの所要時間を、呼び出し元の記録に加える
+        timings = current_timings()
+        if timings is not None:
+            timings.extend(spans)
+        return pdf_bytes
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+render_pool = RenderPool()
@@ -0,0 +1,402 @@
+import io
+import os
+import tempfile
+import threading
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+# reportlab のインポート
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+from reportlab.lib.units import inch
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import Paragraph, Table, TableStyle
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib import colors
+import markdown
+from PIL import Image, ImageOps
+
+from timing import span, start_timings
+
+# このファイルの場所を基準に絶対パスを構築
+BASE_DIR = Path(__file__).resolve().parent
+
+# 日本語フォント
+FONT_PATH = Path(BASE_DIR, "fonts", "ipaexg.ttf")
+_fonts_lock = threading.Lock()
+_fonts_registered = False
+
+# PDFに載せる写真の解像度 (印刷時の1インチあたりのピクセル数)。写真は載せる大きさに合わせて縮小してから埋め込む
+REPORT_IMAGE_DPI = int(os.getenv("REPORT_IMAGE_DPI", "150"))
+REPORT_IMAGE_QUALITY = int(os.getenv("REPORT_IMAGE_QUALITY", "85"))
+# カウンセリングレポートの写真の幅 (ギャラリーは2列)
+PHOTO_WIDTH = 3 * inch
+
+
+def register_fonts():
+    """日本語フォントを登録する。TTFの解析に時間がかかるため、最初のレポート作成時に1度だけ行う"""
+    global _fonts_registered
+    with _fonts_lock:
+        if _fonts_registered:
+            return
+        if FONT_PATH.exists():
+            pdfmetrics.registerFont(TTFont('IPAexGothic', str(FONT_PATH)))
+            pdfmetrics.registerFontFamily('IPAexGothic', normal='IPAexGothic', bold='IPAexGothic', italic='IPAexGothic', boldItalic='IPAexGothic')
+        else:
+            print(f"Warning: Japanese font not found at {FONT_PATH}. Please place IPAexGothic.ttf in the 'fonts' directory.")
+        _fonts_registered = True
+
+
+class ReportTemplate:
+    """
+    レポートのスタイルと、患者によって変わらない段落をまとめたもの。
+    固定の段落は作成時にレイアウト (wrap) 済みなので、描画時は drawOn するだけでよい。
+    """
+
+    def __init__(self):
+        width, height = letter
+
+        # 術者向けAI診断サマリーのスタイル
+        self.summary_h1 = ParagraphStyle(name='H1', fontName='IPAexGothic', fontSize=16, leading=22, alignment=TA_CENTER)
+        self.summary_h2 = ParagraphStyle(name='H2', fontName='IPAexGothic', fontSize=12, leading=18)
+        self.summary_table = ParagraphStyle(name='Table', fontName='IPAexGothic', fontSize=10, leading=14)
+        self.summary_body = ParagraphStyle(name='Body', fontName='IPAexGothic', fontSize=10, leading=14)
+
+        # 保護者向けカウンセリングレポートのスタイル
+        self.counseling_h1 = ParagraphStyle(name='H1', fontName='IPAexGothic', fontSize=18, leading=24, alignment=TA_CENTER, spaceAfter=20)
+        self.counseling_h2 = ParagraphStyle(name='H2', fontName='IPAexGothic', fontSize=14, leading=18, spaceBefore=15, spaceAfter=10)
+        self.counseling_body = ParagraphStyle(name='Body', fontName='IPAexGothic', fontSize=11, leading=16)
+
+        # Markdownの変換器 (拡張機能の読み込みなどの初期化を1度だけ行う)
+        self.markdown = markdown.Markdown()
+
+        def prewrapped(text, style, avail_width):
+            p = Paragraph(text, style)
+            p.wrap(avail_width, height)
+            return p
+
+        # 術者向けAI診断サマリーの固定の段落
+        self.summary_title = prewrapped("術者向けAI診断サマリー", self.summary_h1, width - 2 * inch)
+        self.summary_table_labels = [
+            [Paragraph('<b>患者氏名</b>', self.summary_table), Paragraph('<b>年齢</b>', self.summary_table)],
+            [Paragraph('<b>リスク判定</b>', self.summary_table), Paragraph('<b>推奨アプライアンス</b>', self.summary_table)],
+            [Paragraph('<b>筋機能評価スコア (MFS)</b>', self.summary_table), Paragraph('<b>歯列評価スコア (DAS)</b>', self.summary_table)],
+        ]
+        self.summary_findings_heading = prewrapped("<b>【AIによる口腔内写真の客観的所見】</b>", self.summary_h2, width - 2 * inch)
+        self.summary_no_findings = prewrapped("口腔内写真の解析結果はありません。", self.summary_body, width - 2.2 * inch)
+        self.summary_notes_heading = prewrapped("<b>【特記事項】</b>", self.summary_h2, width - 2 * inch)
+
+        # 保護者向けカウンセリングレポートの固定の段落
+        self.counseling_current_heading = prewrapped("<b>【いま、お口の中で起きていること】</b>", self.counseling_h2, width - 2 * inch)
+        self.counseling_ai_comment = prewrapped("AI（人工知能）の分析でも、<b>この部分</b>（写真参照）が、将来問題になる可能性があると指摘されています。", self.counseling_body, width - 2 * inch)
+        self.counseling_cause_heading = prewrapped("<b>【なぜ、そうなってしまったの？】</b>", self.counseling_h2, width - 2 * inch)
+        self.counseling_cause_body = prewrapped("実は、これらの問題の根本的な原因は、<b>「口呼吸」</b>や<b>「舌の悪い癖」</b>にあるのです。<br/>（ここに口呼吸や舌癖を説明するイラストを挿入）", self.counseling_body, width - 2 * inch)
+        self.counseling_solution_heading = prewrapped("<b>【未来のための解決策があります】</b>", self.counseling_h2, width - 2 * inch)
+        self.counseling_future_heading = prewrapped("<b>【MRC治療で得られる素晴らしい未来】</b>", self.counseling_h2, width - 2 * inch)
+        self.gallery_heading = prewrapped("<b>【お口の中の写真】</b>", self.counseling_h2, width - 2 * inch)
+        self.gallery_caption = self.counseling_body
+        self.counseling_future_body = prewrapped("<b>綺麗な歯並び</b>と、<b>健康的な体</b>を手に入れることができます。<br/>正しい呼吸は、集中力アップや、運動能力の向上にも繋がります。<br/><br/>より詳しいお話にご興味があれば、ぜひ一度ご相談ください。<br/>専門のスタッフが、丁寧にご説明させていただきます。", self.counseling_body, width - 2 * inch)
+
+
+# 段落は描画中に状態を持つため、スレッドごとに1つずつ作成して使い回す
+_template_cache = threading.local()
+
+
+def report_template():
+    """このスレッド用の ReportTemplate を返す (初回のみ作成する)"""
+    template = getattr(_template_cache, "template", None)
+    if template is None:
+        register_fonts()
+        template = _template_cache.template = ReportTemplate()
+    return template
+
+
+def clear_report_template_cache():
+    """キャッシュした ReportTemplate を破棄する (ベンチマークやフォント変更時に使う)"""
+    _template_cache.__dict__.pop("template", None)
+
+
+def warm_up():
+    """
+    レンダリング用のワーカープロセスの起動時に呼び出し、フォントとテンプレートを準備しておく。
+    (このモジュールだけを読み込ませるため、ここに置いている)
+    """
+    report_template()
+    return os.getpid()
+
+
+def print_image(path, width, dpi=None):
+    """
+    写真を幅 width (ポイント) で印刷する解像度に縮小したJPEGを作成し、(ファイルのパス, 幅, 高さ) を返す。
+    縮小した写真は元の写真の隣に保存して使い回す (元の写真は内容のハッシュ値で保存されているため、名前が衝突しない)。
+    reportlab はJPEGのファイルを再圧縮せずにそのまま埋め込み、同じパスの画像は1つのXObjectを共有する。
+    """
+    dpi = dpi or REPORT_IMAGE_DPI
+    path = Path(path)
+    max_width = round(width / 72 * dpi)
+    scaled_path = path.with_name(f"{path.stem}.{max_width}w.jpg")
+    if scaled_path.exists():
+        with Image.open(scaled_path) as img:
+            return str(scaled_path), *img.size
+
+    with Image.open(path) as img:
+        # JPEGは縮小した解像度で復号する (全画素を復号するより速い)
+        img.draft("RGB", (max_width, max_width))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        if img.width > max_width:
+            img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS)
+        # 書き込み途中のファイルを他のワーカーが読まないよう、一時ファイルに書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, "JPEG", quality=REPORT_IMAGE_QUALITY, optimize=True)
+            os.replace(tmp_path, scaled_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return str(scaled_path), *img.size
+
+
+def draw_photo(c, path, x, top, width=PHOTO_WIDTH):
+    """写真を左上 (x, top) から幅 width で描画し、描画した高さを返す"""
+    with span("photo_scale"):
+        scaled_path, img_width, img_height = print_image(path, width)
+    draw_height = width * img_height / img_width
+    c.drawImage(scaled_path, x, top - draw_height, width=width, height=draw_height)
+    return draw_height
+
+
+def render_report_pdf(diagnosis_result):
+    """
+    診断結果からPDFレポートを生成し、PDFのバイト列を返す。
+    プロセスプールのワーカーからも呼び出せるよう、引数と戻り値はシリアライズ可能な値のみとする。
+    """
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+
+    # ==================================================================
+    # 術者向けAI診断サマリー (1ページ目)
+    # ==================================================================
+    with span("summary_page"):
+        create_summary_page(c, diagnosis_result)
+
+    # ==================================================================
+    # 保護者向けカウンセリングレポート (2ページ目以降)
+    # ==================================================================
+    c.showPage() # 改ページ
+    with span("counseling_page"):
+        create_counseling_report_page(c, diagnosis_result, diagnosis_result["photo_paths"], diagnosis_result["gemini_analyses"])
+
+    # 全ての部位の写真 (3ページ目以降)
+    if diagnosis_result["photo_paths"]:
+        c.showPage()
+        with span("photo_gallery"):
+            create_photo_gallery(c, diagnosis_result["photo_paths"])
+
+    with span("pdf_save"):
+        c.save()
+    return buffer.getvalue()
+
+
+def render_report_pdf_timed(diagnosis_result):
+    """render_report_pdf と同じだが、(PDFのバイト列, [(段階名, 秒), ...]) を返す (ワーカープロセスから所要時間を返すため)"""
+    timings = start_timings()
+    pdf_bytes = render_report_pdf(diagnosis_result)
+    return pdf_bytes, timings.spans
+
+def create_summary_page(c, diagnosis_result):
+    """術者向けAI診断サマリーページを作成する"""
+    width, height = letter
+    template = report_template()
+
+    # スタイルの設定
+    styleT = template.summary_table
+    styleBody = template.summary_body
+
+    # タイトル
+    template.summary_title.drawOn(c, 1 * inch, height - 1 * inch)
+
+    # 患者情報テーブル
+    patient_info = diagnosis_result['patient_info']
+    summary_data = diagnosis_result['analysis_summary']
+    
+    labels = template.summary_table_labels
+    data = [
+        [labels[0][0], Paragraph(patient_info['name'], styleT), labels[0][1], Paragraph(str(patient_info['age']), styleT)],
+        [labels[1][0], Paragraph(f'<b>{summary_data["risk_level"]}</b>', styleT), labels[1][1], Paragraph(summary_data["appliance_suggestion"], styleT)],
+        [labels[2][0], Paragraph(f'<b>{summary_data["mfs_score"]} / 9</b>', styleT), labels[2][1], Paragraph(f'<b>{summary_data["das_score"]} / 9</b>', styleT)],
+    ]
+    
+    table = Table(data, colWidths=[1.5*inch, 2*inch, 1.7*inch, 2.3*inch])
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
+        ('BACKGROUND', (2, 0), (2, -1), colors.lightgrey),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 5),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 5),
+    ]))
+    
+    table.wrapOn(c, width - 2 * inch, height)
+    table.drawOn(c, 1 * inch, height - 2.5 * inch)
+
+    # AIによる口腔内写真の客観的所見
+    y_pos = height - 3.5 * inch
+    template.summary_findings_heading.drawOn(c, 1 * inch, y_pos)
+    y_pos -= 0.4 * inch
+    
+    gemini_analyses = diagnosis_result.get("gemini_analyses", [])
+    if gemini_analyses:
+        for analysis in gemini_analyses:
+            if analysis.get("findings"):
+                # 構造化された所見 (ANALYSIS_MODE=combined) はMarkdownを変換せずにそのまま段落にする
+                html_text = f"<b>{escape(analysis['view'])}:</b><br/>" + "<br/>".join(
+                    f"・<b>{escape(f['category'])}</b>: {escape(f['finding'])}" for f in analysis["findings"]
+                )
+            else:
+                # MarkdownをHTMLに変換してParagraphで描画
+                with span("markdown"):
+                    html_text = template.markdown.reset().convert(f"<b>{analysis['view']}:</b> {analysis['analysis']}")
+            p = Paragraph(html_text, styleBody)
+            p_height = p.wrap(width - 2.2 * inch, height)[1]
+            if y_pos - p_height < 1 * inch:
+                c.showPage()
+                y_pos = height - 1 * inch
+            p.drawOn(c, 1.1 * inch, y_pos - p_height)
+            y_pos -= p_height + 10
+    else:
+        template.summary_no_findings.drawOn(c, 1.1 * inch, y_pos - 0.2 * inch)
+        y_pos -= 0.4 * inch
+
+    # 特記事項
+    y_pos -= 0.4 * inch
+    template.summary_notes_heading.drawOn(c, 1 * inch, y_pos)
+    y_pos -= 0.4 * inch
+
+    # (MFSとDASの詳細項目などをここに記載)
+    p = Paragraph(f"<b>MFS項目 ({summary_data['mfs_score']}点):</b> {', '.join(summary_data['mfs_yes_items'])}", styleBody)
+    p.wrapOn(c, width - 2.2 * inch, height)
+    p.drawOn(c, 1.1 * inch, y_pos - p.height)
+    y_pos -= p.height + 10
+
+    p = Paragraph(f"<b>DAS項目 ({summary_data['das_score']}点):</b> {', '.join(summary_data['das_items'])}", styleBody)
+    p.wrapOn(c, width - 2.2 * inch, height)
+    p.drawOn(c, 1.1 * inch, y_pos - p.height)
+    y_pos -= p.height + 10
+    
+    # その他所見
+    if diagnosis_result.get('other_findings'):
+        p = Paragraph(f"<b>その他口腔内所見:</b> {diagnosis_result['other_findings']}", styleBody)
+        p.wrapOn(c, width - 2.2 * inch, height)
+        p.drawOn(c, 1.1 * inch, y_pos - p.height)
+
+def create_counseling_report_page(c, diagnosis_result, photo_paths, gemini_analyses):
+    """保護者向けカウンセリングレポートページを作成する"""
+    width, height = letter
+    template = report_template()
+
+    # スタイルの設定
+    styleH1 = template.counseling_h1
+    styleBody = template.counseling_body
+    
+    patient_name = diagnosis_result['patient_info']['name']
+    summary_data = diagnosis_result['analysis_summary']
+    mfs_score = summary_data['mfs_score']
+
+    # 掴み
+    p = Paragraph(f"<b>{patient_name}くん・ちゃんの健やかな成長のために</b><br/><b>大切なお口のお話</b>", styleH1)
+    p.wrapOn(c, width - 2 * inch, height)
+    p.drawOn(c, 1 * inch, height - 1.5 * inch)
+
+    y_pos = height - 2.5 * inch
+
+    # 現状の説明
+    p = template.counseling_current_heading
+    p.drawOn(c, 1 * inch, y_pos)
+    y_pos -= p.height + 10
+
+    p = Paragraph(f"お口の悪い癖が、<b>{mfs_score}個</b>も見つかりました。<br/>このままだと、将来の歯並びだけでなく、健康にも影響が出てしまうかもしれません。", styleBody)
+    p.wrapOn(c, width - 2 * inch, height)
+    p.drawOn(c, 1 * inch, y_pos - p.height)
+    y_pos -= p.height + 20
+    
+    # (口腔内写真とAIの指摘を表示するロジック)
+    # ここでは最初の写真と解析結果を表示する例
+    if photo_paths and gemini_analyses:
+        photo_info = photo_paths[0]
+        analysis_info = gemini_analyses[0]
+        
+        try:
+            # 画像を描画 (ギャラリーと同じ大きさに縮小した画像を使い、PDFには1度だけ埋め込まれる)
+            draw_height = draw_photo(c, photo_info['path'], 1.5 * inch, y_pos)
+            y_pos -= draw_height + 10
+
+            # AIの分析結果を描画
+            p = template.counseling_ai_comment
+            p.drawOn(c, 1 * inch, y_pos - p.height)
+            y_pos -= p.height + 20
+
+        except Exception as e:
+            print(f"Error embedding counseling image: {e}")
+
+
+    # 原因の説明
+    p = template.counseling_cause_heading
+    p.drawOn(c, 1 * inch, y_pos - p.height)
+    y_pos -= p.height + 10
+
+    p = template.counseling_cause_body
+    p.drawOn(c, 1 * inch, y_pos - p.height)
+    y_pos -= p.height + 20
+
+    # 解決策の提示
+    appliance = summary_data['appliance_suggestion']
+    p = template.counseling_solution_heading
+    p.drawOn(c, 1 * inch, y_pos - p.height)
+    y_pos -= p.height + 10
+
+    p = Paragraph(f"そこで、当院では<b>「MRC治療」</b>をお勧めしています。<br/>これは、<b>「{appliance}」</b>という、柔らかいマウスピース型の装置を使って、お口の悪い癖を治し、あごの成長を助け、歯並びを自然に整える、世界中で行われている治療法です。", styleBody)
+    p.wrapOn(c, width - 2 * inch, height)
+    p.drawOn(c, 1 * inch, y_pos - p.height)
+    y_pos -= p.height + 20
+
+    # 未来の提示 & クロージング
+    p = template.counseling_future_heading
+    p.drawOn(c, 1 * inch, y_pos - p.height)
+    y_pos -= p.height + 10
+    
+    p = template.counseling_future_body
+    p.drawOn(c, 1 * inch, y_pos - p.height)
+
+
+def create_photo_gallery(c, photo_paths):
+    """全ての部位の写真を2列に並べ、ページに収まらない分は次のページに続ける"""
+    width, height = letter
+    template = report_template()
+    gap = width - 2 * inch - 2 * PHOTO_WIDTH
+
+    template.gallery_heading.drawOn(c, 1 * inch, height - 1 * inch - template.gallery_heading.height)
+    y_pos = height - 1.5 * inch
+    for i in range(0, len(photo_paths), 2):
+        row = []
+        for photo_info in photo_paths[i:i + 2]:
+            try:
+                with span("photo_scale"):
+                    row.append((photo_info, *print_image(photo_info["path"], PHOTO_WIDTH)))
+            except Exception as e:
+                print(f"Error embedding gallery image ({photo_info['view']}): {e}")
+        if not row:
+            continue
+        row_height = max(PHOTO_WIDTH * h / w for _, _, w, h in row) + 24
+        if y_pos - row_height < 1 * inch:
+            c.showPage()
+            y_pos = height - 1 * inch
+        for column, (photo_info, scaled_path, img_width, img_height) in enumerate(row):
+            x = 1 * inch + column * (PHOTO_WIDTH + gap)
+            c.setFont(template.gallery_caption.fontName, template.gallery_caption.fontSize)
+            c.drawString(x, y_pos - template.gallery_caption.fontSize, photo_info["view"])
+            draw_height = PHOTO_WIDTH * img_height / img_width
+            c.drawImage(scaled_path, x, y_pos - 16 - draw_height, width=PHOTO_WIDTH, height=draw_height)
+        y_pos -= row_height
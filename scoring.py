@@ -0,0 +1,264 @@
+import numpy as np
+
+# ==================================================================
+# 判定ルールの定義
+# ==================================================================
+
+# 筋機能評価スコア (MFS): 「はい」の項目ごとに1点
+MFS_ITEMS = [
+    ("mouth_breathing", "口呼吸"),
+    ("thumb_sucking", "指しゃぶり"),
+    ("nail_biting", "爪噛み"),
+    ("tongue_thrust", "舌癖"),
+    ("snoring", "いびき"),
+    ("tonsil_swelling", "扁桃腺の腫れ"),
+    ("allergic_rhinitis", "アレルギー性鼻炎"),
+    ("eating_sounds", "食事中の音"),
+    ("swallowing_pattern", "嚥下パターン"),
+]
+
+# 歯列評価スコア (DAS): (項目, 比較方法, 値, 点数, 所見)
+DAS_RULES = [
+    ("upper_jaw_condition", "eq", "crowding", 3, "上顎の叢生"),
+    ("upper_jaw_condition", "eq", "spacing", 1, "上顎の空隙歯列"),
+    ("lower_jaw_condition", "eq", "crowding", 3, "下顎の叢生"),
+    ("lower_jaw_condition", "eq", "spacing", 1, "下顎の空隙歯列"),
+    ("midline_deviation", "ge", 1.0, 1, "正中線のずれ ({midline_deviation}mm)"),
+    ("crossbite", "eq", "yes", 2, "交叉咬合"),
+]
+
+# リスク判定: 上から順に評価し、最初に条件を満たしたものを採用する。
+# 条件は「いずれかを満たす (項目, 値) の組」を全て満たすこと (AND of OR)
+RISK_RULES = [
+    ("高リスク", [
+        [("mouth_breathing", "yes")],
+        [("tongue_thrust", "yes")],
+        [("upper_jaw_condition", "crowding"), ("lower_jaw_condition", "crowding")],
+    ]),
+    ("中リスク", [
+        [("mouth_breathing", "yes"), ("tongue_thrust", "yes")],
+    ]),
+]
+DEFAULT_RISK_LEVEL = "低リスク"
+
+# アプライアンス選択: (推奨アプライアンス, 最低年齢, 最高年齢, 条件)。上から順に評価する
+APPLIANCE_RULES = [
+    ("T4K", 6, 10, [[("upper_jaw_condition", "crowding")]]),
+    ("Myobrace for Juniors", 3, 5, []),
+]
+DEFAULT_APPLIANCE = "要相談"
+
+# スコア計算に使うフォーム項目
+SCORING_FIELDS = sorted(
+    {field for field, _ in MFS_ITEMS}
+    | {rule[0] for rule in DAS_RULES}
+    | {field for _, conditions in RISK_RULES for group in conditions for field, _ in group}
+    | {field for *_, conditions in APPLIANCE_RULES for group in conditions for field, _ in group}
+    | {"patient_age"}
+)
+
+
+# ==================================================================
+# 1人分のスコア計算
+# ==================================================================
+
+def _rule_matches(form, field, op, value):
+    if op == "ge":
+        return form[field] >= value
+    return form[field] == value
+
+
+def _conditions_match(form, conditions):
+    return all(any(form[field] == value for field, value in group) for group in conditions)
+
+
+def score_patient(form):
+    """
+    1人分のフォームの入力内容から、MFS・DASスコア、該当項目、リスク判定、推奨アプライアンスを計算する。
+    戻り値のキーは mfs_score, das_score, mfs_yes_items, das_items, risk_level, appliance_suggestion。
+    """
+    mfs_yes_items = [label for field, label in MFS_ITEMS if form[field] == 'yes']
+
+    das_score = 0
+    das_items = []
+    for field, op, value, points, label in DAS_RULES:
+        if _rule_matches(form, field, op, value):
+            das_score += points
+            das_items.append(label.format(**form))
+
+    risk_level = next(
+        (level for level, conditions in RISK_RULES if _conditions_match(form, conditions)),
+        DEFAULT_RISK_LEVEL,
+    )
+    appliance_suggestion = next(
+        (name for name, age_min, age_max, conditions in APPLIANCE_RULES
+         if age_min <= form["patient_age"] <= age_max and _conditions_match(form, conditions)),
+        DEFAULT_APPLIANCE,
+    )
+
+    return {
+        "mfs_score": len(mfs_yes_items),
+        "das_score": das_score,
+        "mfs_yes_items": mfs_yes_items,
+        "das_items": das_items,
+        "risk_level": risk_level,
+        "appliance_suggestion": appliance_suggestion,
+    }
+
+
+# ==================================================================
+# 複数人のスコアをまとめて計算する (NumPy)
+# ==================================================================
+
+def cohort_columns(forms):
+    """フォームのリストを、スコア計算に使う項目ごとのNumPy配列に変換する"""
+    columns = {field: np.array([form[field] for form in forms]) for field in SCORING_FIELDS}
+    columns["patient_age"] = columns["patient_age"].astype(np.int64)
+    columns["midline_deviation"] = columns["midline_deviation"].astype(np.float64)
+    return columns
+
+
+def _cohort_conditions(columns, conditions, n):
+    mask = np.ones(n, dtype=bool)
+    for group in conditions:
+        group_mask = np.zeros(n, dtype=bool)
+        for field, value in group:
+            group_mask |= columns[field] == value
+        mask &= group_mask
+    return mask
+
+
+def score_cohort(columns):
+    """
+    患者集団の項目ごとの配列 (cohort_columns の戻り値) から、全員のスコアを一度に計算する。
+    戻り値は患者ごとの配列:
+      mfs_score, das_score (int), risk_level, appliance_suggestion (str),
+      mfs_yes (患者数 x MFS項目数の bool), das_hits (患者数 x DASルール数の bool)
+    """
+    n = len(columns["patient_age"])
+
+    mfs_yes = np.column_stack([columns[field] == 'yes' for field, _ in MFS_ITEMS]) if n else np.zeros((0, len(MFS_ITEMS)), dtype=bool)
+    das_hits = np.column_stack([
+        columns[field] >= value if op == "ge" else columns[field] == value
+        for field, op, value, _, _ in DAS_RULES
+    ]) if n else np.zeros((0, len(DAS_RULES)), dtype=bool)
+    das_points = np.array([points for *_, points, _ in DAS_RULES], dtype=np.int64)
+
+    risk_level = np.select(
+        [_cohort_conditions(columns, conditions, n) for _, conditions in RISK_RULES],
+        [level for level, _ in RISK_RULES],
+        default=DEFAULT_RISK_LEVEL,
+    )
+    age = columns["patient_age"]
+    appliance_suggestion = np.select(
+        [(age >= age_min) & (age <= age_max) & _cohort_conditions(columns, conditions, n)
+         for _, age_min, age_max, conditions in APPLIANCE_RULES],
+        [name for name, *_ in APPLIANCE_RULES],
+        default=DEFAULT_APPLIANCE,
+    )
+
+    return {
+        "mfs_score": mfs_yes.sum(axis=1),
+        "das_score": das_hits.astype(np.int64) @ das_points,
+        "risk_level": risk_level,
+        "appliance_suggestion": appliance_suggestion,
+        "mfs_yes": mfs_yes,
+        "das_hits": das_hits,
+    }
+
+
+def cohort_patient(columns, scores, i):
+    """score_cohort の結果から i 番目の患者の結果を取り出す (score_patient と同じ形式)"""
+    midline_deviation = float(columns["midline_deviation"][i])
+    return {
+        "mfs_score": int(scores["mfs_score"][i]),
+        "das_score": int(scores["das_score"][i]),
+        "mfs_yes_items": [label for (_, label), hit in zip(MFS_ITEMS, scores["mfs_yes"][i]) if hit],
+        "das_items": [
+            label.format(midline_deviation=midline_deviation)
+            for (*_, label), hit in zip(DAS_RULES, scores["das_hits"][i]) if hit
+        ],
+        "risk_level": str(scores["risk_level"][i]),
+        "appliance_suggestion": str(scores["appliance_suggestion"][i]),
+    }
+
+
+# ==================================================================
+# 判定ルールの確認用ゴールデンケース (python scoring.py で確認する)
+# ==================================================================
+
+_NO_HABITS = {field: "no" for field, _ in MFS_ITEMS}
+_NORMAL_EXAM = {"upper_jaw_condition": "normal", "lower_jaw_condition": "normal", "midline_deviation": 0.0, "crossbite": "no"}
+
+GOLDEN_CASES = [
+    (
+        {**_NO_HABITS, **_NORMAL_EXAM, "patient_age": 8},
+        {"mfs_score": 0, "das_score": 0, "mfs_yes_items": [], "das_items": [],
+         "risk_level": "低リスク", "appliance_suggestion": "要相談"},
+    ),
+    (
+        {**_NO_HABITS, **_NORMAL_EXAM, "mouth_breathing": "yes", "tongue_thrust": "yes",
+         "upper_jaw_condition": "crowding", "patient_age": 7},
+        {"mfs_score": 2, "das_score": 3, "mfs_yes_items": ["口呼吸", "舌癖"], "das_items": ["上顎の叢生"],
+         "risk_level": "高リスク", "appliance_suggestion": "T4K"},
+    ),
+    (
+        {**_NO_HABITS, **_NORMAL_EXAM, "mouth_breathing": "yes", "tongue_thrust": "yes",
+         "lower_jaw_condition": "crowding", "patient_age": 11},
+        {"mfs_score": 2, "das_score": 3, "mfs_yes_items": ["口呼吸", "舌癖"], "das_items": ["下顎の叢生"],
+         "risk_level": "高リスク", "appliance_suggestion": "要相談"},
+    ),
+    (
+        {**_NO_HABITS, **_NORMAL_EXAM, "tongue_thrust": "yes", "upper_jaw_condition": "crowding",
+         "lower_jaw_condition": "spacing", "midline_deviation": 1.5, "crossbite": "yes", "patient_age": 10},
+        {"mfs_score": 1, "das_score": 7, "mfs_yes_items": ["舌癖"],
+         "das_items": ["上顎の叢生", "下顎の空隙歯列", "正中線のずれ (1.5mm)", "交叉咬合"],
+         "risk_level": "中リスク", "appliance_suggestion": "T4K"},
+    ),
+    (
+        {**{field: "yes" for field, _ in MFS_ITEMS}, **_NORMAL_EXAM, "mouth_breathing": "unknown",
+         "upper_jaw_condition": "spacing", "midline_deviation": 1.0, "patient_age": 3},
+        {"mfs_score": 8, "das_score": 2,
+         "mfs_yes_items": ["指しゃぶり", "爪噛み", "舌癖", "いびき", "扁桃腺の腫れ", "アレルギー性鼻炎", "食事中の音", "嚥下パターン"],
+         "das_items": ["上顎の空隙歯列", "正中線のずれ (1.0mm)"],
+         "risk_level": "中リスク", "appliance_suggestion": "Myobrace for Juniors"},
+    ),
+    (
+        {**_NO_HABITS, **_NORMAL_EXAM, "snoring": "yes", "upper_jaw_condition": "crowding",
+         "lower_jaw_condition": "crowding", "midline_deviation": 0.9, "patient_age": 5},
+        {"mfs_score": 1, "das_score": 6, "mfs_yes_items": ["いびき"], "das_items": ["上顎の叢生", "下顎の叢生"],
+         "risk_level": "低リスク", "appliance_suggestion": "Myobrace for Juniors"},
+    ),
+    (
+        {**_NO_HABITS, **_NORMAL_EXAM, "mouth_breathing": "yes", "upper_jaw_condition": "crowding", "patient_age": 6},
+        {"mfs_score": 1, "das_score": 3, "mfs_yes_items": ["口呼吸"], "das_items": ["上顎の叢生"],
+         "risk_level": "中リスク", "appliance_suggestion": "T4K"},
+    ),
+    (
+        {**_NO_HABITS, **_NORMAL_EXAM, "lower_jaw_condition": "crowding", "patient_age": 2},
+        {"mfs_score": 0, "das_score": 3, "mfs_yes_items": [], "das_items": ["下顎の叢生"],
+         "risk_level": "低リスク", "appliance_suggestion": "要相談"},
+    ),
+]
+
+
+def verify_golden_cases():
+    """1人分の計算と集団の一括計算の両方が、ゴールデンケースと一致するか確認する"""
+    forms = [form for form, _ in GOLDEN_CASES]
+    columns = cohort_columns(forms)
+    scores = score_cohort(columns)
+    mismatches = []
+    for i, (form, expected) in enumerate(GOLDEN_CASES):
+        for mode, actual in (("single", score_patient(form)), ("cohort", cohort_patient(columns, scores, i))):
+            if actual != expected:
+                mismatches.append((i, mode, actual, expected))
+    return mismatches
+
+
+if __name__ == "__main__":
+    mismatches = verify_golden_cases()
+    for i, mode, actual, expected in mismatches:
+        print(f"ケース{i} ({mode}) が一致しません:\n  結果: {actual}\n  期待: {expected}")
+    if mismatches:
+        raise SystemExit(1)
+    print(f"全{len(GOLDEN_CASES)}件のゴールデンケースが、1人分の計算と一括計算の両方で一致しました。")
@@ -0,0 +1,145 @@
+"""
+同じ入力の診断リクエストをまとめる (single-flight)。
+ボタンの二度押しや、応答が遅いときのクライアントの再送で同じフォームと写真が同時に届いた場合に、
+先に届いた1件だけが写真の解析を行い、残りはその完了を待って同じ結果を受け取る。
+実行中の印をSQLiteに記録するため、同じファイルを使う全てのgunicornワーカーの間でまとめられる。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+from metrics import SINGLE_FLIGHT_REQUESTS
+from storage import UPLOAD_DIR
+from timing import span
+
+# sqlite のとき同じ入力の診断をまとめる。off にするとまとめない
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "sqlite")
+SINGLE_FLIGHT_DB_PATH = os.getenv("SINGLE_FLIGHT_DB_PATH", str(UPLOAD_DIR / "single_flight.sqlite3"))
+# 実行中の印がこの秒数より古ければ、実行していたワーカーが止まったとみなして引き継ぐ
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "300"))
+# 完了後もこの秒数の間は、同じ入力のリクエストに同じ結果を返す (遅い応答の後の再送に備える)
+SINGLE_FLIGHT_WINDOW = float(os.getenv("SINGLE_FLIGHT_WINDOW", "30"))
+# 完了を待つ間の確認の間隔（秒）
+SINGLE_FLIGHT_POLL = float(os.getenv("SINGLE_FLIGHT_POLL", "0.2"))
+
+
+def request_key(form, received_photos):
+    """フォームの入力 (型を変換済みの値) と写真の部位・内容からキーを作成する"""
+    h = hashlib.sha256()
+    h.update(json.dumps(form, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    for photo in received_photos:
+        h.update(b"\0")
+        h.update(photo.view.encode("utf-8"))
+        h.update(bytes.fromhex(photo.digest) if photo.digest else hashlib.sha256(photo.data).digest())
+    return h.hexdigest()
+
+
+class SingleFlight:
+    """
+    キーごとの実行中・完了の印をSQLiteに保存する。
+    完了した印には結果のID (診断結果の保存先のID) を記録し、待っていたリクエストはそのIDで結果を読み込む。
+    """
+
+    def __init__(self, db_path, timeout=SINGLE_FLIGHT_TIMEOUT, window=SINGLE_FLIGHT_WINDOW, poll=SINGLE_FLIGHT_POLL):
+        self.db_path = str(db_path)
+        self.timeout = timeout
+        self.window = window
+        self.poll = poll
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS flights ("
+                "key TEXT PRIMARY KEY, owner TEXT NOT NULL, result_id TEXT, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def claim(self, key):
+        """
+        key の実行を引き受ける。(owner, None) なら呼び出し側が実行し、(None, result_id) なら完了済みの結果を使う。
+        (None, None) は他のリクエストが実行中であることを表す。
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            # 確認と書き込みの間に他のワーカーが割り込まないよう、書き込みロックを取ってから確認する
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT result_id, updated_at FROM flights WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                result_id, updated_at = row
+                if result_id is None and now - updated_at < self.timeout:
+                    conn.execute("COMMIT")
+                    return None, None
+                if result_id is not None and now - updated_at < self.window:
+                    conn.execute("COMMIT")
+                    return None, result_id
+            owner = uuid.uuid4().hex
+            conn.execute(
+                "INSERT OR REPLACE INTO flights (key, owner, result_id, updated_at) VALUES (?, ?, NULL, ?)",
+                (key, owner, now),
+            )
+            conn.execute("DELETE FROM flights WHERE updated_at < ?", (now - max(self.timeout, self.window),))
+            conn.execute("COMMIT")
+            return owner, None
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def finish(self, key, owner, result_id):
+        """実行の終了を記録する。result_id が無ければ (失敗・保存できなかった) 印を消し、次のリクエストに実行させる"""
+        with self._connect() as conn:
+            if result_id:
+                conn.execute(
+                    "UPDATE flights SET result_id = ?, updated_at = ? WHERE key = ? AND owner = ?",
+                    (result_id, time.time(), key, owner),
+                )
+            else:
+                conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, owner))
+
+    async def run(self, key, compute, load):
+        """
+        key の計算を全ワーカーで1回にまとめる。引き受けたリクエストは compute() で (結果のID, 結果) を求め、
+        同時に届いたリクエストは完了を待って load(結果のID) で結果を読み込む。
+        戻り値は (結果, まとめられた側か)。
+        """
+        with span("single_flight"):
+            while True:
+                owner, result_id = await asyncio.to_thread(self.claim, key)
+                if owner is not None or result_id is not None:
+                    break
+                await asyncio.sleep(self.poll)
+
+        if owner is not None:
+            SINGLE_FLIGHT_REQUESTS.labels("leader").inc()
+            result_id = None
+            try:
+                result_id, result = await compute()
+            finally:
+                # 書き込みはスレッドで行う。キャンセルされた場合も待っているリクエストが引き継げるよう、終わるのは待たない
+                asyncio.get_running_loop().run_in_executor(None, self.finish, key, owner, result_id)
+            return result, False
+
+        result = await asyncio.to_thread(load, result_id)
+        if result is None:
+            # 結果を読み込めなければ (保存先がワーカーごとのメモリなど) 自分で計算する
+            SINGLE_FLIGHT_REQUESTS.labels("fallback").inc()
+            return (await compute())[1], False
+        SINGLE_FLIGHT_REQUESTS.labels("follower").inc()
+        return result, True
+
+
+def create_single_flight():
+    """SINGLE_FLIGHT の設定に応じて作成する。off なら None"""
+    if SINGLE_FLIGHT == "off":
+        return None
+    return SingleFlight(SINGLE_FLIGHT_DB_PATH)
+
+
+single_flight = create_single_flight()
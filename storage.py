@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+# このファイルの場所を基準に絶対パスを構築
+BASE_DIR = Path(__file__).resolve().parent
+
+# アップロードされたファイルを保存するディレクトリも絶対パスで設定
+UPLOAD_DIR = Path(BASE_DIR, "uploads")
+# 写真は内容のハッシュ値をファイル名にして保存する (同名ファイルの上書きが起きない)
+PHOTO_DIR = UPLOAD_DIR / "photos"
+os.makedirs(PHOTO_DIR, exist_ok=True)
+
+# 保存した写真などを削除するまでの期間（秒）と、保存容量の上限（バイト）
+UPLOAD_RETENTION_SECONDS = float(os.getenv("UPLOAD_RETENTION_SECONDS", str(7 * 24 * 3600)))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(1024 ** 3)))
+# 削除処理を実行する間隔（秒）
+UPLOAD_SWEEP_INTERVAL = float(os.getenv("UPLOAD_SWEEP_INTERVAL", "600"))
+
+
+def store_photo(data, suffix, digest=None):
+    """
+    写真を内容のハッシュ値で保存し、保存先のパスを返す。同じ内容の写真は1つのファイルを共有する。
+    計算済みのハッシュ値 (sha256 の16進数) を digest に渡すと計算し直さない。
+    """
+    digest = digest or hashlib.sha256(data).hexdigest()
+    suffix = "".join(ch for ch in suffix.lower() if ch.isalnum())
+    path = PHOTO_DIR / digest[:2] / (f"{digest}.{suffix}" if suffix else digest)
+    try:
+        # 既にあれば更新時刻を変えて保存期間を延長する (touch() と違い、削除された直後に空のファイルを作らない)
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        # 無いか、確認の直前に削除された
+        pass
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def _managed_files():
+    # 写真と、以前のバージョンで保存していたPDFレポートを対象にする
+    files = [p for p in PHOTO_DIR.rglob("*") if p.is_file()]
+    files += [p for p in UPLOAD_DIR.glob("*.pdf") if p.is_file()]
+    return files
+
+
+def sweep_uploads(max_age=None, max_bytes=None, now=None, keep=None):
+    """
+    保存期間を過ぎたファイルを削除し、合計サイズが上限を超える場合は古いものから削除する。
+    keep に含まれる名前のファイル (保存した診断が参照している写真) は削除しないが、合計サイズには含める。
+    削除したファイル数とバイト数を返す。
+    """
+    max_age = UPLOAD_RETENTION_SECONDS if max_age is None else max_age
+    max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    now = now or time.time()
+
+    entries = []
+    for path in _managed_files():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    total_bytes = sum(size for _, size, _ in entries)
+    removed_files = 0
+    removed_bytes = 0
+    for mtime, size, path in entries:
+        if now - mtime <= max_age and total_bytes <= max_bytes:
+            break
+        if keep and path.name in keep:
+            continue
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            # 他のワーカーが先に削除した
+            pass
+        else:
+            removed_files += 1
+            removed_bytes += size
+        total_bytes -= size
+    return removed_files, removed_bytes
+
+
+async def retention_loop(on_sweep=None, interval=None, referenced=None):
+    """
+    一定間隔で sweep_uploads を実行し続ける (アプリの起動時にバックグラウンドで開始する)。
+    on_sweep には UPLOAD_RETENTION_SECONDS 秒前の時刻を渡す (ジョブや診断の削除)。診断が参照している写真も削除できるよう、写真より先に呼び出す。
+    referenced を渡すと、referenced() が返す名前のファイルは削除しない。
+    """
+    interval = interval or UPLOAD_SWEEP_INTERVAL
+    while True:
+        try:
+            if on_sweep:
+                await asyncio.to_thread(on_sweep, time.time() - UPLOAD_RETENTION_SECONDS)
+            keep = await asyncio.to_thread(referenced) if referenced else None
+            removed_files, removed_bytes = await asyncio.to_thread(sweep_uploads, keep=keep)
+            if removed_files:
+                print(f"保存期間を過ぎたファイルを削除しました: {removed_files}件 ({removed_bytes} bytes)")
+        except Exception as e:
+            print(f"Error during upload retention sweep: {e}")
+        await asyncio.sleep(interval)
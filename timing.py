@@ -0,0 +1,60 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+# 処理中のリクエスト (またはジョブ) の所要時間の記録先
+_current_timings = contextvars.ContextVar("current_timings", default=None)
+
+
+class Timings:
+    """1件の診断の段階ごとの所要時間 (秒) を記録する。同じ名前の段階は合計する"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._spans = {}
+
+    def add(self, name, seconds):
+        self._spans[name] = self._spans.get(name, 0.0) + seconds
+
+    def extend(self, spans):
+        for name, seconds in spans:
+            self.add(name, seconds)
+
+    @property
+    def spans(self):
+        """[(段階名, 秒), ...] (プロセス間で受け渡しできる形式)"""
+        return list(self._spans.items())
+
+    def server_timing(self):
+        """Server-Timing ヘッダーの値 (ミリ秒)"""
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self._spans.items())
+
+
+def start_timings():
+    """新しい記録を開始し、以降の span() の記録先にする"""
+    timings = Timings()
+    _current_timings.set(timings)
+    return timings
+
+
+def current_timings():
+    return _current_timings.get()
+
+
+@contextmanager
+def span(name):
+    """with ブロックの所要時間を、処理中のリクエストの記録に加える (記録を開始していなければ何もしない)"""
+    timings = _current_timings.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.add(name, time.perf_counter() - start)
+
+
+def mark(name):
+    """記録の開始から現在までの経過時間を記録する (フォームの受信など、開始時点から続く段階に使う)"""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, time.perf_counter() - timings.started)